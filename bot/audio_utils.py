@@ -0,0 +1,82 @@
+# audio_utils.py - Нарезка длинных голосовых сообщений на куски по паузам (ffmpeg в отдельном процессе)
+import asyncio
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+import config
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = "ffmpeg"
+
+# тишина тише порога дольше SILENCE_MIN_DURATION секунд считается паузой между фразами
+SILENCE_NOISE_DB = -30
+SILENCE_MIN_DURATION = 0.5
+
+_silence_start_re = re.compile(r"silence_start: (-?[\d.]+)")
+_silence_end_re = re.compile(r"silence_end: (-?[\d.]+)")
+
+
+async def _run_ffmpeg(args, input_bytes: bytes) -> bytes:
+    """Запустить ffmpeg, не блокируя event loop; возвращает stderr (там же лог silencedetect)"""
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, "-hide_banner", "-nostats", *args,
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate(input_bytes)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {stderr.decode(errors='ignore')[-500:]}")
+    return stderr.decode(errors="ignore")
+
+
+async def detect_silences(audio_bytes: bytes) -> list:
+    """Середины пауз (в секундах от начала)"""
+    log = await _run_ffmpeg(
+        ["-i", "pipe:0", "-af", f"silencedetect=noise={SILENCE_NOISE_DB}dB:d={SILENCE_MIN_DURATION}", "-f", "null", "-"],
+        audio_bytes
+    )
+    starts = [float(value) for value in _silence_start_re.findall(log)]
+    ends = [float(value) for value in _silence_end_re.findall(log)]
+    return [(start + end) / 2 for start, end in zip(starts, ends)]
+
+
+def plan_split_points(duration: float, silences: list, chunk_seconds: float) -> list:
+    """Точки разреза: последняя пауза во второй половине каждого куска, без паузы - ровно через chunk_seconds"""
+    split_points = []
+    start = 0
+    while duration - start > chunk_seconds:
+        end = start + chunk_seconds
+        candidates = [point for point in silences if start + chunk_seconds / 2 <= point <= end]
+        start = candidates[-1] if candidates else end
+        split_points.append(start)
+
+    return split_points
+
+
+async def split_audio(audio_bytes: bytes, duration: float) -> list:
+    """Разрезать ogg/opus по паузам на куски не длиннее voice_chunk_seconds; без ffmpeg или при ошибке - один кусок"""
+    if duration <= config.voice_chunk_seconds or shutil.which(FFMPEG) is None:
+        return [audio_bytes]
+
+    try:
+        split_points = plan_split_points(duration, await detect_silences(audio_bytes), config.voice_chunk_seconds)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # -c copy: opus-пакеты не перекодируются, разрез по ближайшей границе пакета (20 мс)
+            await _run_ffmpeg([
+                "-i", "pipe:0", "-f", "segment", "-segment_times", ",".join(f"{point:.2f}" for point in split_points),
+                "-reset_timestamps", "1", "-c", "copy", os.path.join(directory, "chunk%03d.oga")
+            ], audio_bytes)
+
+            chunks = []
+            for filename in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, filename), "rb") as f:
+                    chunks.append(f.read())
+    except Exception as e:
+        logger.warning(f"Failed to split voice message, transcribing it in one request: {e}")
+        return [audio_bytes]
+
+    return chunks or [audio_bytes]
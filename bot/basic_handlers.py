@@ -1,5 +1,4 @@
 # basic_handlers.py - Базовые обработчики команд с поддержкой групп
-from datetime import datetime
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext
@@ -12,11 +11,11 @@ async def start_handle(update: Update, context: CallbackContext, db):
     await register_user_if_not_exists(update, context, update.message.from_user, db)
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    db.update_last_interaction(user_id)
+    await db.start_new_dialog(user_id)
 
     # Проверяем, установлен ли уже язык у пользователя
-    user_language = db.get_user_attribute(user_id, "language")
+    user_language = await db.get_user_attribute(user_id, "language")
 
     if not user_language:
         # Если язык не установлен, показываем выбор языка НА РУССКОМ
@@ -32,25 +31,25 @@ async def start_handle(update: Update, context: CallbackContext, db):
         return
 
     # Если язык уже установлен, показываем обычное приветствие
-    reply_text = t(user_id, "start_greeting", chat_id=update.message.chat.id)
-    reply_text += t(user_id, "help_message", chat_id=update.message.chat.id)
+    reply_text = await t(user_id, "start_greeting", chat_id=update.message.chat.id)
+    reply_text += await t(user_id, "help_message", chat_id=update.message.chat.id)
 
     await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
 
 async def help_handle(update: Update, context: CallbackContext, db):
     await register_user_if_not_exists(update, context, update.message.from_user, db)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
-    help_text = t(user_id, "help_message", chat_id=update.message.chat.id)
+    help_text = await t(user_id, "help_message", chat_id=update.message.chat.id)
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
 
 async def help_group_chat_handle(update: Update, context: CallbackContext, db):
     await register_user_if_not_exists(update, context, update.message.from_user, db)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
-    text = t(user_id, "help_group_chat", chat_id=update.message.chat.id, bot_username="@" + context.bot.username)
+    text = await t(user_id, "help_group_chat", chat_id=update.message.chat.id, bot_username="@" + context.bot.username)
 
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
     await update.message.reply_video(config.help_group_chat_video_path)
@@ -63,16 +62,16 @@ async def new_dialog_handle(update: Update, context: CallbackContext, db):
 
     # Только для личных чатов
     if chat_id > 0:
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
-        db.set_user_attribute(user_id, "current_model", config.default_model)
-        db.start_new_dialog(user_id)
+        db.update_last_interaction(user_id)
+        await db.set_user_attribute(user_id, "current_model", config.default_model)
+        await db.start_new_dialog(user_id)
 
-        success_text = t(user_id, "new_dialog_started", chat_id=chat_id)
+        success_text = await t(user_id, "new_dialog_started", chat_id=chat_id)
         await update.message.reply_text(success_text)
 
         # Получаем локализованное welcome сообщение
-        chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-        user_language = db.get_user_attribute(user_id, "language") or "en"
+        chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
+        user_language = await db.get_user_attribute(user_id, "language") or "en"
 
         welcome_message = config.chat_modes[chat_mode]["welcome_message"]
 
@@ -85,20 +84,20 @@ async def new_dialog_handle(update: Update, context: CallbackContext, db):
     else:
         # Для групп просто уведомляем, что команда работает только в личных чатах
         await update.message.reply_text(
-            t(user_id, "new_dialog_group_not_supported", chat_id=chat_id),
+            await t(user_id, "new_dialog_group_not_supported", chat_id=chat_id),
             parse_mode=ParseMode.HTML
         )
 
-def get_chat_mode_menu(page_index: int, user_id: int, chat_id: int = None, db=None):
+async def get_chat_mode_menu(page_index: int, user_id: int, chat_id: int = None, db=None):
     """Получить меню режимов чата с поддержкой групп"""
     # Используем именованные параметры для t()
-    text = t(user_id, "select_chat_mode", chat_id=chat_id, count=len(config.chat_modes))
+    text = await t(user_id, "select_chat_mode", chat_id=chat_id, count=len(config.chat_modes))
 
     # Получаем текущий режим чата с учетом групп
     if chat_id and chat_id < 0:  # Группа
-        current_chat_mode = db.get_group_attribute(chat_id, "current_chat_mode") or "assistant"
+        current_chat_mode = await db.get_group_attribute(chat_id, "current_chat_mode") or "assistant"
     else:  # Личный чат
-        current_chat_mode = db.get_user_attribute(user_id, "current_chat_mode") or "assistant"
+        current_chat_mode = await db.get_user_attribute(user_id, "current_chat_mode") or "assistant"
 
     # buttons
     chat_mode_keys = list(config.chat_modes.keys())
@@ -152,9 +151,9 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext, db):
             await send_admin_rights_error(update, context, db)
             return
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
-    text, reply_markup = get_chat_mode_menu(0, user_id, chat_id=chat_id, db=db)
+    text, reply_markup = await get_chat_mode_menu(0, user_id, chat_id=chat_id, db=db)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 async def show_chat_modes_callback_handle(update: Update, context: CallbackContext, db):
@@ -167,7 +166,7 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
     user_id = update.callback_query.from_user.id
     chat_id = update.callback_query.message.chat.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     query = update.callback_query
     await query.answer()
@@ -176,7 +175,7 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
     if page_index < 0:
         return
 
-    text, reply_markup = get_chat_mode_menu(page_index, user_id, chat_id=chat_id, db=db)
+    text, reply_markup = await get_chat_mode_menu(page_index, user_id, chat_id=chat_id, db=db)
     try:
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     except telegram.error.BadRequest as e:
@@ -196,7 +195,7 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext, db):
     # Проверяем права для групп - только тот, кто добавил бота
     if chat_id < 0:  # Группа
         if not await check_group_admin_rights(update, context, db):
-            await update.callback_query.answer(t(user_id, "group_admin_only", chat_id=chat_id))
+            await update.callback_query.answer(await t(user_id, "group_admin_only", chat_id=chat_id))
             return
 
     query = update.callback_query
@@ -206,16 +205,16 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext, db):
 
     # Для групп сохраняем в настройках группы
     if chat_id < 0:  # Группа
-        db.set_group_attribute(chat_id, "current_chat_mode", chat_mode)
-        user_language = db.get_group_attribute(chat_id, "language") or "en"
+        await db.set_group_attribute(chat_id, "current_chat_mode", chat_mode)
+        user_language = await db.get_group_attribute(chat_id, "language") or "en"
     else:  # Личный чат
-        db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-        db.start_new_dialog(user_id)
-        user_language = db.get_user_attribute(user_id, "language") or "en"
+        await db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+        await db.start_new_dialog(user_id)
+        user_language = await db.get_user_attribute(user_id, "language") or "en"
 
     # Сначала обновляем меню с новой отметкой
     try:
-        text, reply_markup = get_chat_mode_menu(0, user_id, chat_id=chat_id, db=db)
+        text, reply_markup = await get_chat_mode_menu(0, user_id, chat_id=chat_id, db=db)
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     except telegram.error.BadRequest as e:
         if str(e).startswith("Message is not modified"):
@@ -236,13 +235,13 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext, db):
         parse_mode=ParseMode.HTML
     )
 
-def get_settings_menu(user_id: int, chat_id: int, db):
+async def get_settings_menu(user_id: int, chat_id: int, db):
     """Получить меню настроек с поддержкой групп"""
     # Определяем откуда брать настройки
     if chat_id < 0:  # Группа
-        current_model = db.get_group_attribute(chat_id, "current_model")
+        current_model = await db.get_group_attribute(chat_id, "current_model")
     else:  # Личный чат
-        current_model = db.get_user_attribute(user_id, "current_model")
+        current_model = await db.get_user_attribute(user_id, "current_model")
 
     text = config.models["info"][current_model]["description"]
 
@@ -252,7 +251,7 @@ def get_settings_menu(user_id: int, chat_id: int, db):
         text += "🟢" * score_value + "⚪️" * (5 - score_value) + f" – {score_key}\n\n"
 
     # Исправленный вызов t() с именованными параметрами
-    text += t(user_id, "select_model", chat_id=chat_id)
+    text += await t(user_id, "select_model", chat_id=chat_id)
 
     # buttons to choose models - используем available_text_models из конфигурации
     keyboard = []
@@ -285,9 +284,9 @@ async def settings_handle(update: Update, context: CallbackContext, db):
             await send_admin_rights_error(update, context, db)
             return
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
-    text, reply_markup = get_settings_menu(user_id, chat_id, db)
+    text, reply_markup = await get_settings_menu(user_id, chat_id, db)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 async def set_settings_handle(update: Update, context: CallbackContext, db):
@@ -303,7 +302,7 @@ async def set_settings_handle(update: Update, context: CallbackContext, db):
     # Проверяем права для групп - только тот, кто добавил бота
     if chat_id < 0:  # Группа
         if not await check_group_admin_rights(update, context, db):
-            await update.callback_query.answer(t(user_id, "group_admin_only", chat_id=chat_id))
+            await update.callback_query.answer(await t(user_id, "group_admin_only", chat_id=chat_id))
             return
 
     query = update.callback_query
@@ -313,12 +312,12 @@ async def set_settings_handle(update: Update, context: CallbackContext, db):
 
     # Для групп сохраняем в настройках группы
     if chat_id < 0:  # Группа
-        db.set_group_attribute(chat_id, "current_model", model_key)
+        await db.set_group_attribute(chat_id, "current_model", model_key)
     else:  # Личный чат
-        db.set_user_attribute(user_id, "current_model", model_key)
-        db.start_new_dialog(user_id)
+        await db.set_user_attribute(user_id, "current_model", model_key)
+        await db.start_new_dialog(user_id)
 
-    text, reply_markup = get_settings_menu(user_id, chat_id, db)
+    text, reply_markup = await get_settings_menu(user_id, chat_id, db)
     try:
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     except telegram.error.BadRequest as e:
@@ -1,4 +1,5 @@
 # bot.py - Главный файл бота с системой локализации
+import asyncio
 import logging
 import traceback
 import html
@@ -21,7 +22,8 @@ from telegram.constants import ParseMode
 # Импорты модулей
 import config
 import database
-from utils import split_text_into_chunks
+import openai_utils
+from utils import split_text_into_chunks, with_request_context
 
 # Инициализация локализации
 from localization import init_localization, TEXTS
@@ -42,6 +44,7 @@ from basic_handlers import (
 from message_handlers import (
     message_handle,
     voice_message_handle,
+    is_bot_mentioned,
     unsupport_message_handle,
     retry_handle,
     cancel_handle
@@ -71,6 +74,9 @@ from member_handlers import my_chat_member_handler, chat_member_handler
 db = database.Database()
 logger = logging.getLogger(__name__)
 
+# фоновые задачи, запущенные в post_init (останавливаются в post_shutdown)
+background_tasks = []
+
 # Инициализация локализации
 localization = init_localization(db)
 
@@ -100,9 +106,55 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
     except:
         await context.bot.send_message(update.effective_chat.id, "Some error in error handler")
 
+async def run_legacy_data_migration():
+    """Фоновая миграция: ошибка не останавливает бота, но попадает в лог"""
+    try:
+        await db.migrate_legacy_data()
+        logger.info("Legacy data migration finished")
+    except Exception:
+        logger.exception("Legacy data migration failed")
+
 async def post_init(application: Application):
     """Инициализация команд бота с локализацией"""
 
+    # Общий HTTP-клиент для запросов к OpenAI
+    await openai_utils.init_http_session()
+
+    # System prompt для каждой пары (chat_mode, language) считается в токенах один раз
+    try:
+        openai_utils.init_system_prompts()
+    except Exception as e:
+        logger.error(f"Failed to count system prompt tokens: {e}")
+
+    # Индексы для запросов подписок, диалогов и платежей
+    try:
+        index_report = await db.get_index_report()
+        if index_report["missing"]:
+            logger.info(f"Creating missing MongoDB indexes: {', '.join(index_report['missing'])}")
+        if index_report["unused"]:
+            logger.info(f"Unused MongoDB indexes since server start: {', '.join(index_report['unused'])}")
+
+        await db.ensure_indexes()
+
+        # проверка по живым индексам уже после создания
+        index_report = await db.get_index_report()
+        if index_report["missing"] or index_report["mismatched"]:
+            logger.warning(
+                f"MongoDB indexes differ from the declared ones: missing {index_report['missing']}, "
+                f"different keys {index_report['mismatched']}"
+            )
+    except Exception as e:
+        logger.error(f"Failed to ensure MongoDB indexes: {e}")
+
+    # Миграция документов старого формата в фоне, вне горячего пути обработки
+    background_tasks.append(asyncio.create_task(run_legacy_data_migration()))
+
+    # Периодический сброс буфера last_interaction
+    background_tasks.append(asyncio.create_task(db.run_last_interactions_flusher()))
+
+    # Метрики очередей лимитов OpenAI и кеша ответов
+    background_tasks.append(asyncio.create_task(openai_utils.run_stats_logger()))
+
     # Получаем команды из системы локализации
     def get_commands_for_language(lang_code):
         texts = TEXTS.get(lang_code, TEXTS["en"])
@@ -134,6 +186,18 @@ async def post_init(application: Application):
         # Устанавливаем хотя бы базовые команды
         await application.bot.set_my_commands(get_commands_for_language("en"))
 
+async def post_shutdown(application: Application):
+    """Остановить фоновые задачи, сбросить буферизованные записи и закрыть соединения"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+    await db.flush_last_interactions()
+    await openai_utils.close_http_session()
+
+    logger.info(f"OpenAI stats: {openai_utils.get_openai_stats()}")
+
 def run_bot() -> None:
     """Запуск бота"""
     application = (
@@ -144,6 +208,7 @@ def run_bot() -> None:
         .http_version("1.1")
         .get_updates_http_version("1.1")
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -156,52 +221,52 @@ def run_bot() -> None:
         group_ids = [x for x in any_ids if x < 0]
         user_filter = filters.User(username=usernames) | filters.User(user_id=user_ids) | filters.Chat(chat_id=group_ids)
 
-    application.add_handler(ChatMemberHandler(lambda u, c: my_chat_member_handler(u, c, db), ChatMemberHandler.MY_CHAT_MEMBER))
-    application.add_handler(ChatMemberHandler(lambda u, c: chat_member_handler(u, c, db), ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(with_request_context(my_chat_member_handler, db), ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(with_request_context(chat_member_handler, db), ChatMemberHandler.CHAT_MEMBER))
 
     # Основные обработчики команд
-    application.add_handler(CommandHandler("start", lambda u, c: start_handle(u, c, db), filters=user_filter))
-    application.add_handler(CommandHandler("help", lambda u, c: help_handle(u, c, db), filters=user_filter))
-    application.add_handler(CommandHandler("help_group_chat", lambda u, c: help_group_chat_handle(u, c, db), filters=user_filter))
-    application.add_handler(CommandHandler("new", lambda u, c: new_dialog_handle(u, c, db), filters=user_filter))
-    application.add_handler(CommandHandler("retry", lambda u, c: retry_handle(u, c, db), filters=user_filter))
-    application.add_handler(CommandHandler("cancel", lambda u, c: cancel_handle(u, c, db), filters=user_filter))
+    application.add_handler(CommandHandler("start", with_request_context(start_handle, db), filters=user_filter))
+    application.add_handler(CommandHandler("help", with_request_context(help_handle, db), filters=user_filter))
+    application.add_handler(CommandHandler("help_group_chat", with_request_context(help_group_chat_handle, db), filters=user_filter))
+    application.add_handler(CommandHandler("new", with_request_context(new_dialog_handle, db), filters=user_filter))
+    application.add_handler(CommandHandler("retry", with_request_context(retry_handle, db), filters=user_filter))
+    application.add_handler(CommandHandler("cancel", with_request_context(cancel_handle, db), filters=user_filter))
 
     # Обработчики языков
-    application.add_handler(CommandHandler("lang", lambda u, c: language_handle(u, c, db), filters=user_filter))
-    application.add_handler(CallbackQueryHandler(lambda u, c: set_language_handle(u, c, db), pattern="^set_language"))
-    application.add_handler(CallbackQueryHandler(lambda u, c: language_info_callback_handle(u, c, db), pattern="^language_info"))
-    application.add_handler(CallbackQueryHandler(lambda u, c: back_to_language_callback_handle(u, c, db), pattern="^back_to_language_selection"))
+    application.add_handler(CommandHandler("lang", with_request_context(language_handle, db), filters=user_filter))
+    application.add_handler(CallbackQueryHandler(with_request_context(set_language_handle, db), pattern="^set_language"))
+    application.add_handler(CallbackQueryHandler(with_request_context(language_info_callback_handle, db), pattern="^language_info"))
+    application.add_handler(CallbackQueryHandler(with_request_context(back_to_language_callback_handle, db), pattern="^back_to_language_selection"))
 
     # Обработчики сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter, lambda u, c: message_handle(u, c, db)))
-    application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND & user_filter, lambda u, c: message_handle(u, c, db)))
-    application.add_handler(MessageHandler(filters.VIDEO & ~filters.COMMAND & user_filter, lambda u, c: unsupport_message_handle(u, c, db)))
-    application.add_handler(MessageHandler(filters.Document.ALL & ~filters.COMMAND & user_filter, lambda u, c: unsupport_message_handle(u, c, db)))
-    application.add_handler(MessageHandler(filters.VOICE & user_filter, lambda u, c: voice_message_handle(u, c, db)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter, with_request_context(message_handle, db, is_bot_mentioned)))
+    application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND & user_filter, with_request_context(message_handle, db, is_bot_mentioned)))
+    application.add_handler(MessageHandler(filters.VIDEO & ~filters.COMMAND & user_filter, with_request_context(unsupport_message_handle, db)))
+    application.add_handler(MessageHandler(filters.Document.ALL & ~filters.COMMAND & user_filter, with_request_context(unsupport_message_handle, db)))
+    application.add_handler(MessageHandler(filters.VOICE & user_filter, with_request_context(voice_message_handle, db, is_bot_mentioned)))
 
     # Обработчики режимов чата
-    application.add_handler(CommandHandler("mode", lambda u, c: show_chat_modes_handle(u, c, db), filters=user_filter))
-    application.add_handler(CallbackQueryHandler(lambda u, c: show_chat_modes_callback_handle(u, c, db), pattern="^show_chat_modes"))
-    application.add_handler(CallbackQueryHandler(lambda u, c: set_chat_mode_handle(u, c, db), pattern="^set_chat_mode"))
+    application.add_handler(CommandHandler("mode", with_request_context(show_chat_modes_handle, db), filters=user_filter))
+    application.add_handler(CallbackQueryHandler(with_request_context(show_chat_modes_callback_handle, db), pattern="^show_chat_modes"))
+    application.add_handler(CallbackQueryHandler(with_request_context(set_chat_mode_handle, db), pattern="^set_chat_mode"))
 
     # Обработчики настроек
-    application.add_handler(CommandHandler("settings", lambda u, c: settings_handle(u, c, db), filters=user_filter))
-    application.add_handler(CallbackQueryHandler(lambda u, c: set_settings_handle(u, c, db), pattern="^set_settings"))
+    application.add_handler(CommandHandler("settings", with_request_context(settings_handle, db), filters=user_filter))
+    application.add_handler(CallbackQueryHandler(with_request_context(set_settings_handle, db), pattern="^set_settings"))
 
     # Обработчики баланса
-    application.add_handler(CommandHandler("balance", lambda u, c: show_balance_handle(u, c, db), filters=user_filter))
-    application.add_handler(CallbackQueryHandler(lambda u, c: show_balance_handle(u, c, db), pattern="^refresh_balance"))
+    application.add_handler(CommandHandler("balance", with_request_context(show_balance_handle, db), filters=user_filter))
+    application.add_handler(CallbackQueryHandler(with_request_context(show_balance_handle, db), pattern="^refresh_balance"))
 
     # Обработчики Premium подписок
-    application.add_handler(CommandHandler("premium", lambda u, c: show_premium_plans_handle(u, c, db), filters=user_filter))
-    application.add_handler(CallbackQueryHandler(lambda u, c: show_premium_plans_handle(u, c, db), pattern="^show_premium_plans"))
-    application.add_handler(CallbackQueryHandler(lambda u, c: show_usage_stats_handle(u, c, db), pattern="^show_my_usage"))
-    application.add_handler(CallbackQueryHandler(lambda u, c: buy_premium_handle(u, c, db), pattern="^buy_premium"))
+    application.add_handler(CommandHandler("premium", with_request_context(show_premium_plans_handle, db), filters=user_filter))
+    application.add_handler(CallbackQueryHandler(with_request_context(show_premium_plans_handle, db), pattern="^show_premium_plans"))
+    application.add_handler(CallbackQueryHandler(with_request_context(show_usage_stats_handle, db), pattern="^show_my_usage"))
+    application.add_handler(CallbackQueryHandler(with_request_context(buy_premium_handle, db), pattern="^buy_premium"))
 
     # Обработчики платежей
-    application.add_handler(PreCheckoutQueryHandler(lambda u, c: pre_checkout_callback(u, c, db)))
-    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, lambda u, c: successful_payment_callback(u, c, db)))
+    application.add_handler(PreCheckoutQueryHandler(with_request_context(pre_checkout_callback, db)))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, with_request_context(successful_payment_callback, db)))
 
     # Обработчик ошибок
     application.add_error_handler(error_handle)
@@ -1,8 +1,10 @@
+import os
 import yaml
 import dotenv
 from pathlib import Path
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+# BOT_CONFIG_DIR - другой каталог с config.yml, config.env, chat_modes.yml и models.yml (например, в тестах)
+config_dir = Path(os.environ.get("BOT_CONFIG_DIR", Path(__file__).parent.parent.resolve() / "config"))
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
@@ -18,10 +20,51 @@ openai_api_base = config_yaml.get("openai_api_base", None)
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
 new_dialog_timeout = config_yaml["new_dialog_timeout"]
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
+openai_max_connections = config_yaml.get("openai_max_connections", 100)
+openai_keepalive_timeout = config_yaml.get("openai_keepalive_timeout", 60.0)
+openai_connect_timeout = config_yaml.get("openai_connect_timeout", 10.0)
+openai_request_timeout = config_yaml.get("openai_request_timeout", 60.0)
+enable_completion_cache = config_yaml.get("enable_completion_cache", False)
+completion_cache_size = config_yaml.get("completion_cache_size", 1000)
+completion_cache_ttl = config_yaml.get("completion_cache_ttl", 3600)
+openai_max_queue_wait = config_yaml.get("openai_max_queue_wait", 30.0)
+openai_max_retries = config_yaml.get("openai_max_retries", 3)
+openai_retry_base_delay = config_yaml.get("openai_retry_base_delay", 0.5)
+openai_retry_max_delay = config_yaml.get("openai_retry_max_delay", 8.0)
+openai_breaker_failure_threshold = config_yaml.get("openai_breaker_failure_threshold", 5)
+openai_breaker_reset_timeout = config_yaml.get("openai_breaker_reset_timeout", 30.0)
+router_window_seconds = config_yaml.get("router_window_seconds", 300)
+router_min_samples = config_yaml.get("router_min_samples", 10)
+router_max_error_rate = config_yaml.get("router_max_error_rate", 0.5)
+router_max_ttft = config_yaml.get("router_max_ttft", 10.0)
+router_max_latency = config_yaml.get("router_max_latency", 60.0)
+router_max_queue_depth = config_yaml.get("router_max_queue_depth", 20)
+enable_dialog_summarization = config_yaml.get("enable_dialog_summarization", False)
+dialog_summary_model = config_yaml.get("dialog_summary_model", "gpt-3.5-turbo")
+dialog_summary_threshold_tokens = config_yaml.get("dialog_summary_threshold_tokens", 3000)
+dialog_summary_keep_last_n = config_yaml.get("dialog_summary_keep_last_n", 4)
+dialog_summary_max_tokens = config_yaml.get("dialog_summary_max_tokens", 500)
+openai_stats_log_interval = config_yaml.get("openai_stats_log_interval", 300)
 return_n_generated_images = config_yaml.get("return_n_generated_images", 1)
 image_size = config_yaml.get("image_size", "512x512")
+vision_image_detail = config_yaml.get("vision_image_detail", "auto")
+vision_jpeg_quality = config_yaml.get("vision_jpeg_quality", 85)
+vision_image_max_bytes = config_yaml.get("vision_image_max_bytes", 500000)
+voice_chunk_seconds = config_yaml.get("voice_chunk_seconds", 60)
+voice_max_parallel_chunks = config_yaml.get("voice_max_parallel_chunks", 4)
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
-mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
+n_dialog_messages_in_context = config_yaml.get("n_dialog_messages_in_context", 200)
+storage_backend = config_yaml.get("storage_backend", "mongo")
+mongodb_uri = config_yaml.get(
+    "mongodb_uri",
+    f"mongodb://{config_env.get('MONGODB_HOST', 'mongo')}:{config_env.get('MONGODB_PORT', 27017)}"
+)
+mongodb_max_pool_size = config_yaml.get("mongodb_max_pool_size", 100)
+mongodb_min_pool_size = config_yaml.get("mongodb_min_pool_size", 0)
+mongodb_timeout_ms = config_yaml.get("mongodb_timeout_ms", 5000)
+subscription_cache_ttl = config_yaml.get("subscription_cache_ttl", 300)
+last_interaction_flush_interval = config_yaml.get("last_interaction_flush_interval", 10)
+daily_usage_retention_days = config_yaml.get("daily_usage_retention_days", 30)
 
 # Models configuration from env
 available_text_models = config_env.get('AVAILABLE_TEXT_MODELS', 'gpt-3.5-turbo').split(',')
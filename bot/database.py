@@ -1,22 +1,217 @@
 # database.py - С поддержкой групповых настроек
 from typing import Optional, Any
-import pymongo
+import asyncio
+import base64
+import hashlib
+import logging
+import motor.motor_asyncio
+from gridfs.errors import FileExists
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import WriteError
 import uuid
 from datetime import datetime, timedelta
 import config
+import memory_storage
+import request_context
+from request_context import RequestContext
+
+logger = logging.getLogger(__name__)
+
+# Индексы, которые создаются при старте: коллекция -> список IndexModel
+INDEXES = {
+    "subscriptions": [
+        # активная подписка пользователя: {user_id, status, expires_at}
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("expires_at", ASCENDING)], name="user_status_expires"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+    "dialog": [
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+    ],
+    "payments": [
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+    "daily_usage": [
+        # счетчики удаляются Mongo автоматически после expires_at
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Поля, которые не нужны при чтении документа пользователя (история старого формата)
+USER_PROJECTION = {"daily_usage": 0}
+
+# n_used_tokens старого формата - одно число (все токены gpt-3.5-turbo как выходные).
+# Pipeline-обновление переводит его в счетчики по моделям на сервере; применять с фильтром {"n_used_tokens": {"$type": "number"}}
+LEGACY_N_USED_TOKENS_UPDATE = [{"$set": {"n_used_tokens": {
+    "gpt-3_5-turbo": {"n_input_tokens": {"$literal": 0}, "n_output_tokens": "$n_used_tokens"}
+}}}]
 
 
 class Database:
     def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
+        self.is_embedded = config.storage_backend == "memory"
+
+        if self.is_embedded:
+            # встроенное хранилище в памяти процесса (без контейнера MongoDB)
+            self.client = memory_storage.MemoryClient()
+        elif config.storage_backend == "mongo":
+            # motor: асинхронный драйвер, все запросы выполняются без блокировки event loop
+            self.client = motor.motor_asyncio.AsyncIOMotorClient(
+                config.mongodb_uri,
+                maxPoolSize=config.mongodb_max_pool_size,
+                minPoolSize=config.mongodb_min_pool_size,
+                serverSelectionTimeoutMS=config.mongodb_timeout_ms,
+            )
+        else:
+            raise ValueError(f"Unknown storage backend: {config.storage_backend}")
+
         self.db = self.client["chatgpt_telegram_bot"]
 
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
+        if self.is_embedded:
+            self.image_bucket = memory_storage.MemoryGridFSBucket(self.db, bucket_name="images")
+        else:
+            self.image_bucket = motor.motor_asyncio.AsyncIOMotorGridFSBucket(self.db, bucket_name="images")
         self.group_collection = self.db["group"]  # Новая коллекция для групп
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        # кеш активных подписок: user_id -> (subscription или None, время до которого запись валидна)
+        self.subscription_cache = {}
+
+        # счетчики использования за сегодня: user_id -> {usage_type: amount}
+        self.daily_usage_collection = self.db["daily_usage"]
+        self.daily_usage_cache = {}
+        self.daily_usage_cache_date = None
+
+        # буфер last_interaction (write-behind): id -> datetime, сбрасывается в flush_last_interactions
+        self.pending_user_interactions = {}
+        self.pending_group_interactions = {}
+
+    async def ensure_indexes(self):
+        """Создать объявленные в INDEXES индексы (идемпотентно)"""
+        for collection_name, indexes in INDEXES.items():
+            await self.db[collection_name].create_indexes(indexes)
+
+    async def get_index_report(self) -> dict:
+        """Отчет по живым индексам коллекций (index_information) в сравнении с INDEXES:
+        отсутствующие, существующие с другими ключами и ни разу не использованные с запуска сервера"""
+        report = {"missing": [], "mismatched": [], "unused": []}
+        if self.is_embedded:
+            return report  # во встроенном хранилище индексов нет
+
+        for collection_name, indexes in INDEXES.items():
+            collection = self.db[collection_name]
+            existing = await collection.index_information()
+            stats = await collection.aggregate([{"$indexStats": {}}]).to_list(length=None)
+            accesses = {item["name"]: item["accesses"]["ops"] for item in stats}
+
+            for index in indexes:
+                name = index.document["name"]
+                if name not in existing:
+                    report["missing"].append(f"{collection_name}.{name}")
+                elif list(existing[name]["key"]) != list(index.document["key"].items()) or \
+                        existing[name].get("expireAfterSeconds") != index.document.get("expireAfterSeconds"):
+                    report["mismatched"].append(f"{collection_name}.{name}")
+                elif accesses.get(name, 0) == 0:
+                    report["unused"].append(f"{collection_name}.{name}")
+
+        return report
+
+    async def load_request_context(self, user_id: int, chat_id: int) -> RequestContext:
+        """Загрузить пользователя, группу и активную подписку одним параллельным запросом"""
+        queries = [
+            self.user_collection.find_one({"_id": user_id}, USER_PROJECTION),
+            self._get_active_subscription(user_id),
+            self._get_today_usage(user_id),
+        ]
+        if chat_id < 0:  # Группа
+            queries.append(self.db["groups"].find_one({"_id": chat_id}))
+
+        results = await asyncio.gather(*queries)
+        user_dict, subscription = results[0], results[1]
+        group_dict = results[3] if chat_id < 0 else None
+
+        # еще не сброшенные в базу значения last_interaction новее загруженных
+        if user_dict is not None and user_id in self.pending_user_interactions:
+            user_dict["last_interaction"] = self.pending_user_interactions[user_id]
+        if group_dict is not None and chat_id in self.pending_group_interactions:
+            group_dict["last_interaction"] = self.pending_group_interactions[chat_id]
+
+        return RequestContext(user_id, chat_id, user_dict, group_dict, subscription)
+
+    async def flush_request_context(self, request: Optional[RequestContext] = None):
+        """Записать накопленные изменения снапшота (один update_one на документ)"""
+        request = request or request_context.get_current()
+        if request is None:
+            return
+
+        writes = []
+        if request.user_updates:
+            writes.append(self.user_collection.update_one({"_id": request.user_id}, {"$set": request.user_updates}))
+            request.user_updates = {}
+        if request.group_updates:
+            writes.append(self.db["groups"].update_one({"_id": request.chat_id}, {"$set": request.group_updates}))
+            request.group_updates = {}
+
+        if writes:
+            await asyncio.gather(*writes)
+
+    def update_last_interaction(self, user_id: int):
+        """Запомнить время последнего взаимодействия пользователя (запись в базу - в flush_last_interactions)"""
+        now = datetime.now()
+        self.pending_user_interactions[user_id] = now
+
+        request = request_context.get_current()
+        if request is not None and request.has_user(user_id):
+            request.set_user_attribute("last_interaction", now, pending=False)
+
+    def update_group_last_interaction(self, group_id: int):
+        """Запомнить время последнего взаимодействия группы (запись в базу - в flush_last_interactions)"""
+        now = datetime.now()
+        self.pending_group_interactions[group_id] = now
+
+        request = request_context.get_current()
+        if request is not None and request.has_group(group_id):
+            request.set_group_attribute("last_interaction", now, pending=False)
+
+    async def flush_last_interactions(self):
+        """Записать накопленные last_interaction одним bulk_write на коллекцию"""
+        user_interactions, self.pending_user_interactions = self.pending_user_interactions, {}
+        group_interactions, self.pending_group_interactions = self.pending_group_interactions, {}
+
+        for collection, interactions, pending in (
+            (self.user_collection, user_interactions, self.pending_user_interactions),
+            (self.db["groups"], group_interactions, self.pending_group_interactions),
+        ):
+            if not interactions:
+                continue
+
+            try:
+                await collection.bulk_write([
+                    UpdateOne({"_id": _id}, {"$max": {"last_interaction": last_interaction}})
+                    for _id, last_interaction in interactions.items()
+                ], ordered=False)
+            except Exception:
+                # вернуть в буфер, чтобы записать при следующем сбросе
+                for _id, last_interaction in interactions.items():
+                    pending[_id] = max(last_interaction, pending.get(_id, last_interaction))
+                raise
+
+    async def run_last_interactions_flusher(self):
+        """Фоновая задача: периодический сброс буфера last_interaction"""
+        while True:
+            await asyncio.sleep(config.last_interaction_flush_interval)
+            try:
+                await self.flush_last_interactions()
+            except Exception as e:
+                logger.error(f"Failed to flush last_interaction updates: {e}")
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        request = request_context.get_current()
+        if request is not None and request.has_user(user_id):
+            return True
+
+        if await self.user_collection.count_documents({"_id": user_id}) > 0:
             return True
         else:
             if raise_exception:
@@ -24,9 +219,13 @@ class Database:
             else:
                 return False
 
-    def check_if_group_exists(self, group_id: int, raise_exception: bool = False):
+    async def check_if_group_exists(self, group_id: int, raise_exception: bool = False):
         """Проверить существование группы"""
-        if self.db["groups"].count_documents({"_id": group_id}) > 0:
+        request = request_context.get_current()
+        if request is not None and request.has_group(group_id):
+            return True
+
+        if await self.db["groups"].count_documents({"_id": group_id}) > 0:
             return True
         else:
             if raise_exception:
@@ -35,7 +234,7 @@ class Database:
                 return False
 
 
-    def add_new_group(self, group_id: int, group_title: str = "", admin_id: int = None):
+    async def add_new_group(self, group_id: int, group_title: str = "", admin_id: int = None):
         """Добавить новую группу с указанием администратора"""
         group_dict = {
             "_id": group_id,
@@ -48,28 +247,36 @@ class Database:
             "last_interaction": datetime.now()
         }
 
-        if not self.check_if_group_exists(group_id):
-            self.db["groups"].insert_one(group_dict)
+        if not await self.check_if_group_exists(group_id):
+            await self.db["groups"].insert_one(group_dict)
+
+            request = request_context.get_current()
+            if request is not None and request.chat_id == group_id:
+                request.group_dict = group_dict
 
-    def is_group_admin(self, group_id: int, user_id: int) -> bool:
+    async def is_group_admin(self, group_id: int, user_id: int) -> bool:
         """Проверить, является ли пользователь тем, кто добавил бота в группу"""
-        admin_id = self.get_group_admin_id(group_id)
+        admin_id = await self.get_group_admin_id(group_id)
         return admin_id == user_id
 
-    def get_group_admin_id(self, group_id: int) -> Optional[int]:
+    async def get_group_admin_id(self, group_id: int) -> Optional[int]:
         """Получить ID администратора группы (того, кто добавил бота)"""
-        return self.get_group_attribute(group_id, "admin_id")
+        return await self.get_group_attribute(group_id, "admin_id")
 
-    def set_group_admin_id(self, group_id: int, admin_id: int):
+    async def set_group_admin_id(self, group_id: int, admin_id: int):
         """Установить ID администратора группы"""
-        self.set_group_attribute(group_id, "admin_id", admin_id)
+        await self.set_group_attribute(group_id, "admin_id", admin_id)
 
-    def get_group_attribute(self, group_id: int, key: str):
+    async def get_group_attribute(self, group_id: int, key: str):
         """Получить атрибут группы"""
-        if not self.check_if_group_exists(group_id):
-            return None
+        request = request_context.get_current()
+        if request is not None and request.has_group(group_id):
+            group_dict = request.group_dict
+        else:
+            if not await self.check_if_group_exists(group_id):
+                return None
 
-        group_dict = self.db["groups"].find_one({"_id": group_id})
+            group_dict = await self.db["groups"].find_one({"_id": group_id})
 
         if key not in group_dict:
             # Значения по умолчанию
@@ -82,50 +289,56 @@ class Database:
 
         return group_dict[key]
 
-    def set_group_attribute(self, group_id: int, key: str, value: Any):
+    async def set_group_attribute(self, group_id: int, key: str, value: Any):
         """Установить атрибут группы"""
         # Создаем группу если не существует
-        if not self.check_if_group_exists(group_id):
-            self.add_new_group(group_id)
+        if not await self.check_if_group_exists(group_id):
+            await self.add_new_group(group_id)
+
+        request = request_context.get_current()
+        if request is not None and request.has_group(group_id):
+            request.set_group_attribute(key, value)
+            request.set_group_attribute("last_interaction", datetime.now())
+            return
 
-        self.db["groups"].update_one(
+        await self.db["groups"].update_one(
             {"_id": group_id},
             {"$set": {key: value, "last_interaction": datetime.now()}}
         )
 
-    def get_chat_mode(self, user_id: int, chat_id: int = None):
+    async def get_chat_mode(self, user_id: int, chat_id: int = None):
         """Получить режим чата в зависимости от контекста (группа или приватный чат)"""
         if chat_id and chat_id < 0:  # Групповой чат (отрицательный ID)
-            if self.check_if_group_exists(chat_id):
-                return self.get_group_attribute(chat_id, "current_chat_mode") or "assistant"
+            if await self.check_if_group_exists(chat_id):
+                return await self.get_group_attribute(chat_id, "current_chat_mode") or "assistant"
             else:
                 # Если группа не существует, создаем её с режимом по умолчанию
-                self.add_new_group(chat_id)
+                await self.add_new_group(chat_id)
                 return "assistant"
         else:
             # Приватный чат - используем настройки пользователя
-            return self.get_user_attribute(user_id, "current_chat_mode")
+            return await self.get_user_attribute(user_id, "current_chat_mode")
 
-    def set_chat_mode(self, user_id: int, chat_mode: str, chat_id: int = None):
+    async def set_chat_mode(self, user_id: int, chat_mode: str, chat_id: int = None):
         """Установить режим чата в зависимости от контекста"""
         if chat_id and chat_id < 0:  # Групповой чат
-            if not self.check_if_group_exists(chat_id):
-                self.add_new_group(chat_id)
-            self.set_group_attribute(chat_id, "current_chat_mode", chat_mode)
-            self.set_group_attribute(chat_id, "last_interaction", datetime.now())
+            if not await self.check_if_group_exists(chat_id):
+                await self.add_new_group(chat_id)
+            await self.set_group_attribute(chat_id, "current_chat_mode", chat_mode)
+            await self.set_group_attribute(chat_id, "last_interaction", datetime.now())
         else:
             # Приватный чат
-            self.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+            await self.set_user_attribute(user_id, "current_chat_mode", chat_mode)
 
-    def add_new_user(
+    def _new_user_dict(
         self,
         user_id: int,
         chat_id: int,
         username: str = "",
         first_name: str = "",
         last_name: str = "",
-    ):
-        user_dict = {
+    ) -> dict:
+        return {
             "_id": user_id,
             "chat_id": chat_id,
 
@@ -147,16 +360,113 @@ class Database:
             "n_transcribed_seconds": 0.0  # voice message transcription
         }
 
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
+    async def register_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ) -> dict:
+        """Зарегистрировать пользователя одним атомарным upsert и вернуть его документ.
+
+        Если пользователь уже есть в снапшоте текущего update, запросов к базе нет.
+        """
+        request = request_context.get_current()
+        if request is not None and request.has_user(user_id):
+            return request.user_dict
+
+        defaults = self._new_user_dict(user_id, chat_id, username, first_name, last_name)
+        del defaults["_id"]
 
-    def start_new_dialog(self, user_id: int, chat_id: int = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        user_dict = await self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$setOnInsert": defaults},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        if request is not None and request.user_id == user_id:
+            request.user_dict = user_dict
+
+        return user_dict
+
+    async def migrate_legacy_data(self):
+        """Одноразовая миграция документов старого формата (запускается в фоне при старте)"""
+        if self.is_embedded:
+            return  # встроенное хранилище всегда создается пустым
+        # back compatibility for n_used_tokens field: проверка формата и запись в одном обновлении на сервере,
+        # поэтому параллельный $inc из update_n_used_tokens не теряется
+        await self.user_collection.update_many({"n_used_tokens": {"$type": "number"}}, LEGACY_N_USED_TOKENS_UPDATE)
+
+        # ключи n_used_tokens с точками (gpt-3.5-turbo) -> ключи, адресуемые через $inc
+        has_dotted_keys = {"$gt": [{"$size": {"$filter": {
+            "input": {"$objectToArray": {"$ifNull": ["$n_used_tokens", {}]}},
+            "cond": {"$gte": [{"$indexOfBytes": ["$$this.k", "."]}, 0]}
+        }}}, 0]}
+
+        # запись только если счетчики не изменились с момента чтения; иначе документ перечитывается на следующем проходе
+        for _ in range(3):
+            requests = []
+            async for user_dict in self.user_collection.find({"$expr": has_dotted_keys}, {"n_used_tokens": 1}):
+                new_n_used_tokens = {}
+                for model, n_tokens in user_dict["n_used_tokens"].items():
+                    model_tokens = new_n_used_tokens.setdefault(
+                        self._n_used_tokens_key(model), {"n_input_tokens": 0, "n_output_tokens": 0}
+                    )
+                    model_tokens["n_input_tokens"] += n_tokens.get("n_input_tokens", 0)
+                    model_tokens["n_output_tokens"] += n_tokens.get("n_output_tokens", 0)
+                requests.append(UpdateOne(
+                    {"_id": user_dict["_id"], "n_used_tokens": user_dict["n_used_tokens"]},
+                    {"$set": {"n_used_tokens": new_n_used_tokens}}
+                ))
+
+            if not requests:
+                break
+            result = await self.user_collection.bulk_write(requests, ordered=False)
+            if result.modified_count == len(requests):
+                break
+
+        # missing fields
+        await self.user_collection.update_many({"current_model": None}, {"$set": {"current_model": config.default_model}})
+        await self.user_collection.update_many({"n_transcribed_seconds": None}, {"$set": {"n_transcribed_seconds": 0.0}})
+        await self.user_collection.update_many({"n_generated_images": None}, {"$set": {"n_generated_images": 0}})
+
+        # счетчики использования переехали из документа пользователя в коллекцию daily_usage
+        today = datetime.now().strftime("%Y-%m-%d")
+        requests = []
+        async for user_dict in self.user_collection.find({f"daily_usage.{today}": {"$exists": True}}, {f"daily_usage.{today}": 1}):
+            counters = user_dict["daily_usage"][today]
+            requests.append(UpdateOne(
+                {"_id": self._daily_usage_id(user_dict["_id"], today)},
+                {
+                    "$max": {f"counters.{usage_type}": amount for usage_type, amount in counters.items()},
+                    "$setOnInsert": {
+                        "user_id": user_dict["_id"],
+                        "date": today,
+                        "expires_at": datetime.strptime(today, "%Y-%m-%d") + timedelta(days=config.daily_usage_retention_days)
+                    }
+                },
+                upsert=True
+            ))
+
+        if requests:
+            await self.daily_usage_collection.bulk_write(requests, ordered=False)
+        await self.user_collection.update_many({"daily_usage": {"$exists": True}}, {"$unset": {"daily_usage": ""}})
+
+        # счетчик сообщений для диалогов, созданных до его появления
+        await self.dialog_collection.update_many(
+            {"n_messages": {"$exists": False}},
+            [{"$set": {"n_messages": {"$size": "$messages"}}}]
+        )
+
+    async def start_new_dialog(self, user_id: int, chat_id: int = None):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         dialog_id = str(uuid.uuid4())
 
         # Получаем режим чата в зависимости от контекста
-        chat_mode = self.get_chat_mode(user_id, chat_id)
+        chat_mode = await self.get_chat_mode(user_id, chat_id)
 
         dialog_dict = {
             "_id": dialog_id,
@@ -164,24 +474,35 @@ class Database:
             "chat_id": chat_id,  # Добавляем chat_id для связи с группой
             "chat_mode": chat_mode,
             "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
-            "messages": []
+            "model": await self.get_user_attribute(user_id, "current_model"),
+            "messages": [],
+            "n_messages": 0
         }
 
         # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        await self.dialog_collection.insert_one(dialog_dict)
 
         # update user's current dialog
-        self.user_collection.update_one(
+        await self.user_collection.update_one(
             {"_id": user_id},
             {"$set": {"current_dialog_id": dialog_id}}
         )
 
+        request = request_context.get_current()
+        if request is not None and request.has_user(user_id):
+            request.set_user_attribute("current_dialog_id", dialog_id, pending=False)
+
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+    async def get_user_attribute(self, user_id: int, key: str):
+        request = request_context.get_current()
+        if request is not None and request.has_user(user_id):
+            user_dict = request.user_dict
+        else:
+            await self.check_if_user_exists(user_id, raise_exception=True)
+            user_dict = await self.user_collection.find_one({"_id": user_id}, USER_PROJECTION)
+            if user_id in self.pending_user_interactions:
+                user_dict["last_interaction"] = self.pending_user_interactions[user_id]
 
         if key not in user_dict:
             # Для поля language возвращаем "en" по умолчанию
@@ -191,81 +512,311 @@ class Database:
 
         return user_dict[key]
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        request = request_context.get_current()
+        if request is not None and request.has_user(user_id):
+            request.set_user_attribute(key, value)
+            return
+
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        await self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+
+    @staticmethod
+    def _n_used_tokens_key(model: str) -> str:
+        # точка в имени модели (gpt-3.5-turbo) сломала бы путь для $inc
+        return model.replace(".", "_")
+
+    async def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
+        """Атомарно увеличить счетчики токенов модели (одна запись, без чтения)"""
+        key = f"n_used_tokens.{self._n_used_tokens_key(model)}"
+        update = {"$inc": {f"{key}.n_input_tokens": n_input_tokens, f"{key}.n_output_tokens": n_output_tokens}}
+        try:
+            await self.user_collection.update_one({"_id": user_id}, update)
+        except WriteError:
+            # документ старого формата, до которого еще не дошла фоновая миграция: переводим его и повторяем
+            await self.user_collection.update_one({"_id": user_id, "n_used_tokens": {"$type": "number"}}, LEGACY_N_USED_TOKENS_UPDATE)
+            await self.user_collection.update_one({"_id": user_id}, update)
+
+        request = request_context.get_current()
+        if request is not None and request.has_user(user_id):
+            if not isinstance(request.user_dict.get("n_used_tokens"), dict):
+                request.user_dict["n_used_tokens"] = {
+                    "gpt-3_5-turbo": {"n_input_tokens": 0, "n_output_tokens": request.user_dict.get("n_used_tokens") or 0}
+                }
+            model_tokens = request.user_dict["n_used_tokens"].setdefault(
+                self._n_used_tokens_key(model), {"n_input_tokens": 0, "n_output_tokens": 0}
+            )
+            model_tokens["n_input_tokens"] += n_input_tokens
+            model_tokens["n_output_tokens"] += n_output_tokens
+
+    async def get_dialog_context(self, user_id: int, dialog_id: Optional[str] = None, last_n: Optional[int] = None):
+        """Сообщения диалога, еще не вошедшие в резюме, текст резюме (None, если его нет)
+        и количество несжатых сообщений, не попавших в last_n последних.
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
+        summary.n_messages - сколько первых сообщений диалога сжато в summary.text.
+        """
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        projection = {"n_messages": 1, "summary": 1}
+        if last_n is None:
+            projection["messages"] = 1
+        elif last_n > 0:
+            projection["messages"] = {"$slice": -last_n}
+
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id}, projection)
+        dialog_messages = dialog_dict.get("messages", [])
+        summary = dialog_dict.get("summary")
+        n_summarized = summary["n_messages"] if summary is not None else 0
+
+        # индекс первого загруженного сообщения в полном диалоге
+        offset = dialog_dict.get("n_messages", len(dialog_messages)) - len(dialog_messages)
+        n_not_loaded = max(offset - n_summarized, 0)
+        n_loaded_summarized = min(max(n_summarized - offset, 0), len(dialog_messages))
+
+        return dialog_messages[n_loaded_summarized:], summary["text"] if summary is not None else None, n_not_loaded
+
+    async def get_unsummarized_dialog(self, user_id: int, dialog_id: str):
+        """Для фонового сжатия: несжатые сообщения, текст резюме и сколько сообщений в нем сжато.
+
+        Одно чтение, сжатая часть диалога с сервера не передается.
+        """
+        cursor = self.dialog_collection.aggregate([
+            {"$match": {"_id": dialog_id, "user_id": user_id}},
+            {"$project": {
+                "summary": 1,
+                "messages": {"$slice": [
+                    "$messages", {"$ifNull": ["$summary.n_messages", 0]}, {"$max": [{"$size": "$messages"}, 1]}
+                ]},
+            }},
+        ])
+        dialog_dicts = await cursor.to_list(length=1)
+        if not dialog_dicts:
+            return [], None, 0
+
+        summary = dialog_dicts[0].get("summary")
+        if summary is None:
+            return dialog_dicts[0]["messages"], None, 0
+        return dialog_dicts[0]["messages"], summary["text"], summary["n_messages"]
+
+    async def set_dialog_summary(self, user_id: int, dialog_id: str, summary_text: str, n_messages: int, previous_n_messages: int) -> bool:
+        """Сохранить резюме первых n_messages сообщений; не перезаписывает резюме, обновленное параллельно"""
+        if previous_n_messages:
+            query = {"_id": dialog_id, "user_id": user_id, "summary.n_messages": previous_n_messages}
         else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
+            query = {"_id": dialog_id, "user_id": user_id, "summary": {"$exists": False}}
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+        result = await self.dialog_collection.update_one(
+            query,
+            {"$set": {"summary": {"text": summary_text, "n_messages": n_messages}}}
+        )
+        return result.modified_count > 0
+
+    async def put_image(self, image_bytes: bytes) -> str:
+        """Сохранить изображение в GridFS по хешу содержимого; одинаковые фото хранятся один раз"""
+        image_id = hashlib.sha256(image_bytes).hexdigest()
+
+        if await self.db["images.files"].count_documents({"_id": image_id}, limit=1) == 0:
+            try:
+                await self.image_bucket.upload_from_stream_with_id(image_id, f"{image_id}.jpg", image_bytes)
+            except FileExists:  # параллельно загрузили то же самое фото
+                pass
+
+        return image_id
+
+    async def get_image(self, image_id: str) -> bytes:
+        stream = await self.image_bucket.open_download_stream(image_id)
+        return await stream.read()
+
+    async def load_dialog_images(self, dialog_messages: list) -> list:
+        """Подставить base64 вместо ссылок {"type": "image", "image_id": ...} (только в памяти, для запроса к модели)"""
+        image_ids = {
+            part["image_id"]
+            for dialog_message in dialog_messages if isinstance(dialog_message["user"], list)
+            for part in dialog_message["user"] if "image_id" in part
+        }
+        if not image_ids:
+            return dialog_messages
+
+        # все изображения диалога загружаются из GridFS параллельно, одинаковые - один раз
+        image_ids = list(image_ids)
+        images = dict(zip(image_ids, await asyncio.gather(*(self.get_image(image_id) for image_id in image_ids))))
+
+        loaded_messages = []
+        for dialog_message in dialog_messages:
+            if isinstance(dialog_message["user"], list) and any("image_id" in part for part in dialog_message["user"]):
+                user_content = []
+                for part in dialog_message["user"]:
+                    if "image_id" in part:
+                        image = base64.b64encode(images[part["image_id"]]).decode("utf-8")
+                        part = {"type": "image", "image": image, "detail": part.get("detail", "high")}
+                    user_content.append(part)
+                dialog_message = {**dialog_message, "user": user_content}
+
+            loaded_messages.append(dialog_message)
+
+        return loaded_messages
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def get_dialog_message_count(self, user_id: int, dialog_id: Optional[str] = None) -> int:
+        """Количество сообщений в диалоге без загрузки самих сообщений"""
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
-        return dialog_dict["messages"]
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id}, {"n_messages": 1})
+        if dialog_dict is None:
+            return 0
+
+        return dialog_dict.get("n_messages", 0)
+
+    async def save_dialog_token_counts(self, user_id: int, dialog_messages: list, indices: list, encoding_name: str, dialog_id: Optional[str] = None):
+        """Ленивый backfill: дописать n_tokens.<encoding_name> в уже сохраненные сообщения.
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        dialog_messages - хвост диалога из get_dialog_context(last_n=...), indices - позиции в нем.
+        Каждое сообщение дополнительно сверяется по date, чтобы не записать счетчик в чужое сообщение.
+        """
+        if not indices:
+            return
 
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        n_messages = await self.get_dialog_message_count(user_id, dialog_id=dialog_id)
+        offset = n_messages - len(dialog_messages)
+        if offset < 0:
+            return
+
+        await self.dialog_collection.bulk_write([
+            UpdateOne(
+                {"_id": dialog_id, "user_id": user_id, f"messages.{offset + i}.date": dialog_messages[i]["date"]},
+                {"$set": {f"messages.{offset + i}.n_tokens.{encoding_name}": dialog_messages[i]["n_tokens"][encoding_name]}}
+            )
+            for i in indices
+        ], ordered=False)
 
-        self.dialog_collection.update_one(
+    async def append_dialog_message(self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        """Атомарно добавить одно сообщение в конец диалога (без перезаписи всей истории)"""
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        await self.dialog_collection.update_one(
             {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"messages": dialog_messages}}
+            {"$push": {"messages": dialog_message}, "$inc": {"n_messages": 1}}
         )
 
+    async def pop_last_dialog_message(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        """Атомарно удалить последнее сообщение диалога и вернуть его (None если диалог пуст)"""
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = await self.dialog_collection.find_one_and_update(
+            {"_id": dialog_id, "user_id": user_id, "messages.0": {"$exists": True}},
+            {"$pop": {"messages": 1}, "$inc": {"n_messages": -1}},
+            projection={"messages": {"$slice": -1}},
+            return_document=ReturnDocument.BEFORE
+        )
+
+        if dialog_dict is None:
+            return None
+
+        return dialog_dict["messages"][0]
+
     # ========================
     # МЕТОДЫ ДЛЯ ПОДПИСОК
     # ========================
 
-    def get_user_subscription_status(self, user_id: int):
+    async def get_user_subscription_status(self, user_id: int):
         """Получить статус подписки пользователя"""
-        subscription = self.db["subscriptions"].find_one({
+        request = request_context.get_current()
+        if request is not None and request.user_id == user_id:
+            return request.is_premium()
+
+        subscription = await self._get_active_subscription(user_id)
+        return subscription is not None
+
+    async def _get_active_subscription(self, user_id: int) -> Optional[dict]:
+        """Активная подписка из кеша; запрос к базе только при промахе или истечении записи"""
+        now = datetime.now()
+
+        cached = self.subscription_cache.get(user_id)
+        if cached is not None and now < cached[1]:
+            return cached[0]
+
+        subscription = await self.db["subscriptions"].find_one({
             "user_id": user_id,
             "status": "active",
-            "expires_at": {"$gt": datetime.now()}
+            "expires_at": {"$gt": now}
         })
+        self._cache_subscription(user_id, subscription)
 
-        return subscription is not None
+        return subscription
 
-    def add_daily_usage(self, user_id: int, usage_type: str, amount: int = 1):
-        """Добавить использование за день"""
-        today = datetime.now().strftime("%Y-%m-%d")
+    def _cache_subscription(self, user_id: int, subscription: Optional[dict]):
+        if subscription is not None:
+            # премиум не меняется до expires_at (кроме покупки/отмены, которые сбрасывают кеш)
+            cache_until = subscription["expires_at"]
+        else:
+            cache_until = datetime.now() + timedelta(seconds=config.subscription_cache_ttl)
 
-        key = f"daily_usage.{today}.{usage_type}"
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$inc": {key: amount}},
-            upsert=True
-        )
+        self.subscription_cache[user_id] = (subscription, cache_until)
 
-    def get_daily_usage(self, user_id: int, usage_type: str) -> int:
-        """Получить использование за сегодня"""
+    def invalidate_subscription_cache(self, user_id: int):
+        self.subscription_cache.pop(user_id, None)
+
+    def _daily_usage_id(self, user_id: int, date: str) -> str:
+        return f"{user_id}:{date}"
+
+    def _today_usage_cache(self) -> dict:
+        """Кеш счетчиков за сегодня (сбрасывается при смене дня)"""
         today = datetime.now().strftime("%Y-%m-%d")
+        if self.daily_usage_cache_date != today:
+            self.daily_usage_cache = {}
+            self.daily_usage_cache_date = today
 
-        user = self.user_collection.find_one({"_id": user_id})
-        if not user:
-            return 0
+        return self.daily_usage_cache
+
+    async def _get_today_usage(self, user_id: int) -> dict:
+        cache = self._today_usage_cache()
+        if user_id not in cache:
+            usage = await self.daily_usage_collection.find_one(
+                {"_id": self._daily_usage_id(user_id, self.daily_usage_cache_date)},
+                {"_id": 0, "counters": 1}
+            )
+            cache[user_id] = usage["counters"] if usage else {}
 
-        daily_usage = user.get("daily_usage", {})
-        return daily_usage.get(today, {}).get(usage_type, 0)
+        return cache[user_id]
 
-    def create_subscription(self, user_id: int, plan: str, duration_days: int):
+    async def add_daily_usage(self, user_id: int, usage_type: str, amount: int = 1):
+        """Добавить использование за день"""
+        cache = self._today_usage_cache()
+        today = self.daily_usage_cache_date
+        expires_at = datetime.strptime(today, "%Y-%m-%d") + timedelta(days=config.daily_usage_retention_days)
+
+        usage = await self.daily_usage_collection.find_one_and_update(
+            {"_id": self._daily_usage_id(user_id, today)},
+            {
+                "$inc": {f"counters.{usage_type}": amount},
+                "$setOnInsert": {"user_id": user_id, "date": today, "expires_at": expires_at}
+            },
+            projection={"_id": 0, "counters": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        cache[user_id] = usage["counters"]
+
+    async def get_daily_usage(self, user_id: int, usage_type: str) -> int:
+        """Получить использование за сегодня"""
+        usage = await self._get_today_usage(user_id)
+        return usage.get(usage_type, 0)
+
+    async def create_subscription(self, user_id: int, plan: str, duration_days: int, payment_id: str = "test_payment"):
         """Создать новую подписку"""
         subscription_id = str(uuid.uuid4())
         expires_at = datetime.now() + timedelta(days=duration_days)
@@ -277,13 +828,19 @@ class Database:
             "status": "active",
             "created_at": datetime.now(),
             "expires_at": expires_at,
-            "payment_id": "test_payment"
+            "payment_id": payment_id
         }
 
-        self.db["subscriptions"].insert_one(subscription)
+        await self.db["subscriptions"].insert_one(subscription)
+        self._cache_subscription(user_id, subscription)
+
+        request = request_context.get_current()
+        if request is not None and request.user_id == user_id:
+            request.subscription = subscription
+
         return subscription_id
 
-    def record_payment(self, user_id: int, amount: float, currency: str, subscription_id: str):
+    async def record_payment(self, user_id: int, amount: float, currency: str, subscription_id: str, telegram_payment_id: str = "test_charge_id"):
         """Записать платеж"""
         payment_id = str(uuid.uuid4())
 
@@ -293,24 +850,24 @@ class Database:
             "amount": amount,
             "currency": currency,
             "subscription_id": subscription_id,
-            "telegram_payment_id": "test_charge_id",
+            "telegram_payment_id": telegram_payment_id,
             "created_at": datetime.now()
         }
 
-        self.db["payments"].insert_one(payment)
+        await self.db["payments"].insert_one(payment)
         return payment_id
 
-    def get_user_subscription_info(self, user_id: int):
+    async def get_user_subscription_info(self, user_id: int):
         """Получить информацию о подписке пользователя"""
-        return self.db["subscriptions"].find_one({
-            "user_id": user_id,
-            "status": "active",
-            "expires_at": {"$gt": datetime.now()}
-        })
+        request = request_context.get_current()
+        if request is not None and request.user_id == user_id:
+            return request.subscription if request.is_premium() else None
 
-    def cancel_subscription(self, user_id: int):
+        return await self._get_active_subscription(user_id)
+
+    async def cancel_subscription(self, user_id: int):
         """Отменить подписку"""
-        self.db["subscriptions"].update_one(
+        await self.db["subscriptions"].update_one(
             {
                 "user_id": user_id,
                 "status": "active"
@@ -322,13 +879,18 @@ class Database:
                 }
             }
         )
+        self.invalidate_subscription_cache(user_id)
+
+        request = request_context.get_current()
+        if request is not None and request.user_id == user_id:
+            request.subscription = None
 
-    def get_subscription_stats(self):
+    async def get_subscription_stats(self):
         """Получить статистику по подпискам (для админа)"""
-        total_subscriptions = self.db["subscriptions"].count_documents({"status": "active"})
-        total_revenue = list(self.db["payments"].aggregate([
+        total_subscriptions = await self.db["subscriptions"].count_documents({"status": "active"})
+        total_revenue = await self.db["payments"].aggregate([
             {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-        ]))
+        ]).to_list(length=None)
 
         return {
             "active_subscriptions": total_subscriptions,
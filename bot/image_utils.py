@@ -0,0 +1,78 @@
+# image_utils.py - Подготовка фото для vision-моделей: выбор размера из Telegram, уменьшение и перекодирование в JPEG
+import asyncio
+import re
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+import config
+
+# в detail: low модель видит изображение 512x512
+LOW_DETAIL_MAX_SIDE = 512
+# в detail: high OpenAI вписывает изображение в 2048x2048, затем уменьшает короткую сторону до 768
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+# слова подписи, которые просят прочитать текст или разглядеть мелкие детали - нужен detail: high.
+# Английские слова сравниваются целиком, русские - по основе (начало слова), чтобы покрыть падежные формы
+HIGH_DETAIL_WORDS = {
+    "text", "texts", "read", "reading", "ocr", "detail", "details", "detailed", "small", "tiny",
+    "document", "documents", "receipt", "receipts", "table", "tables", "chart", "charts", "diagram", "diagrams",
+    "code", "screenshot", "screenshots", "handwriting", "handwritten", "formula", "formulas", "translate", "transcribe",
+}
+HIGH_DETAIL_STEMS = (
+    "текст", "прочита", "прочти", "прочесть", "распозна", "детал", "мелк", "документ", "квитанц", "таблиц",
+    "график", "диаграм", "код", "скриншот", "почерк", "формул", "перевед", "перевод",
+)
+
+
+def choose_image_detail(caption: str) -> str:
+    """detail для OpenAI: из конфига или, в режиме auto, по словам подписи к фото"""
+    if config.vision_image_detail in ("low", "high"):
+        return config.vision_image_detail
+
+    words = re.findall(r"\w+", (caption or "").casefold().replace("ё", "е"))
+    for word in words:
+        if word in HIGH_DETAIL_WORDS or word.startswith(HIGH_DETAIL_STEMS):
+            return "high"
+    return "low"
+
+
+def pick_photo_size(photo_sizes, detail: str):
+    """Наименьший из размеров Telegram (отсортированы по возрастанию), которого хватает для detail"""
+    for photo_size in photo_sizes:
+        short_side, long_side = sorted((photo_size.width, photo_size.height))
+        if detail == "low" and long_side >= LOW_DETAIL_MAX_SIDE:
+            return photo_size
+        if detail == "high" and (short_side >= HIGH_DETAIL_SHORT_SIDE or long_side >= HIGH_DETAIL_MAX_SIDE):
+            return photo_size
+
+    return photo_sizes[-1]
+
+
+def _prepare_image(image_bytes: bytes, detail: str) -> bytes:
+    image = Image.open(BytesIO(image_bytes))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+
+    # больше, чем OpenAI все равно оставит от изображения, не отправляем
+    width, height = image.size
+    if detail == "low":
+        scale = LOW_DETAIL_MAX_SIDE / max(width, height)
+    else:
+        scale = min(HIGH_DETAIL_MAX_SIDE / max(width, height), HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    if scale < 1:
+        image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+    quality = config.vision_jpeg_quality
+    while True:
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        if output.tell() <= config.vision_image_max_bytes or quality <= 40:
+            return output.getvalue()
+        quality -= 15
+
+
+async def prepare_image(image_bytes: bytes, detail: str) -> bytes:
+    """Уменьшить и перекодировать фото в JPEG в пуле потоков, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _prepare_image, image_bytes, detail)
@@ -2,7 +2,6 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
 from telegram.ext import CallbackContext
 from telegram.constants import ParseMode
-from datetime import datetime
 from utils import register_user_if_not_exists, check_group_admin_rights, send_admin_rights_error
 from localization import t, TEXTS
 
@@ -23,17 +22,17 @@ async def language_handle(update: Update, context: CallbackContext, db):
             await send_admin_rights_error(update, context, db)
             return
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
-    text = t(user_id, "select_language", chat_id=chat_id)
+    text = await t(user_id, "select_language", chat_id=chat_id)
 
     keyboard = []
 
     # Получаем текущий язык (группы или пользователя)
     if chat_id < 0:  # Группа
-        current_lang = db.get_group_attribute(chat_id, "language") or "en"
+        current_lang = await db.get_group_attribute(chat_id, "language") or "en"
     else:  # Личный чат
-        current_lang = db.get_user_attribute(user_id, "language") or "en"
+        current_lang = await db.get_user_attribute(user_id, "language") or "en"
 
     # Создаем кнопки для языков
     languages = [
@@ -50,7 +49,7 @@ async def language_handle(update: Update, context: CallbackContext, db):
         ])
 
     # Добавляем информационную кнопку
-    info_text = t(user_id, "language_info_button", chat_id=chat_id)
+    info_text = await t(user_id, "language_info_button", chat_id=chat_id)
     keyboard.append([InlineKeyboardButton(info_text, callback_data="language_info")])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -64,10 +63,10 @@ async def show_language_info(update: Update, context: CallbackContext, db):
     user_id = query.from_user.id
     chat_id = query.message.chat.id
 
-    info_text = t(user_id, "language_info_text", chat_id=chat_id)
+    info_text = await t(user_id, "language_info_text", chat_id=chat_id)
 
     # Добавляем кнопку "Назад"
-    back_text = t(user_id, "back_to_language", chat_id=chat_id)
+    back_text = await t(user_id, "back_to_language", chat_id=chat_id)
     keyboard = [[InlineKeyboardButton(back_text, callback_data="back_to_language_selection")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -82,15 +81,15 @@ async def back_to_language_selection(update: Update, context: CallbackContext, d
     chat_id = query.message.chat.id
 
     # Повторно показываем меню выбора языка
-    text = t(user_id, "select_language", chat_id=chat_id)
+    text = await t(user_id, "select_language", chat_id=chat_id)
 
     keyboard = []
 
     # Получаем текущий язык (группы или пользователя)
     if chat_id < 0:  # Группа
-        current_lang = db.get_group_attribute(chat_id, "language") or "en"
+        current_lang = await db.get_group_attribute(chat_id, "language") or "en"
     else:  # Личный чат
-        current_lang = db.get_user_attribute(user_id, "language") or "en"
+        current_lang = await db.get_user_attribute(user_id, "language") or "en"
 
     # Создаем кнопки для языков
     languages = [
@@ -107,7 +106,7 @@ async def back_to_language_selection(update: Update, context: CallbackContext, d
         ])
 
     # Добавляем информационную кнопку
-    info_text = t(user_id, "how_language_works", chat_id=chat_id)
+    info_text = await t(user_id, "how_language_works", chat_id=chat_id)
     keyboard.append([InlineKeyboardButton(info_text, callback_data="language_info")])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -128,7 +127,7 @@ async def set_language_handle(update: Update, context: CallbackContext, db):
     # Проверяем права для групп - только тот, кто добавил бота
     if chat_id < 0:  # Группа
         if not await check_group_admin_rights(update, context, db):
-            await query.answer(t(user_id, "group_admin_only", chat_id=chat_id))
+            await query.answer(await t(user_id, "group_admin_only", chat_id=chat_id))
             return
 
     await query.answer()
@@ -137,12 +136,12 @@ async def set_language_handle(update: Update, context: CallbackContext, db):
 
     # Определяем старый язык и устанавливаем новый
     if chat_id < 0:  # Группа
-        old_language = db.get_group_attribute(chat_id, "language")
-        db.set_group_attribute(chat_id, "language", language)
+        old_language = await db.get_group_attribute(chat_id, "language")
+        await db.set_group_attribute(chat_id, "language", language)
     else:  # Личный чат
-        old_language = db.get_user_attribute(user_id, "language")
-        db.set_user_attribute(user_id, "language", language)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        old_language = await db.get_user_attribute(user_id, "language")
+        await db.set_user_attribute(user_id, "language", language)
+        db.update_last_interaction(user_id)
 
         # Обновляем команды для пользователя
         await update_user_commands(context, user_id, language)
@@ -150,11 +149,11 @@ async def set_language_handle(update: Update, context: CallbackContext, db):
     # Если это первый выбор языка для личного чата
     if chat_id > 0 and old_language is None:
         # Начинаем новый диалог для применения языковых изменений
-        db.start_new_dialog(user_id)
+        await db.start_new_dialog(user_id)
 
         # Показываем приветствие на выбранном языке
-        reply_text = t(user_id, "start_greeting", chat_id=chat_id)
-        reply_text += t(user_id, "help_message", chat_id=chat_id)
+        reply_text = await t(user_id, "start_greeting", chat_id=chat_id)
+        reply_text += await t(user_id, "help_message", chat_id=chat_id)
 
         await query.edit_message_text(reply_text, parse_mode=ParseMode.HTML)
 
@@ -166,22 +165,22 @@ async def set_language_handle(update: Update, context: CallbackContext, db):
     if old_language == language:
         # Язык не изменился, показываем текущий статус
         if chat_id < 0:  # Группа
-            status_text = t(user_id, "group_language_already_set", chat_id=chat_id)
+            status_text = await t(user_id, "group_language_already_set", chat_id=chat_id)
         else:  # Личный чат
-            status_text = t(user_id, "language_already_set", chat_id=chat_id)
+            status_text = await t(user_id, "language_already_set", chat_id=chat_id)
 
         await query.edit_message_text(status_text, parse_mode=ParseMode.HTML)
         return
 
     # Язык изменился
     if chat_id > 0:  # Личный чат - начинаем новый диалог
-        db.start_new_dialog(user_id)
+        await db.start_new_dialog(user_id)
 
     # Отправляем уведомление на новом языке
     if chat_id < 0:  # Группа
-        confirmation_text = t(user_id, "group_language_changed", chat_id=chat_id)
+        confirmation_text = await t(user_id, "group_language_changed", chat_id=chat_id)
     else:  # Личный чат
-        confirmation_text = t(user_id, "language_change_notification", chat_id=chat_id)
+        confirmation_text = await t(user_id, "language_change_notification", chat_id=chat_id)
 
     await query.edit_message_text(confirmation_text, parse_mode=ParseMode.HTML)
 
@@ -203,7 +202,7 @@ async def show_chat_modes_handle_from_callback(query, context: CallbackContext,
 
     # Используем ту же логику, что и в basic_handlers.py
     from basic_handlers import get_chat_mode_menu
-    text, reply_markup = get_chat_mode_menu(0, user_id, chat_id=chat_id, db=db)
+    text, reply_markup = await get_chat_mode_menu(0, user_id, chat_id=chat_id, db=db)
 
     # Отправляем новое сообщение вместо редактирования
     await context.bot.send_message(
@@ -67,10 +67,14 @@ For example: "{bot_username} write a poem about Telegram" """,
         "new_dialog_started": "Starting new dialog ✅",
         "dialog_timeout": "Starting new dialog due to timeout (<b>{mode_name}</b> mode) ✅",
         "message_removed": "✍️ <i>Note:</i> Your current dialog is too long, so your <b>first message</b> was removed from the context.\n Send /new command to start new dialog",
+        "openai_unavailable": "⏳ <b>The model is overloaded right now.</b> Please, try again in a minute.",
+        "model_fallback_used": "ℹ️ <i>{model} is unavailable right now, so this answer was given by <b>{fallback_model}</b>.</i>",
         "messages_removed": "✍️ <i>Note:</i> Your current dialog is too long, so <b>{count} first messages</b> were removed from the context.\n Send /new command to start new dialog",
         "editing_not_supported": "🥲 Unfortunately, message <b>editing</b> is not supported",
         "unsupported_files": "I don't know how to read files or videos. Send the picture in normal mode (Quick Mode).",
         "voice_transcription": "🎤: <i>{text}</i>",
+        "voice_transcription_progress": "🎤 <i>Transcribing... {n_done}/{n_total}</i>",
+        "voice_transcription_failed_chunks": "⚠️ <i>Could not transcribe part {chunks} of {n_total}, the text above is incomplete.</i>",
         "canceled": "✅ Canceled",
 
         # Режимы чата
@@ -206,10 +210,14 @@ For example: "{bot_username} write a poem about Telegram" """,
         "new_dialog_started": "Начинаем новый диалог ✅",
         "dialog_timeout": "Начинаем новый диалог из-за таймаута (режим <b>{mode_name}</b>) ✅",
         "message_removed": "✍️ <i>Примечание:</i> Ваш текущий диалог слишком длинный, поэтому ваше <b>первое сообщение</b> было удалено из контекста.\n Отправьте команду /new, чтобы начать новый диалог",
+        "openai_unavailable": "⏳ <b>Модель сейчас перегружена.</b> Пожалуйста, попробуйте еще раз через минуту.",
+        "model_fallback_used": "ℹ️ <i>Модель {model} сейчас недоступна, поэтому ответила <b>{fallback_model}</b>.</i>",
         "messages_removed": "✍️ <i>Примечание:</i> Ваш текущий диалог слишком длинный, поэтому <b>{count} первых сообщений</b> были удалены из контекста.\n Отправьте команду /new, чтобы начать новый диалог",
         "editing_not_supported": "🥲 К сожалению, <b>редактирование</b> сообщений не поддерживается",
         "unsupported_files": "Я не умею читать файлы или видео. Отправьте картинку в обычном режиме (Быстрый режим).",
         "voice_transcription": "🎤: <i>{text}</i>",
+        "voice_transcription_progress": "🎤 <i>Распознаю... {n_done}/{n_total}</i>",
+        "voice_transcription_failed_chunks": "⚠️ <i>Не удалось распознать часть {chunks} из {n_total}, текст выше неполный.</i>",
         "canceled": "✅ Отменено",
 
         # Режимы чата
@@ -287,27 +295,27 @@ class Localization:
         self.db = db
         self.default_language = "en"
 
-    def get_user_language(self, user_id: int, chat_id: int = None) -> str:
+    async def get_user_language(self, user_id: int, chat_id: int = None) -> str:
         """Получить язык пользователя или группы"""
         try:
             # Если указан chat_id и это группа
             if chat_id and chat_id < 0:
-                lang = self.db.get_group_attribute(chat_id, "language")
+                lang = await self.db.get_group_attribute(chat_id, "language")
             else:
-                lang = self.db.get_user_attribute(user_id, "language")
+                lang = await self.db.get_user_attribute(user_id, "language")
 
             return lang if lang in TEXTS else self.default_language
         except:
             return self.default_language
 
-    def set_user_language(self, user_id: int, language: str):
+    async def set_user_language(self, user_id: int, language: str):
         """Установить язык пользователя"""
         if language in TEXTS:
-            self.db.set_user_attribute(user_id, "language", language)
+            await self.db.set_user_attribute(user_id, "language", language)
 
-    def get_text(self, user_id: int, key: str, chat_id: int = None, **kwargs) -> str:
+    async def get_text(self, user_id: int, key: str, chat_id: int = None, **kwargs) -> str:
         """Получить локализованный текст с поддержкой групп"""
-        language = self.get_user_language(user_id, chat_id)
+        language = await self.get_user_language(user_id, chat_id)
 
         try:
             text = TEXTS[language][key]
@@ -342,8 +350,8 @@ def init_localization(db):
     return localization
 
 
-def t(user_id: int, key: str, chat_id: int = None, **kwargs) -> str:
+async def t(user_id: int, key: str, chat_id: int = None, **kwargs) -> str:
     """Быстрая функция для получения текста с поддержкой групп"""
     if localization is None:
         return f"[Localization not initialized: {key}]"
-    return localization.get_text(user_id, key, chat_id, **kwargs)
+    return await localization.get_text(user_id, key, chat_id, **kwargs)
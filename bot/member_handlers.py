@@ -38,11 +38,11 @@ async def my_chat_member_handler(update: Update, context: CallbackContext, db):
         logger.info(f"Bot added to group {group_id} by user {admin_id}")
 
         # Добавляем группу в базу данных
-        if not db.check_if_group_exists(group_id):
-            db.add_new_group(group_id, group_title, admin_id=admin_id)
+        if not await db.check_if_group_exists(group_id):
+            await db.add_new_group(group_id, group_title, admin_id=admin_id)
         else:
             # Если группа уже существует, обновляем администратора
-            db.set_group_admin_id(group_id, admin_id)
+            await db.set_group_admin_id(group_id, admin_id)
 
         # Отправляем приветственное сообщение
         try:
@@ -64,7 +64,7 @@ async def my_chat_member_handler(update: Update, context: CallbackContext, db):
         logger.info(f"Bot removed from group {chat.id}")
 
         # Можно добавить логику очистки данных группы или пометки как неактивной
-        # db.set_group_attribute(chat.id, "active", False)
+        # await db.set_group_attribute(chat.id, "active", False)
 
 async def chat_member_handler(update: Update, context: CallbackContext, db):
     """Обработчик изменений статуса других участников группы"""
@@ -0,0 +1,390 @@
+# memory_storage.py - Встроенное хранилище в памяти с интерфейсом подмножества motor
+# Используется вместо MongoDB при storage_backend: memory (небольшие установки, бенчмарки, тесты).
+# Поддерживаются только те операции и операторы, которые использует database.Database.
+import copy
+from datetime import datetime
+from typing import Any, Optional
+
+from gridfs.errors import FileExists, NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+
+class UnsupportedQueryError(ValueError):
+    """Оператор или стадия запроса, которых нет во встроенном хранилище"""
+
+
+def _get_path(document: dict, path: str) -> Any:
+    value = document
+    for key in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(key, _MISSING)
+        elif isinstance(value, list) and key.isdigit():
+            value = value[int(key)] if int(key) < len(value) else _MISSING
+        else:
+            return _MISSING
+
+        if value is _MISSING:
+            return _MISSING
+
+    return value
+
+
+def _set_path(document: dict, path: str, value: Any):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document[int(key)] if isinstance(document, list) else document.setdefault(key, {})
+
+    if isinstance(document, list):
+        document[int(keys[-1])] = value
+    else:
+        document[keys[-1]] = value
+
+
+def _unset_path(document: dict, path: str):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document.get(key)
+        if not isinstance(document, dict):
+            return
+    document.pop(keys[-1], None)
+
+
+def _match_condition(value: Any, condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$exists":
+                if (value is not _MISSING) != bool(operand):
+                    return False
+            elif operator == "$type":
+                type_checks = {
+                    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+                    "object": lambda v: isinstance(v, dict),
+                    "array": lambda v: isinstance(v, list),
+                    "string": lambda v: isinstance(v, str),
+                }
+                if value is _MISSING or not type_checks[operand](value):
+                    return False
+            elif operator == "$in":
+                if (None if value is _MISSING else value) not in operand:
+                    return False
+            elif operator == "$ne":
+                if (None if value is _MISSING else value) == operand:
+                    return False
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                if value is _MISSING or value is None:
+                    return False
+                compare = {
+                    "$gt": lambda a, b: a > b,
+                    "$gte": lambda a, b: a >= b,
+                    "$lt": lambda a, b: a < b,
+                    "$lte": lambda a, b: a <= b,
+                }[operator]
+                if not compare(value, operand):
+                    return False
+            else:
+                raise UnsupportedQueryError(f"Query operator {operator} is not supported by memory storage")
+        return True
+
+    if condition is None:
+        return value is _MISSING or value is None
+
+    return value == condition
+
+
+def _matches(document: dict, query: dict) -> bool:
+    for path, condition in query.items():
+        if path.startswith("$"):
+            raise UnsupportedQueryError(f"Query operator {path} is not supported by memory storage")
+        if not _match_condition(_get_path(document, path), condition):
+            return False
+    return True
+
+
+def _project(document: dict, projection: Optional[dict]) -> dict:
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+
+    slices = {key: value["$slice"] for key, value in projection.items() if isinstance(value, dict)}
+    flags = {key: value for key, value in projection.items() if not isinstance(value, dict)}
+    include_id = flags.pop("_id", 1)
+
+    for key, n in slices.items():
+        if isinstance(document.get(key), list):
+            document[key] = document[key][n:] if n < 0 else document[key][:n]
+
+    if any(flags.values()):
+        included = set(flags) | set(slices)
+        document = {key: value for key, value in document.items() if key in included or key == "_id"}
+    else:
+        for key in flags:
+            _unset_path(document, key)
+
+    if not include_id:
+        document.pop("_id", None)
+
+    return document
+
+
+def _evaluate(document: dict, expression: Any) -> Any:
+    """Подмножество выражений агрегации: "$поле", $ifNull, $size, $max и $slice с позицией"""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _get_path(document, expression[1:])
+    if not isinstance(expression, dict):
+        return expression
+
+    (operator, operands), = expression.items()
+    values = [_evaluate(document, operand) for operand in (operands if isinstance(operands, list) else [operands])]
+    present_values = [value for value in values if value is not _MISSING and value is not None]
+
+    if operator == "$ifNull":
+        return present_values[0] if present_values else values[-1]
+    if operator == "$size":
+        return len(values[0])
+    if operator == "$max":
+        return max(present_values) if present_values else None
+    if operator == "$slice" and len(values) == 3:
+        array, position, n = values
+        return array[position:position + n]
+
+    raise UnsupportedQueryError(f"Expression operator {operator} is not supported by memory storage")
+
+
+def _project_stage(document: dict, spec: dict) -> dict:
+    """Стадия $project: включение полей (1) и вычисляемые поля"""
+    projected = {"_id": document["_id"]} if spec.get("_id", 1) else {}
+    for field, expression in spec.items():
+        if field == "_id":
+            continue
+        if expression == 0:
+            raise UnsupportedQueryError("Exclusion in $project is not supported by memory storage")
+
+        value = _get_path(document, field) if expression == 1 else _evaluate(document, expression)
+        if value is not _MISSING:
+            _set_path(projected, field, value)
+
+    return projected
+
+
+def _apply_update(document: dict, update: dict, is_insert: bool):
+    if isinstance(update, list):
+        raise UnsupportedQueryError("Pipeline updates are not supported by memory storage")
+
+    for operator, fields in update.items():
+        if operator == "$setOnInsert":
+            if is_insert:
+                for path, value in fields.items():
+                    _set_path(document, path, copy.deepcopy(value))
+        elif operator == "$set":
+            for path, value in fields.items():
+                _set_path(document, path, copy.deepcopy(value))
+        elif operator == "$unset":
+            for path in fields:
+                _unset_path(document, path)
+        elif operator == "$inc":
+            for path, amount in fields.items():
+                current = _get_path(document, path)
+                _set_path(document, path, (0 if current is _MISSING else current) + amount)
+        elif operator == "$max":
+            for path, value in fields.items():
+                current = _get_path(document, path)
+                if current is _MISSING or value > current:
+                    _set_path(document, path, value)
+        elif operator == "$push":
+            for path, value in fields.items():
+                current = _get_path(document, path)
+                _set_path(document, path, ([] if current is _MISSING else current) + [copy.deepcopy(value)])
+        elif operator == "$pop":
+            for path, direction in fields.items():
+                current = _get_path(document, path)
+                if isinstance(current, list) and current:
+                    _set_path(document, path, current[:-1] if direction == 1 else current[1:])
+        else:
+            raise UnsupportedQueryError(f"Update operator {operator} is not supported by memory storage")
+
+
+class UpdateResult:
+    def __init__(self, matched_count: int, modified_count: int, upserted_id: Any = None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class MemoryCursor:
+    def __init__(self, documents: list):
+        self.documents = documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+    async def to_list(self, length: Optional[int] = None) -> list:
+        return self.documents if length is None else self.documents[:length]
+
+
+class MemoryCollection:
+    def __init__(self, name: str):
+        self.name = name
+        self.documents = {}  # _id -> document
+
+    def _find(self, query: dict) -> list:
+        if set(query) == {"_id"} and not isinstance(query["_id"], dict):
+            document = self.documents.get(query["_id"])
+            return [document] if document is not None else []
+
+        return [document for document in self.documents.values() if _matches(document, query)]
+
+    async def find_one(self, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        documents = self._find(query)
+        return _project(documents[0], projection) if documents else None
+
+    def find(self, query: dict = None, projection: Optional[dict] = None) -> MemoryCursor:
+        return MemoryCursor([_project(document, projection) for document in self._find(query or {})])
+
+    async def count_documents(self, query: dict, limit: int = 0) -> int:
+        n_documents = len(self._find(query))
+        return min(n_documents, limit) if limit else n_documents
+
+    async def insert_one(self, document: dict):
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError(f"Duplicate _id {document['_id']} in {self.name}")
+        self.documents[document["_id"]] = copy.deepcopy(document)
+
+    def _upsert_document(self, query: dict, update: dict) -> dict:
+        document = {path: copy.deepcopy(value) for path, value in query.items() if not isinstance(value, dict)}
+        _apply_update(document, update, is_insert=True)
+        self.documents[document["_id"]] = document
+        return document
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False) -> UpdateResult:
+        documents = self._find(query)
+        if documents:
+            _apply_update(documents[0], update, is_insert=False)
+            return UpdateResult(1, 1)
+
+        if upsert:
+            document = self._upsert_document(query, update)
+            return UpdateResult(0, 0, upserted_id=document["_id"])
+
+        return UpdateResult(0, 0)
+
+    async def update_many(self, query: dict, update: dict) -> UpdateResult:
+        documents = self._find(query)
+        for document in documents:
+            _apply_update(document, update, is_insert=False)
+        return UpdateResult(len(documents), len(documents))
+
+    async def find_one_and_update(
+        self,
+        query: dict,
+        update: dict,
+        projection: Optional[dict] = None,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+    ) -> Optional[dict]:
+        documents = self._find(query)
+        if documents:
+            document = documents[0]
+            before = _project(document, projection)
+            _apply_update(document, update, is_insert=False)
+            return before if return_document == ReturnDocument.BEFORE else _project(document, projection)
+
+        if upsert:
+            document = self._upsert_document(query, update)
+            return None if return_document == ReturnDocument.BEFORE else _project(document, projection)
+
+        return None
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        # pymongo.UpdateOne хранит аргументы в _filter/_doc/_upsert
+        for request in requests:
+            await self.update_one(request._filter, request._doc, upsert=bool(request._upsert))
+
+    def aggregate(self, pipeline: list) -> MemoryCursor:
+        documents = list(self.documents.values())  # стадии не меняют документы, копируется только результат
+        for stage in pipeline:
+            (operator, spec), = stage.items()
+            if operator == "$match":
+                documents = [document for document in documents if _matches(document, spec)]
+            elif operator == "$project":
+                documents = [_project_stage(document, spec) for document in documents]
+            elif operator == "$group" and spec["_id"] is None:
+                group = {"_id": None}
+                for field, accumulator in spec.items():
+                    if field == "_id":
+                        continue
+                    (accumulator_operator, path), = accumulator.items()
+                    if accumulator_operator != "$sum":
+                        raise UnsupportedQueryError(f"Accumulator {accumulator_operator} is not supported by memory storage")
+                    values = [_get_path(document, path.lstrip("$")) for document in documents]
+                    group[field] = sum(value for value in values if value is not _MISSING)
+                documents = [group] if documents else []
+            else:
+                raise UnsupportedQueryError(f"Aggregation stage {operator} is not supported by memory storage")
+
+        return MemoryCursor(copy.deepcopy(documents))
+
+    async def create_indexes(self, indexes: list):
+        pass  # полный перебор в памяти, индексы не нужны
+
+
+class MemoryDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+
+class MemoryClient:
+    """Замена AsyncIOMotorClient: данные живут в памяти процесса"""
+
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(name)
+        return self.databases[name]
+
+
+class MemoryDownloadStream:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read(self) -> bytes:
+        return self.data
+
+
+class MemoryGridFSBucket:
+    """Замена AsyncIOMotorGridFSBucket: файлы хранятся целиком в коллекции <bucket_name>.files"""
+
+    def __init__(self, database: MemoryDatabase, bucket_name: str = "fs"):
+        self.files = database[f"{bucket_name}.files"]
+
+    async def upload_from_stream_with_id(self, file_id: Any, filename: str, source: bytes):
+        if file_id in self.files.documents:
+            raise FileExists(f"File {file_id} already exists")
+
+        await self.files.insert_one({
+            "_id": file_id,
+            "filename": filename,
+            "length": len(source),
+            "uploadDate": datetime.now(),
+            "data": bytes(source)
+        })
+
+    async def open_download_stream(self, file_id: Any) -> MemoryDownloadStream:
+        document = self.files.documents.get(file_id)
+        if document is None:
+            raise NoFile(f"File {file_id} not found")
+        return MemoryDownloadStream(document["data"])
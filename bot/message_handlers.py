@@ -1,7 +1,7 @@
 # message_handlers.py - С поддержкой групп и автоматическим определением языка
 import io
 import asyncio
-import base64
+import logging
 from datetime import datetime
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -10,54 +10,68 @@ from telegram.constants import ParseMode
 
 import config
 import openai_utils
+import image_utils
+import audio_utils
 from utils import register_user_if_not_exists, register_group_if_not_exists
 from localization import t
 
+logger = logging.getLogger(__name__)
+
 user_semaphores = {}
 user_tasks = {}
+summarizing_dialogs = set()  # dialog_id, для которых уже идет фоновое сжатие
 
-def get_language_instruction(user_id: int, chat_id: int, db) -> str:
-    """Получить инструкцию о языке для ChatGPT с поддержкой групп"""
-    # Определяем источник языка
+async def get_chat_language(user_id: int, chat_id: int, db) -> str:
+    """Язык ответов ChatGPT: язык группы или пользователя (из снапшота запроса, без обращения к БД)"""
     if chat_id < 0:  # Группа
-        user_language = db.get_group_attribute(chat_id, "language") or "en"
+        return await db.get_group_attribute(chat_id, "language") or "en"
     else:  # Личный чат
-        user_language = db.get_user_attribute(user_id, "language") or "en"
-
-    language_instructions = {
-        "ru": "Отвечай ТОЛЬКО на русском языке. Будь дружелюбным и полезным помощником. Все твои ответы должны быть на русском языке, независимо от языка вопроса.",
-        "en": "Respond ONLY in English. Be a friendly and helpful assistant. All your responses should be in English, regardless of the question's language.",
-    }
+        return await db.get_user_attribute(user_id, "language") or "en"
 
-    return language_instructions.get(user_language, language_instructions["en"])
+async def fill_dialog_token_counts(db, user_id: int, dialog_messages: list, model: str):
+    """Досчитать токены старых сообщений (сохраненных до появления n_tokens) и записать их в диалог"""
+    filled_indices = openai_utils.fill_dialog_token_counts(dialog_messages, model)
+    await db.save_dialog_token_counts(user_id, dialog_messages, filled_indices, openai_utils.get_encoding_name(model))
 
-def enhance_dialog_messages_with_language(dialog_messages: list, user_id: int, chat_id: int, db) -> list:
-    """Добавить языковую инструкцию к диалогу с поддержкой групп"""
-    if not dialog_messages:
-        dialog_messages = []
+async def summarize_dialog_if_needed(db, user_id: int, dialog_id: str, model: str):
+    """Фоновое сжатие: если несжатая часть диалога длиннее порога, старые сообщения заменяются резюме"""
+    if dialog_id in summarizing_dialogs:
+        return
 
-    language_instruction = get_language_instruction(user_id, chat_id, db)
+    summarizing_dialogs.add(dialog_id)
+    try:
+        # только несжатый хвост диалога; если резюме успели обновить параллельно, set_dialog_summary ничего не запишет
+        dialog_messages, dialog_summary, n_summarized = await db.get_unsummarized_dialog(user_id, dialog_id)
 
-    # Создаем копию сообщений
-    enhanced_messages = []
+        # n_tokens уже посчитаны при сохранении сообщений, досчитываются только старые
+        openai_utils.fill_dialog_token_counts(dialog_messages, model)
+        encoding_name = openai_utils.get_encoding_name(model)
+        n_tokens = sum(dialog_message["n_tokens"][encoding_name] for dialog_message in dialog_messages)
 
-    # Добавляем языковую инструкцию как первое системное сообщение
-    # Определяем язык для ответа бота
-    if chat_id < 0:  # Группа
-        bot_language = db.get_group_attribute(chat_id, "language") or "en"
-    else:  # Личный чат
-        bot_language = db.get_user_attribute(user_id, "language") or "en"
+        n_messages_to_summarize = len(dialog_messages) - config.dialog_summary_keep_last_n
+        if n_tokens <= config.dialog_summary_threshold_tokens or n_messages_to_summarize <= 0:
+            return
 
-    enhanced_messages.append({
-        "user": [{"type": "text", "text": f"SYSTEM: {language_instruction}"}],
-        "bot": "Понял, буду отвечать на выбранном языке." if bot_language == "ru" else "Understood, I will respond in the selected language.",
-        "date": datetime.now()
-    })
+        summary_text, (n_input_tokens, n_output_tokens) = await openai_utils.summarize_dialog(
+            dialog_messages[:n_messages_to_summarize], previous_summary=dialog_summary
+        )
+        await db.update_n_used_tokens(user_id, config.dialog_summary_model, n_input_tokens, n_output_tokens)
+        await db.set_dialog_summary(user_id, dialog_id, summary_text, n_summarized + n_messages_to_summarize, n_summarized)
+    except Exception as e:
+        logger.warning(f"Failed to summarize dialog {dialog_id}: {e}")
+    finally:
+        summarizing_dialogs.discard(dialog_id)
 
-    # Добавляем остальные сообщения
-    enhanced_messages.extend(dialog_messages)
+async def send_messages_removed_notice(update: Update, user_id: int, chat_id: int, n_removed: int):
+    """Сообщить, что первые сообщения диалога не вошли в контекст (обрезаны планировщиком или не загружены)"""
+    if n_removed <= 0:
+        return
 
-    return enhanced_messages
+    if n_removed == 1:
+        text = await t(user_id, "message_removed", chat_id=chat_id)
+    else:
+        text = await t(user_id, "messages_removed", chat_id=chat_id, count=n_removed)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 async def is_bot_mentioned(update: Update, context: CallbackContext):
     try:
@@ -88,7 +102,7 @@ async def is_previous_message_not_answered_yet(update: Update, context: Callback
         user_semaphores[user_id] = asyncio.Semaphore(1)
 
     if user_semaphores[user_id].locked():
-        text = t(user_id, "wait_previous", chat_id=chat_id)
+        text = await t(user_id, "wait_previous", chat_id=chat_id)
         await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
         return True
     else:
@@ -96,25 +110,25 @@ async def is_previous_message_not_answered_yet(update: Update, context: Callback
 
 async def check_daily_limits(update: Update, user_id: int, db) -> bool:
     """Проверить дневные лимиты пользователя"""
-    is_premium = db.get_user_subscription_status(user_id)
-    daily_messages = db.get_daily_usage(user_id, "messages")
+    is_premium = await db.get_user_subscription_status(user_id)
+    daily_messages = await db.get_daily_usage(user_id, "messages")
     max_daily_messages = 1000 if is_premium else 5
     chat_id = update.message.chat.id
 
     if daily_messages >= max_daily_messages:
-        limit_text = t(user_id, "daily_limit_exceeded", chat_id=chat_id)
+        limit_text = await t(user_id, "daily_limit_exceeded", chat_id=chat_id)
 
         if is_premium:
-            limit_text += t(user_id, "premium_limit_text", chat_id=chat_id,
+            limit_text += await t(user_id, "premium_limit_text", chat_id=chat_id,
                           max_messages=max_daily_messages,
                           used_messages=daily_messages)
         else:
-            limit_text += t(user_id, "free_limit_text", chat_id=chat_id,
+            limit_text += await t(user_id, "free_limit_text", chat_id=chat_id,
                           max_messages=max_daily_messages,
                           used_messages=daily_messages)
 
             keyboard = [[
-                InlineKeyboardButton(t(user_id, "buy_premium", chat_id=chat_id), callback_data="show_premium_plans")
+                InlineKeyboardButton(await t(user_id, "buy_premium", chat_id=chat_id), callback_data="show_premium_plans")
             ]]
             reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -132,24 +146,24 @@ async def check_daily_limits(update: Update, user_id: int, db) -> bool:
 
 async def check_image_limits(update: Update, user_id: int, db) -> bool:
     """Проверить лимиты изображений"""
-    is_premium = db.get_user_subscription_status(user_id)
-    daily_images = db.get_daily_usage(user_id, "images")
+    is_premium = await db.get_user_subscription_status(user_id)
+    daily_images = await db.get_daily_usage(user_id, "images")
     max_daily_images = 50 if is_premium else 2
     chat_id = update.message.chat.id
 
     if daily_images >= max_daily_images:
-        limit_text = t(user_id, "image_limit_exceeded", chat_id=chat_id)
+        limit_text = await t(user_id, "image_limit_exceeded", chat_id=chat_id)
 
         if is_premium:
-            limit_text += t(user_id, "premium_image_limit", chat_id=chat_id,
+            limit_text += await t(user_id, "premium_image_limit", chat_id=chat_id,
                           max_images=max_daily_images,
                           used_images=daily_images)
         else:
-            limit_text += t(user_id, "free_image_limit", chat_id=chat_id,
+            limit_text += await t(user_id, "free_image_limit", chat_id=chat_id,
                           max_images=max_daily_images,
                           used_images=daily_images)
 
-            keyboard = [[InlineKeyboardButton(t(user_id, "buy_premium", chat_id=chat_id), callback_data="show_premium_plans")]]
+            keyboard = [[InlineKeyboardButton(await t(user_id, "buy_premium", chat_id=chat_id), callback_data="show_premium_plans")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text(limit_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
             return False
@@ -163,32 +177,35 @@ async def check_model_access(update: Update, user_id: int, chat_id: int, db) ->
     """Проверить доступ к модели и вернуть допустимую модель с поддержкой групп"""
     # Получаем модель из настроек группы или пользователя
     if chat_id < 0:  # Группа
-        current_model = db.get_group_attribute(chat_id, "current_model")
+        current_model = await db.get_group_attribute(chat_id, "current_model")
     else:  # Личный чат
-        current_model = db.get_user_attribute(user_id, "current_model")
+        current_model = await db.get_user_attribute(user_id, "current_model")
 
     # Используем premium_models из конфигурации
-    is_premium = db.get_user_subscription_status(user_id)
+    is_premium = await db.get_user_subscription_status(user_id)
 
     if current_model in config.premium_models and not is_premium:
         await update.message.reply_text(
-            t(user_id, "gpt4_premium_only", chat_id=chat_id),
+            await t(user_id, "gpt4_premium_only", chat_id=chat_id),
             parse_mode=ParseMode.HTML
         )
 
         # Устанавливаем fallback модель
         fallback_model = config.default_model
         if chat_id < 0:  # Группа
-            db.set_group_attribute(chat_id, "current_model", fallback_model)
+            await db.set_group_attribute(chat_id, "current_model", fallback_model)
         else:  # Личный чат
-            db.set_user_attribute(user_id, "current_model", fallback_model)
+            await db.set_user_attribute(user_id, "current_model", fallback_model)
 
         return fallback_model
 
     return current_model
 
-async def message_handle(update: Update, context: CallbackContext, db, message=None, use_new_dialog_timeout=True):
-    """Обработка сообщений с проверкой подписки и лимитов"""
+async def message_handle(update: Update, context: CallbackContext, db, message=None, use_new_dialog_timeout=True, image_id=None, image_detail=None):
+    """Обработка сообщений с проверкой подписки и лимитов.
+
+    Возвращает True, только если ответ получен и сохранен в диалог (по этому /retry решает, вернуть ли снятое сообщение).
+    """
 
     # Проверка упоминания бота
     if not await is_bot_mentioned(update, context):
@@ -222,15 +239,15 @@ async def message_handle(update: Update, context: CallbackContext, db, message=N
     current_model = await check_model_access(update, user_id, chat_id, db)
 
     # Увеличиваем счетчик использования
-    db.add_daily_usage(user_id, "messages", 1)
+    await db.add_daily_usage(user_id, "messages", 1)
 
     # Получаем chat_mode из группы или пользователя
     if chat_id < 0:  # Группа
-        chat_mode = db.get_group_attribute(chat_id, "current_chat_mode")
+        chat_mode = await db.get_group_attribute(chat_id, "current_chat_mode")
     else:  # Личный чат
-        chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+        chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
 
-    _message = message or update.message.text
+    _message = message if message is not None else update.message.text
 
     if update.message.chat.type != "private":
         _message = _message.replace("@" + context.bot.username, "").strip()
@@ -247,15 +264,15 @@ async def message_handle(update: Update, context: CallbackContext, db, message=N
     async def message_handle_fn():
         # new dialog timeout
         if use_new_dialog_timeout:
-            if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-                db.start_new_dialog(user_id)
+            if (datetime.now() - await db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and await db.get_dialog_message_count(user_id) > 0:
+                await db.start_new_dialog(user_id)
 
                 # Получаем локализованное welcome сообщение напрямую
-                user_language = db.get_user_attribute(user_id, "language") or "en"
+                user_language = await db.get_user_attribute(user_id, "language") or "en"
                 mode_name = config.chat_modes[chat_mode]['name']
 
                 # Отправляем уведомление о таймауте
-                timeout_text = t(user_id, "dialog_timeout", chat_id=chat_id, mode_name=mode_name)
+                timeout_text = await t(user_id, "dialog_timeout", chat_id=chat_id, mode_name=mode_name)
                 await update.message.reply_text(timeout_text, parse_mode=ParseMode.HTML)
 
                 # Получаем и отправляем локализованное welcome сообщение
@@ -268,11 +285,15 @@ async def message_handle(update: Update, context: CallbackContext, db, message=N
 
                 await update.message.reply_text(welcome_text, parse_mode=ParseMode.HTML)
 
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        db.update_last_interaction(user_id)
+        await db.flush_request_context()  # сохраняем настройки до долгого запроса к OpenAI
 
         # in case of CancelledError
         n_input_tokens, n_output_tokens = 0, 0
 
+        # при деградации current_model ответит совместимая здоровая модель, доступная пользователю
+        answering_model = openai_utils.model_router.choose_model(current_model, await db.get_user_subscription_status(user_id))
+
         try:
             # send placeholder message to user
             placeholder_message = await update.message.reply_text("...")
@@ -281,26 +302,31 @@ async def message_handle(update: Update, context: CallbackContext, db, message=N
             await update.message.chat.send_action(action="typing")
 
             if _message is None or len(_message) == 0:
-                await update.message.reply_text(t(user_id, "empty_message", chat_id=chat_id), parse_mode=ParseMode.HTML)
+                await update.message.reply_text(await t(user_id, "empty_message", chat_id=chat_id), parse_mode=ParseMode.HTML)
                 return
 
-            # ВАЖНО: Добавляем языковую инструкцию к диалогу
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-            enhanced_dialog_messages = enhance_dialog_messages_with_language(dialog_messages, user_id, chat_id, db)
+            # языковое правило входит в system prompt режима (openai_utils.SYSTEM_PROMPTS)
+            language = await get_chat_language(user_id, chat_id, db)
+            dialog_messages, dialog_summary, n_dialog_messages_not_loaded = await db.get_dialog_context(
+                user_id, dialog_id=None, last_n=config.n_dialog_messages_in_context
+            )
+            await fill_dialog_token_counts(db, user_id, dialog_messages, answering_model)
 
             parse_mode = {
                 "html": ParseMode.HTML,
                 "markdown": ParseMode.MARKDOWN
             }[config.chat_modes[chat_mode]["parse_mode"]]
 
-            chatgpt_instance = openai_utils.ChatGPT(model=current_model)
+            chatgpt_instance = openai_utils.ChatGPT(model=answering_model)
             if config.enable_message_streaming:
-                gen = chatgpt_instance.send_message_stream(_message, dialog_messages=enhanced_dialog_messages, chat_mode=chat_mode)
+                gen = chatgpt_instance.send_message_stream(_message, dialog_messages=dialog_messages, chat_mode=chat_mode, language=language, dialog_summary=dialog_summary)
             else:
                 answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = await chatgpt_instance.send_message(
                     _message,
-                    dialog_messages=enhanced_dialog_messages,
-                    chat_mode=chat_mode
+                    dialog_messages=dialog_messages,
+                    chat_mode=chat_mode,
+                    language=language,
+                    dialog_summary=dialog_summary
                 )
 
                 async def fake_gen():
@@ -333,44 +359,60 @@ async def message_handle(update: Update, context: CallbackContext, db, message=N
 
             # update user data (сохраняем оригинальные сообщения без языковой инструкции)
             new_dialog_message = {"user": [{"type": "text", "text": _message}], "bot": answer, "date": datetime.now()}
+            openai_utils.fill_dialog_token_counts([new_dialog_message], answering_model)
 
-            db.set_dialog_messages(
-                user_id,
-                db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-                dialog_id=None
-            )
+            await db.append_dialog_message(user_id, new_dialog_message, dialog_id=None)
+
+            await db.update_n_used_tokens(user_id, answering_model, n_input_tokens, n_output_tokens)
 
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            if config.enable_dialog_summarization:
+                # сжатие не задерживает ответ: выполняется после него в фоне
+                dialog_id = await db.get_user_attribute(user_id, "current_dialog_id")
+                context.application.create_task(summarize_dialog_if_needed(db, user_id, dialog_id, answering_model))
 
         except asyncio.CancelledError:
             # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            await db.update_n_used_tokens(user_id, answering_model, n_input_tokens, n_output_tokens)
             raise
 
+        except openai_utils.OpenAIUnavailableError:
+            await update.message.reply_text(await t(user_id, "openai_unavailable", chat_id=chat_id), parse_mode=ParseMode.HTML)
+            return
+
         except Exception as e:
             error_text = f"Something went wrong during completion. Reason: {e}"
             await update.message.reply_text(error_text)
             return
 
         # send message if some messages were removed from the context
-        if n_first_dialog_messages_removed > 0:
-            if n_first_dialog_messages_removed == 1:
-                text = t(user_id, "message_removed", chat_id=chat_id)
-            else:
-                text = t(user_id, "messages_removed", chat_id=chat_id, count=n_first_dialog_messages_removed)
+        await send_messages_removed_notice(update, user_id, chat_id, n_first_dialog_messages_removed + n_dialog_messages_not_loaded)
+
+        if answering_model != current_model:
+            text = await t(
+                user_id, "model_fallback_used", chat_id=chat_id,
+                model=config.models["info"][current_model]["name"],
+                fallback_model=config.models["info"][answering_model]["name"]
+            )
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
+        return True
+
+    is_answered = False
     async with user_semaphores[user_id]:
         # Проверяем только наличие фото, а не любых вложений
-        if (current_model == "gpt-4-vision-preview" or current_model == "gpt-4o") and update.message.photo is not None and len(update.message.photo) > 0:
+        has_photo = (update.message.photo is not None and len(update.message.photo) > 0) or image_id is not None
+        if (current_model == "gpt-4-vision-preview" or current_model == "gpt-4o") and has_photo:
             if current_model != "gpt-4o" and current_model != "gpt-4-vision-preview":
                 current_model = "gpt-4o"
                 if chat_id < 0:  # Группа
-                    db.set_group_attribute(chat_id, "current_model", "gpt-4o")
+                    await db.set_group_attribute(chat_id, "current_model", "gpt-4o")
                 else:  # Личный чат
-                    db.set_user_attribute(user_id, "current_model", "gpt-4o")
+                    await db.set_user_attribute(user_id, "current_model", "gpt-4o")
             task = asyncio.create_task(
-                _vision_message_handle_fn(update, context, db, use_new_dialog_timeout=use_new_dialog_timeout)
+                _vision_message_handle_fn(
+                    update, context, db, use_new_dialog_timeout=use_new_dialog_timeout,
+                    message=message, image_id=image_id, image_detail=image_detail
+                )
             )
         else:
             task = asyncio.create_task(
@@ -380,9 +422,9 @@ async def message_handle(update: Update, context: CallbackContext, db, message=N
         user_tasks[user_id] = task
 
         try:
-            await task
+            is_answered = await task
         except asyncio.CancelledError:
-            await update.message.reply_text(t(user_id, "canceled", chat_id=chat_id), parse_mode=ParseMode.HTML)
+            await update.message.reply_text(await t(user_id, "canceled", chat_id=chat_id), parse_mode=ParseMode.HTML)
         else:
             pass
         finally:
@@ -391,45 +433,54 @@ async def message_handle(update: Update, context: CallbackContext, db, message=N
                 task.cancel()
             else:
                 await update.message.reply_text(
-                    t(user_id, "nothing_to_cancel", chat_id=chat_id),
+                    await t(user_id, "nothing_to_cancel", chat_id=chat_id),
                     parse_mode=ParseMode.HTML
                 )
             del user_tasks[user_id]
 
-async def _vision_message_handle_fn(update: Update, context: CallbackContext, db, use_new_dialog_timeout: bool = True):
+    return is_answered
+
+async def _vision_message_handle_fn(
+    update: Update, context: CallbackContext, db, use_new_dialog_timeout: bool = True,
+    message=None, image_id=None, image_detail=None
+):
+    """message/image_id/image_detail передаются при /retry: текст и сохраненное в GridFS фото повторяемого сообщения.
+
+    Возвращает True, если ответ сохранен в диалог.
+    """
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
 
     # Получаем модель из настроек группы или пользователя
     if chat_id < 0:  # Группа
-        current_model = db.get_group_attribute(chat_id, "current_model")
+        current_model = await db.get_group_attribute(chat_id, "current_model")
     else:  # Личный чат
-        current_model = db.get_user_attribute(user_id, "current_model")
+        current_model = await db.get_user_attribute(user_id, "current_model")
 
     if current_model != "gpt-4-vision-preview" and current_model != "gpt-4o":
         await update.message.reply_text(
-            t(user_id, "vision_model_required", chat_id=chat_id),
+            await t(user_id, "vision_model_required", chat_id=chat_id),
             parse_mode=ParseMode.HTML,
         )
         return
 
     # Получаем chat_mode из группы или пользователя
     if chat_id < 0:  # Группа
-        chat_mode = db.get_group_attribute(chat_id, "current_chat_mode")
+        chat_mode = await db.get_group_attribute(chat_id, "current_chat_mode")
     else:  # Личный чат
-        chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+        chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
 
     # new dialog timeout
     if use_new_dialog_timeout:
-        if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-            db.start_new_dialog(user_id)
+        if (datetime.now() - await db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and await db.get_dialog_message_count(user_id) > 0:
+            await db.start_new_dialog(user_id)
 
             # Получаем локализованное welcome сообщение напрямую
-            user_language = db.get_user_attribute(user_id, "language") or "en"
+            user_language = await db.get_user_attribute(user_id, "language") or "en"
             mode_name = config.chat_modes[chat_mode]['name']
 
             # Отправляем уведомление о таймауте
-            timeout_text = t(user_id, "dialog_timeout", chat_id=chat_id, mode_name=mode_name)
+            timeout_text = await t(user_id, "dialog_timeout", chat_id=chat_id, mode_name=mode_name)
             await update.message.reply_text(timeout_text, parse_mode=ParseMode.HTML)
 
             # Получаем и отправляем локализованное welcome сообщение
@@ -442,45 +493,66 @@ async def _vision_message_handle_fn(update: Update, context: CallbackContext, db
 
             await update.message.reply_text(welcome_text, parse_mode=ParseMode.HTML)
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
+    await db.flush_request_context()  # сохраняем настройки до долгого запроса к OpenAI
 
     buf = None
-    if update.message.effective_attachment:
-        photo = update.message.effective_attachment[-1]
+    if image_id is not None:
+        # фото уже уменьшено и перекодировано при первой отправке
+        image_detail = image_detail or "high"
+        buf = io.BytesIO(await db.get_image(image_id))
+        buf.name = "image.jpg"  # file extension is required
+    else:
+        image_detail = image_utils.choose_image_detail(update.message.caption)
+
+    if image_id is None and update.message.effective_attachment:
+        # самый маленький размер, которого хватает для image_detail, а не самый большой
+        photo = image_utils.pick_photo_size(update.message.effective_attachment, image_detail)
         photo_file = await context.bot.get_file(photo.file_id)
 
         # store file in memory, not on disk
-        buf = io.BytesIO()
-        await photo_file.download_to_memory(buf)
+        photo_bytes = await photo_file.download_as_bytearray()
+        buf = io.BytesIO(await image_utils.prepare_image(bytes(photo_bytes), image_detail))
         buf.name = "image.jpg"  # file extension is required
         buf.seek(0)  # move cursor to the beginning of the buffer
 
     # in case of CancelledError
     n_input_tokens, n_output_tokens = 0, 0
 
+    # при деградации current_model ответит совместимая здоровая vision-модель, доступная пользователю
+    answering_model = openai_utils.model_router.choose_model(current_model, await db.get_user_subscription_status(user_id), with_image=buf is not None)
+
     try:
         # send placeholder message to user
         placeholder_message = await update.message.reply_text("...")
-        message = update.message.caption or update.message.text or ''
+        if message is None:
+            message = update.message.caption or update.message.text or ''
 
         # send typing action
         await update.message.chat.send_action(action="typing")
 
-        # ВАЖНО: Добавляем языковую инструкцию к диалогу
-        dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-        enhanced_dialog_messages = enhance_dialog_messages_with_language(dialog_messages, user_id, chat_id, db)
+        # языковое правило входит в system prompt режима (openai_utils.SYSTEM_PROMPTS)
+        language = await get_chat_language(user_id, chat_id, db)
+        dialog_messages, dialog_summary, n_dialog_messages_not_loaded = await db.get_dialog_context(
+            user_id, dialog_id=None, last_n=config.n_dialog_messages_in_context
+        )
+        await fill_dialog_token_counts(db, user_id, dialog_messages, answering_model)
+        dialog_messages = await db.load_dialog_images(dialog_messages)  # изображения хранятся в GridFS по ссылке
 
         parse_mode = {"html": ParseMode.HTML, "markdown": ParseMode.MARKDOWN}[
             config.chat_modes[chat_mode]["parse_mode"]
         ]
 
-        chatgpt_instance = openai_utils.ChatGPT(model=current_model)
+        chatgpt_instance = openai_utils.ChatGPT(model=answering_model)
         if config.enable_message_streaming:
             gen = chatgpt_instance.send_vision_message_stream(
                 message,
-                dialog_messages=enhanced_dialog_messages,
+                dialog_messages=dialog_messages,
                 image_buffer=buf,
                 chat_mode=chat_mode,
+                language=language,
+                dialog_summary=dialog_summary,
+                image_detail=image_detail,
             )
         else:
             (
@@ -489,9 +561,12 @@ async def _vision_message_handle_fn(update: Update, context: CallbackContext, db
                 n_first_dialog_messages_removed,
             ) = await chatgpt_instance.send_vision_message(
                 message,
-                dialog_messages=enhanced_dialog_messages,
+                dialog_messages=dialog_messages,
                 image_buffer=buf,
                 chat_mode=chat_mode,
+                language=language,
+                dialog_summary=dialog_summary,
+                image_detail=image_detail,
             )
 
             async def fake_gen():
@@ -540,7 +615,7 @@ async def _vision_message_handle_fn(update: Update, context: CallbackContext, db
 
         # update user data (сохраняем оригинальные сообщения)
         if buf is not None:
-            base_image = base64.b64encode(buf.getvalue()).decode("utf-8")
+            image_id = await db.put_image(buf.getvalue())
             new_dialog_message = {"user": [
                         {
                             "type": "text",
@@ -548,31 +623,51 @@ async def _vision_message_handle_fn(update: Update, context: CallbackContext, db
                         },
                         {
                             "type": "image",
-                            "image": base_image,
+                            "image_id": image_id,
+                            "detail": image_detail,
                         }
                     ]
                 , "bot": answer, "date": datetime.now()}
         else:
             new_dialog_message = {"user": [{"type": "text", "text": message}], "bot": answer, "date": datetime.now()}
+        openai_utils.fill_dialog_token_counts([new_dialog_message], answering_model)
 
-        db.set_dialog_messages(
-            user_id,
-            db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-            dialog_id=None
-        )
+        await db.append_dialog_message(user_id, new_dialog_message, dialog_id=None)
+
+        await db.update_n_used_tokens(user_id, answering_model, n_input_tokens, n_output_tokens)
 
-        db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+        if config.enable_dialog_summarization:
+            # сжатие не задерживает ответ: выполняется после него в фоне
+            dialog_id = await db.get_user_attribute(user_id, "current_dialog_id")
+            context.application.create_task(summarize_dialog_if_needed(db, user_id, dialog_id, answering_model))
 
     except asyncio.CancelledError:
         # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-        db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+        await db.update_n_used_tokens(user_id, answering_model, n_input_tokens, n_output_tokens)
         raise
 
+    except openai_utils.OpenAIUnavailableError:
+        await update.message.reply_text(await t(user_id, "openai_unavailable", chat_id=chat_id), parse_mode=ParseMode.HTML)
+        return
+
     except Exception as e:
         error_text = f"Something went wrong during completion. Reason: {e}"
         await update.message.reply_text(error_text)
         return
 
+    # send message if some messages were removed from the context
+    await send_messages_removed_notice(update, user_id, chat_id, n_first_dialog_messages_removed + n_dialog_messages_not_loaded)
+
+    if answering_model != current_model:
+        text = await t(
+            user_id, "model_fallback_used", chat_id=chat_id,
+            model=config.models["info"][current_model]["name"],
+            fallback_model=config.models["info"][answering_model]["name"]
+        )
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+    return True
+
 async def generate_image_handle_with_limits(update: Update, context: CallbackContext, db, message=None):
     """Генерация изображений с проверкой лимитов"""
     await register_user_if_not_exists(update, context, update.message.from_user, db)
@@ -581,10 +676,10 @@ async def generate_image_handle_with_limits(update: Update, context: CallbackCon
 
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     # Увеличиваем счетчик изображений
-    db.add_daily_usage(user_id, "images", 1)
+    await db.add_daily_usage(user_id, "images", 1)
 
     await update.message.chat.send_action(action="upload_photo")
     message = message or update.message.text
@@ -595,17 +690,20 @@ async def generate_image_handle_with_limits(update: Update, context: CallbackCon
             n_images=config.return_n_generated_images,
             size=config.image_size
         )
+    except openai_utils.OpenAIUnavailableError:
+        await update.message.reply_text(await t(user_id, "openai_unavailable", chat_id=chat_id), parse_mode=ParseMode.HTML)
+        return
     except Exception as e:
         if "safety system" in str(e):
-            text = t(user_id, "unsupported_content", chat_id=chat_id)
+            text = await t(user_id, "unsupported_content", chat_id=chat_id)
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
             return
         else:
             raise
 
     # Обновляем счетчик изображений
-    db.set_user_attribute(user_id, "n_generated_images",
-                         config.return_n_generated_images + db.get_user_attribute(user_id, "n_generated_images"))
+    await db.set_user_attribute(user_id, "n_generated_images",
+                         config.return_n_generated_images + await db.get_user_attribute(user_id, "n_generated_images"))
 
     for i, image_url in enumerate(image_urls):
         await update.message.chat.send_action(action="upload_photo")
@@ -622,23 +720,63 @@ async def voice_message_handle(update: Update, context: CallbackContext, db):
 
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     voice = update.message.voice
     voice_file = await context.bot.get_file(voice.file_id)
 
     # store file in memory, not on disk
-    buf = io.BytesIO()
-    await voice_file.download_to_memory(buf)
-    buf.name = "voice.oga"  # file extension is required
-    buf.seek(0)  # move cursor to the beginning of the buffer
+    voice_bytes = bytes(await voice_file.download_as_bytearray())
+
+    # длинное сообщение режется по паузам, куски распознаются параллельно
+    await update.message.chat.send_action(action="typing")
+    chunks = await audio_utils.split_audio(voice_bytes, voice.duration)
+    progress_message = None
+    if len(chunks) > 1:
+        progress_message = await update.message.reply_text(
+            await t(user_id, "voice_transcription_progress", chat_id=chat_id, n_done=0, n_total=len(chunks)),
+            parse_mode=ParseMode.HTML
+        )
 
-    transcribed_text = await openai_utils.transcribe_audio(buf)
-    text = t(user_id, "voice_transcription", chat_id=chat_id, text=transcribed_text)
-    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    # куски завершаются одновременно: правки сообщения идут по очереди и не откатывают счетчик назад
+    progress_lock = asyncio.Lock()
+    n_done_shown = 0
+
+    async def on_progress(n_done, n_total):
+        nonlocal n_done_shown
+        async with progress_lock:
+            if n_done <= n_done_shown:
+                return
+            n_done_shown = n_done
+            try:
+                await progress_message.edit_text(
+                    await t(user_id, "voice_transcription_progress", chat_id=chat_id, n_done=n_done, n_total=n_total),
+                    parse_mode=ParseMode.HTML
+                )
+            except telegram.error.BadRequest:
+                pass
+
+    try:
+        transcribed_text, failed_chunks = await openai_utils.transcribe_audio_chunks(
+            chunks, on_progress=on_progress if progress_message else None
+        )
+    except openai_utils.OpenAIUnavailableError:
+        await update.message.reply_text(await t(user_id, "openai_unavailable", chat_id=chat_id), parse_mode=ParseMode.HTML)
+        return
+
+    text = await t(user_id, "voice_transcription", chat_id=chat_id, text=transcribed_text)
+    if failed_chunks:
+        text += "\n\n" + await t(
+            user_id, "voice_transcription_failed_chunks", chat_id=chat_id,
+            chunks=", ".join(map(str, failed_chunks)), n_total=len(chunks)
+        )
+    if progress_message is not None:
+        await progress_message.edit_text(text, parse_mode=ParseMode.HTML)
+    else:
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
     # update n_transcribed_seconds
-    db.set_user_attribute(user_id, "n_transcribed_seconds", voice.duration + db.get_user_attribute(user_id, "n_transcribed_seconds"))
+    await db.set_user_attribute(user_id, "n_transcribed_seconds", voice.duration + await db.get_user_attribute(user_id, "n_transcribed_seconds"))
 
     await message_handle(update, context, db, message=transcribed_text)
 
@@ -646,7 +784,7 @@ async def unsupport_message_handle(update: Update, context: CallbackContext, db)
     """Обработка неподдерживаемых типов сообщений"""
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
-    error_text = t(user_id, "unsupported_files", chat_id=chat_id)
+    error_text = await t(user_id, "unsupported_files", chat_id=chat_id)
     await update.message.reply_text(error_text)
     return
 
@@ -655,7 +793,7 @@ async def edited_message_handle(update: Update, context: CallbackContext, db):
     if update.edited_message.chat.type == "private":
         user_id = update.edited_message.from_user.id
         chat_id = update.edited_message.chat.id
-        text = t(user_id, "editing_not_supported", chat_id=chat_id)
+        text = await t(user_id, "editing_not_supported", chat_id=chat_id)
         await update.edited_message.reply_text(text, parse_mode=ParseMode.HTML)
 
 async def retry_handle(update: Update, context: CallbackContext, db):
@@ -666,17 +804,33 @@ async def retry_handle(update: Update, context: CallbackContext, db):
 
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-    if len(dialog_messages) == 0:
-        await update.message.reply_text(t(user_id, "nothing_to_retry", chat_id=chat_id))
+    last_dialog_message = await db.pop_last_dialog_message(user_id, dialog_id=None)  # last message is removed from the context
+    if last_dialog_message is None:
+        await update.message.reply_text(await t(user_id, "nothing_to_retry", chat_id=chat_id))
         return
 
-    last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)  # last message was removed from the context
+    # сохраненное сообщение - список частей: текст отправляется как сообщение, фото - по ссылке из GridFS
+    user_content = last_dialog_message["user"]
+    image_part = None
+    if isinstance(user_content, list):
+        message = " ".join(part["text"] for part in user_content if part.get("type") == "text")
+        image_part = next((part for part in user_content if part.get("type") == "image" and "image_id" in part), None)
+    else:
+        message = user_content
 
-    await message_handle(update, context, db, message=last_dialog_message["user"], use_new_dialog_timeout=False)
+    # message_handle сам обрабатывает ошибки OpenAI, отмену и лимиты, поэтому успех определяется по возвращаемому флагу
+    is_answered = False
+    try:
+        is_answered = await message_handle(
+            update, context, db, message=message, use_new_dialog_timeout=False,
+            image_id=image_part["image_id"] if image_part else None,
+            image_detail=image_part.get("detail") if image_part else None
+        )
+    finally:
+        if not is_answered:
+            await db.append_dialog_message(user_id, last_dialog_message, dialog_id=None)  # не терять сообщение при сбое
 
 async def cancel_handle(update: Update, context: CallbackContext, db):
     """Отмена текущего запроса"""
@@ -684,13 +838,13 @@ async def cancel_handle(update: Update, context: CallbackContext, db):
 
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     if user_id in user_tasks:
         task = user_tasks[user_id]
         task.cancel()
     else:
         await update.message.reply_text(
-            t(user_id, "nothing_to_cancel", chat_id=chat_id),
+            await t(user_id, "nothing_to_cancel", chat_id=chat_id),
             parse_mode=ParseMode.HTML
         )
@@ -1,8 +1,17 @@
+import asyncio
 import base64
+import statistics
+import random
+import functools
+import hashlib
+import json
+import time
+from collections import OrderedDict, deque
 from io import BytesIO
 import config
 import logging
 
+import aiohttp
 import tiktoken
 import openai
 
@@ -14,116 +23,841 @@ if config.openai_api_base is not None:
 logger = logging.getLogger(__name__)
 
 
+# общий HTTP-клиент для всех запросов к OpenAI (создается в post_init, закрывается при остановке)
+_http_session = None
+
+
+async def init_http_session():
+    """Создать долгоживущую aiohttp-сессию с пулом keep-alive соединений"""
+    global _http_session
+    if _http_session is not None:
+        return
+
+    connector = aiohttp.TCPConnector(
+        limit=config.openai_max_connections,
+        keepalive_timeout=config.openai_keepalive_timeout,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=config.openai_request_timeout,
+        connect=config.openai_connect_timeout,
+    )
+    _http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def _use_http_session():
+    # openai==0.28 берет сессию из ContextVar openai.aiosession, иначе открывает новую на каждый запрос
+    if _http_session is not None:
+        openai.aiosession.set(_http_session)
+
+
+# tiktoken-кодировки по моделям (encoding_for_model заново строит кодировщик, поэтому кешируем)
+_encodings = {}
+
+
+def get_encoding(model):
+    if model not in _encodings:
+        _encodings[model] = tiktoken.encoding_for_model(model)
+    return _encodings[model]
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_text_tokens_cached(model, text):
+    # сообщения диалога пересчитываются при каждом запросе, поэтому счетчики по тексту кешируем
+    return len(get_encoding(model).encode(text))
+
+
+# оценка стоимости одного изображения в detail: high (512px-тайлы 1024x1024 + базовые токены)
+IMAGE_TOKENS_ESTIMATE = 765
+# в detail: low изображение всегда стоит фиксированные базовые токены
+IMAGE_TOKENS_ESTIMATE_LOW = 85
+
+
+def get_image_tokens_estimate(image_detail="high"):
+    return IMAGE_TOKENS_ESTIMATE_LOW if image_detail == "low" else IMAGE_TOKENS_ESTIMATE
+
+
+LANGUAGE_INSTRUCTIONS = {
+    "ru": "Отвечай ТОЛЬКО на русском языке. Будь дружелюбным и полезным помощником. Все твои ответы должны быть на русском языке, независимо от языка вопроса.",
+    "en": "Respond ONLY in English. Be a friendly and helpful assistant. All your responses should be in English, regardless of the question's language.",
+}
+
+# system prompt для каждой пары (chat_mode, language): prompt_start режима + правило языка
+SYSTEM_PROMPTS = {
+    (chat_mode, language): f"{chat_mode_dict['prompt_start'].rstrip()}\n\n{language_instruction}"
+    for chat_mode, chat_mode_dict in config.chat_modes.items() if "prompt_start" in chat_mode_dict
+    for language, language_instruction in LANGUAGE_INSTRUCTIONS.items()
+}
+
+# (chat_mode, language, encoding_name) -> количество токенов system prompt (заполняется в init_system_prompts)
+_system_prompt_n_tokens = {}
+
+
+def get_system_prompt(chat_mode, language="en"):
+    if language not in LANGUAGE_INSTRUCTIONS:
+        language = "en"
+    return SYSTEM_PROMPTS[(chat_mode, language)]
+
+
+def format_dialog_summary(dialog_summary):
+    return f"Summary of the earlier part of this conversation:\n{dialog_summary}"
+
+
+DIALOG_SUMMARY_PROMPT = (
+    "You compress chat history. Merge the previous summary (if any) and the new conversation turns into one concise summary. "
+    "Keep facts, names, numbers, decisions, user preferences and open questions; drop small talk. "
+    "Write in the same language as the conversation, in third person, as plain text without headings."
+)
+
+
+def get_system_prompt_n_tokens(chat_mode, language, model):
+    if language not in LANGUAGE_INSTRUCTIONS:
+        language = "en"
+
+    key = (chat_mode, language, get_encoding_name(model))
+    if key not in _system_prompt_n_tokens:
+        _system_prompt_n_tokens[key] = len(get_encoding(model).encode(SYSTEM_PROMPTS[(chat_mode, language)]))
+    return _system_prompt_n_tokens[key]
+
+
+def init_system_prompts():
+    """Посчитать токены всех system prompt для доступных текстовых моделей (вызывается при старте)"""
+    for model in config.models["available_text_models"]:
+        for chat_mode, language in SYSTEM_PROMPTS:
+            get_system_prompt_n_tokens(chat_mode, language, model)
+
+
+def get_encoding_name(model):
+    return tiktoken.encoding_name_for_model(model)
+
+
+def count_dialog_message_text_tokens(dialog_message, model):
+    """Токены текста пары user/bot без служебных токенов и изображений"""
+    n_tokens = _count_text_tokens_cached(model, dialog_message["bot"])
+    if isinstance(dialog_message["user"], list):
+        for part in dialog_message["user"]:
+            if part.get("type") == "text":
+                n_tokens += _count_text_tokens_cached(model, part["text"])
+    else:
+        n_tokens += _count_text_tokens_cached(model, dialog_message["user"])
+
+    return n_tokens
+
+
+def fill_dialog_token_counts(dialog_messages, model):
+    """Досчитать dialog_message["n_tokens"][<кодировка модели>] там, где его нет; возвращает индексы досчитанных сообщений"""
+    encoding_name = get_encoding_name(model)
+
+    filled_indices = []
+    for i, dialog_message in enumerate(dialog_messages):
+        n_tokens = dialog_message.setdefault("n_tokens", {})
+        if encoding_name not in n_tokens:
+            n_tokens[encoding_name] = count_dialog_message_text_tokens(dialog_message, model)
+            filled_indices.append(i)
+
+    return filled_indices
+
+
+def hash_dialog_context(dialog_messages, dialog_summary=None):
+    # date и n_tokens не влияют на ответ, в хеш идет только содержимое
+    context = [dialog_summary] + [[dialog_message["user"], dialog_message["bot"]] for dialog_message in dialog_messages]
+    return hashlib.sha256(json.dumps(context, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def get_message_key(message):
+    """Хешируемое каноническое представление сообщения: строка как есть, список частей - JSON"""
+    if isinstance(message, str):
+        return message
+    return json.dumps(message, ensure_ascii=False, sort_keys=True, default=str)
+
+
+class CompletionCache:
+    """LRU-кеш готовых ответов с TTL: ключ - (model, chat_mode, language, нормализованное сообщение, хеш контекста)"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, answer, n_first_dialog_messages_removed)
+
+        self.n_hits = 0
+        self.n_misses = 0
+
+    @staticmethod
+    def make_key(model, chat_mode, language, message, dialog_messages, dialog_summary=None):
+        normalized_message = " ".join(get_message_key(message).split()).casefold()
+        return model, chat_mode, language, normalized_message, hash_dialog_context(dialog_messages, dialog_summary)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self.entries.pop(key, None)
+            self.n_misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.n_hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key, answer, n_first_dialog_messages_removed):
+        self.entries[key] = (time.monotonic() + self.ttl, answer, n_first_dialog_messages_removed)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_stats(self):
+        return {"size": len(self.entries), "hits": self.n_hits, "misses": self.n_misses}
+
+
+completion_cache = CompletionCache(config.completion_cache_size, config.completion_cache_ttl) if config.enable_completion_cache else None
+
+
+class SharedStream:
+    """Один стрим OpenAI, раздаваемый всем одновременным подписчикам с одинаковым запросом.
+
+    Элементы стрима содержат весь ответ на текущий момент, поэтому подписчику достаточно последнего.
+    Когда уходит последний подписчик, запрос к OpenAI отменяется.
+    """
+
+    def __init__(self, source):
+        self.latest_item = None
+        self.n_items = 0
+        self.done = False
+        self.error = None
+        self.n_subscribers = 0
+
+        self.condition = asyncio.Condition()
+        self.task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for item in source:
+                async with self.condition:
+                    self.latest_item = item
+                    self.n_items += 1
+                    self.condition.notify_all()
+        except BaseException as e:
+            self.error = e
+        finally:
+            async with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    async def subscribe(self, zero_tokens=False):
+        self.n_subscribers += 1
+        try:
+            n_seen_items = 0
+            while True:
+                async with self.condition:
+                    await self.condition.wait_for(lambda: self.n_items > n_seen_items or self.done)
+                    item, n_items, done, error = self.latest_item, self.n_items, self.done, self.error
+
+                if n_items > n_seen_items:
+                    n_seen_items = n_items
+                    if zero_tokens:  # токены уже учтены у того, кто начал запрос
+                        status, answer, _, n_first_dialog_messages_removed = item
+                        item = status, answer, (0, 0), n_first_dialog_messages_removed
+                    yield item
+
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            self.n_subscribers -= 1
+            if self.n_subscribers == 0 and not self.done:
+                self.task.cancel()
+
+
+class OpenAIUnavailableError(Exception):
+    """Запрос не может быть выполнен сейчас: очередь лимитов переполнена, upstream недоступен или размыкатель открыт"""
+
+
+class ModelRateLimiter:
+    """Token bucket на модель: запросы и токены в минуту (rate_limits из models.yml).
+
+    Запрос заранее списывает оценку токенов (prompt + max_tokens), после ответа она сверяется с фактом.
+    Ожидающие обслуживаются по очереди, но не дольше max_wait.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+
+        self.queue_lock = asyncio.Lock()  # FIFO для ожидающих
+
+        self.n_waiting = 0
+        self.n_acquired = 0
+        self.n_rejected = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.updated_at) / 60
+        self.updated_at = now
+
+        self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed_minutes * self.requests_per_minute)
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed_minutes * self.tokens_per_minute)
+
+    async def acquire(self, n_tokens, max_wait):
+        """Списать запрос и n_tokens; возвращает фактически списанные токены - их же нужно передать в reconcile"""
+        n_tokens = min(n_tokens, self.tokens_per_minute)  # иначе запрос больше бюджета не пройдет никогда
+        started_at = time.monotonic()
+        deadline = started_at + max_wait
+
+        self.n_waiting += 1
+        try:
+            try:
+                await asyncio.wait_for(self.queue_lock.acquire(), timeout=max_wait)
+            except asyncio.TimeoutError:
+                self.n_rejected += 1
+                raise OpenAIUnavailableError("Rate limit queue wait exceeded") from None
+
+            try:
+                while True:
+                    self._refill()
+                    if self.available_requests >= 1 and self.available_tokens >= n_tokens:
+                        self.available_requests -= 1
+                        self.available_tokens -= n_tokens
+                        break
+
+                    delay = 60 * max(
+                        (1 - self.available_requests) / self.requests_per_minute,
+                        (n_tokens - self.available_tokens) / self.tokens_per_minute
+                    )
+                    if time.monotonic() + delay > deadline:
+                        self.n_rejected += 1
+                        raise OpenAIUnavailableError("Rate limit queue wait exceeded")
+
+                    await asyncio.sleep(delay)
+            finally:
+                self.queue_lock.release()
+        finally:
+            self.n_waiting -= 1
+
+        wait_time = time.monotonic() - started_at
+        self.n_acquired += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        return n_tokens
+
+    def reconcile(self, n_reserved_tokens, n_used_tokens):
+        self._refill()
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + n_reserved_tokens - n_used_tokens)
+
+    def get_stats(self):
+        return {
+            "queue_depth": self.n_waiting,
+            "available_requests": int(self.available_requests),
+            "available_tokens": int(self.available_tokens),
+            "acquired": self.n_acquired,
+            "rejected": self.n_rejected,
+            "avg_wait": round(self.total_wait_time / self.n_acquired, 3) if self.n_acquired else 0.0,
+            "max_wait": round(self.max_wait_time, 3),
+        }
+
+
+_rate_limiters = {}  # model -> ModelRateLimiter
+
+
+def get_rate_limiter(model):
+    """None, если для модели не заданы rate_limits"""
+    if model not in _rate_limiters:
+        rate_limits = config.models["info"].get(model, {}).get("rate_limits")
+        _rate_limiters[model] = ModelRateLimiter(**rate_limits) if rate_limits else None
+    return _rate_limiters[model]
+
+
+class CircuitBreaker:
+    """Размыкатель на модель: после failure_threshold ошибок upstream подряд запросы сразу отклоняются
+    на reset_timeout секунд, затем один пробный запрос решает, замкнуть ли цепь снова"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.n_consecutive_failures = 0
+        self.opened_at = 0.0
+        self.is_probe_in_flight = False
+
+        self.n_failures = 0
+        self.n_retries = 0
+        self.n_short_circuited = 0
+
+    def is_available(self):
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        if self.state == self.HALF_OPEN:
+            return not self.is_probe_in_flight
+        return True
+
+    def allow_request(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.is_probe_in_flight = False
+
+        if self.state == self.HALF_OPEN:
+            if self.is_probe_in_flight:
+                return False
+            self.is_probe_in_flight = True
+
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.n_consecutive_failures = 0
+        self.is_probe_in_flight = False
+
+    def record_failure(self):
+        self.n_failures += 1
+        self.n_consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.n_consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+        self.is_probe_in_flight = False
+
+    def release_probe(self):
+        self.is_probe_in_flight = False
+
+    def get_stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.n_consecutive_failures,
+            "failures": self.n_failures,
+            "retries": self.n_retries,
+            "short_circuited": self.n_short_circuited,
+        }
+
+
+_circuit_breakers = {}  # model -> CircuitBreaker
+
+
+def get_circuit_breaker(model):
+    if model not in _circuit_breakers:
+        _circuit_breakers[model] = CircuitBreaker(config.openai_breaker_failure_threshold, config.openai_breaker_reset_timeout)
+    return _circuit_breakers[model]
+
+
+def _is_transient_error(e):
+    """Ошибки, после которых тот же запрос может пройти: лимиты, таймауты, сеть и 5xx"""
+    if isinstance(e, (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                      openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return True
+    return isinstance(e, openai.error.APIError) and (e.http_status is None or e.http_status >= 500)
+
+
+def _get_retry_after(e):
+    try:
+        return float((e.headers or {}).get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def call_openai(model, request_fn, retry=True):
+    """Общая точка вызова OpenAI: размыкатель на модель и повторы с backoff для идемпотентных запросов.
+
+    request_fn - функция без аргументов, возвращающая корутину запроса (вызывается на каждую попытку).
+    Исчерпанные повторы и открытый размыкатель превращаются в OpenAIUnavailableError.
+    """
+    circuit_breaker = get_circuit_breaker(model)
+    n_attempts = config.openai_max_retries + 1 if retry else 1
+
+    for attempt in range(n_attempts):
+        if not circuit_breaker.allow_request():
+            circuit_breaker.n_short_circuited += 1
+            raise OpenAIUnavailableError(f"{model} is temporarily unavailable")
+
+        try:
+            result = await request_fn()
+        except openai.error.OpenAIError as e:
+            if not _is_transient_error(e):
+                circuit_breaker.record_success()  # upstream ответил, ошибка в самом запросе
+                raise
+
+            circuit_breaker.record_failure()
+            model_router.record_error(model)
+            if attempt == n_attempts - 1:
+                raise OpenAIUnavailableError(f"{model} request failed: {e}") from e
+
+            # полный jitter; Retry-After от сервера важнее, но ждать дольше openai_retry_max_delay не имеет смысла
+            delay = random.uniform(0, min(config.openai_retry_max_delay, config.openai_retry_base_delay * 2 ** attempt))
+            retry_after = _get_retry_after(e)
+            if retry_after is not None:
+                if retry_after > config.openai_retry_max_delay:
+                    raise OpenAIUnavailableError(f"{model} asked to retry after {retry_after}s") from e
+                delay = max(delay, retry_after)
+
+            circuit_breaker.n_retries += 1
+            logger.warning(f"OpenAI request to {model} failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        except BaseException:
+            circuit_breaker.release_probe()
+            raise
+        else:
+            circuit_breaker.record_success()
+            return result
+
+
+# модели, которые ChatGPT.send_message / send_message_stream отправляют через ChatCompletion и Completion;
+# роутер выбирает замену только среди них
+CHAT_COMPLETION_MODELS = ("gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4-1106-preview", "gpt-4-vision-preview")
+COMPLETION_MODELS = ("text-davinci-003",)
+TEXT_MODELS = CHAT_COMPLETION_MODELS + COMPLETION_MODELS
+
+# vision-модели в порядке предпочтения при замене деградировавшей модели
+VISION_MODELS = ("gpt-4o", "gpt-4-vision-preview")
+
+
+class ModelRouter:
+    """Скользящие метрики моделей за router_window_seconds (время до первого токена у стримов,
+    время полного ответа у запросов без стрима, доля ошибок) и выбор совместимой модели взамен деградировавшей.
+
+    Старые замеры выпадают из окна, поэтому модель, с которой ушел весь трафик, через окно снова считается здоровой.
+    """
+
+    def __init__(self):
+        self.samples = {}  # model -> deque[(timestamp, is_error, ttft, latency)]
+
+    def _get_samples(self, model):
+        samples = self.samples.setdefault(model, deque())
+        min_timestamp = time.monotonic() - config.router_window_seconds
+        while samples and samples[0][0] < min_timestamp:
+            samples.popleft()
+        return samples
+
+    def record_first_token(self, model, ttft):
+        """Стрим: первый чанк пришел через ttft секунд"""
+        self._get_samples(model).append((time.monotonic(), False, ttft, None))
+
+    def record_completion(self, model, latency):
+        """Запрос без стрима: весь ответ пришел через latency секунд"""
+        self._get_samples(model).append((time.monotonic(), False, None, latency))
+
+    def record_error(self, model):
+        self._get_samples(model).append((time.monotonic(), True, None, None))
+
+    async def track_stream(self, model, r_gen, started_at):
+        """Пропустить стрим насквозь, записав время до первого чанка"""
+        is_first_chunk = True
+        async for r_item in r_gen:
+            if is_first_chunk:
+                self.record_first_token(model, time.monotonic() - started_at)
+                is_first_chunk = False
+            yield r_item
+
+    def get_model_stats(self, model):
+        samples = self._get_samples(model)
+        n_errors = sum(is_error for _, is_error, _, _ in samples)
+        ttfts = sorted(ttft for _, _, ttft, _ in samples if ttft is not None)
+        latencies = sorted(latency for _, _, _, latency in samples if latency is not None)
+        return {
+            "n_samples": len(samples),
+            "error_rate": round(n_errors / len(samples), 3) if samples else 0.0,
+            "ttft_p50": round(statistics.median(ttfts), 3) if ttfts else None,
+            "ttft_p90": round(ttfts[int(0.9 * (len(ttfts) - 1))], 3) if ttfts else None,
+            "latency_p50": round(statistics.median(latencies), 3) if latencies else None,
+            "latency_p90": round(latencies[int(0.9 * (len(latencies) - 1))], 3) if latencies else None,
+        }
+
+    def is_degraded(self, model):
+        if not get_circuit_breaker(model).is_available():
+            return True
+
+        rate_limiter = get_rate_limiter(model)
+        if rate_limiter is not None and rate_limiter.n_waiting >= config.router_max_queue_depth:
+            return True
+
+        stats = self.get_model_stats(model)
+        if stats["n_samples"] < config.router_min_samples:
+            return False
+        if stats["error_rate"] > config.router_max_error_rate:
+            return True
+        if stats["ttft_p90"] is not None and stats["ttft_p90"] > config.router_max_ttft:
+            return True
+        return stats["latency_p90"] is not None and stats["latency_p90"] > config.router_max_latency
+
+    def choose_model(self, preferred_model, is_premium, with_image=False):
+        """preferred_model, если он здоров; иначе самая быстрая здоровая совместимая модель, доступная пользователю"""
+        if not self.is_degraded(preferred_model):
+            return preferred_model
+
+        if with_image:
+            candidate_models = VISION_MODELS
+        else:
+            candidate_models = [model for model in config.models["available_text_models"] if model in TEXT_MODELS]
+        preferred_type = config.models["info"][preferred_model]["type"]
+
+        fallback_models = [
+            model for model in candidate_models
+            if model != preferred_model
+            and model in config.models["info"]
+            and config.models["info"][model]["type"] == preferred_type
+            and (is_premium or model not in config.premium_models)
+            and not self.is_degraded(model)
+        ]
+        if not fallback_models:
+            return preferred_model
+
+        # модели без замеров идут после измеренных, порядок среди них - как в VISION_MODELS / available_text_models
+        def speed_key(model):
+            stats = self.get_model_stats(model)
+            return stats["ttft_p50"] or float("inf"), stats["latency_p50"] or float("inf")
+
+        return min(fallback_models, key=speed_key)
+
+
+model_router = ModelRouter()
+
+
+def get_openai_stats():
+    """Метрики очередей лимитов, размыкателей и кеша ответов для мониторинга"""
+    stats = {
+        "rate_limits": {model: limiter.get_stats() for model, limiter in _rate_limiters.items() if limiter is not None},
+        "circuit_breakers": {model: breaker.get_stats() for model, breaker in _circuit_breakers.items()},
+        "models": {model: model_router.get_model_stats(model) for model in model_router.samples},
+    }
+    if completion_cache is not None:
+        stats["completion_cache"] = completion_cache.get_stats()
+    return stats
+
+
+async def run_stats_logger():
+    """Периодически писать get_openai_stats() в лог"""
+    if not config.openai_stats_log_interval:
+        return
+
+    while True:
+        await asyncio.sleep(config.openai_stats_log_interval)
+        logger.info(f"OpenAI stats: {get_openai_stats()}")
+
+
+# запросы к OpenAI в полете: одинаковые одновременные запросы делят один ответ (single-flight)
+_inflight_streams = {}  # key -> SharedStream
+_inflight_requests = {}  # key -> asyncio.Task
+
+
 OPENAI_COMPLETION_OPTIONS = {
     "temperature": 0.7,
     "max_tokens": 1000,
     "top_p": 1,
     "frequency_penalty": 0,
     "presence_penalty": 0,
-    "request_timeout": 60.0,
+    "request_timeout": config.openai_request_timeout,
 }
 
 
 class ChatGPT:
     def __init__(self, model="gpt-3.5-turbo"):
-        assert model in {"text-davinci-003", "gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4-1106-preview", "gpt-4-vision-preview"}, f"Unknown model: {model}"
+        assert model in TEXT_MODELS, f"Unknown model: {model}"
         self.model = model
 
-    async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
-        if chat_mode not in config.chat_modes.keys():
-            raise ValueError(f"Chat mode {chat_mode} is not supported")
+    async def send_message(self, message, dialog_messages=[], chat_mode="assistant", language="en", dialog_summary=None):
+        """Одинаковые одновременные запросы выполняются один раз; токены получает только первый вызвавший"""
+        key = (self.model, chat_mode, language, get_message_key(message), hash_dialog_context(dialog_messages, dialog_summary))
 
-        n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4-1106-preview", "gpt-4-vision-preview"}:
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
+        task = _inflight_requests.get(key)
+        if task is not None:
+            answer, _, n_first_dialog_messages_removed = await asyncio.shield(task)
+            return answer, (0, 0), n_first_dialog_messages_removed
 
-                    r = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].message["content"]
-                elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r = await openai.Completion.acreate(
-                        engine=self.model,
-                        prompt=prompt,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].text
-                else:
-                    raise ValueError(f"Unknown model: {self.model}")
+        task = asyncio.create_task(self._send_message(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary))
+        _inflight_requests[key] = task
+        task.add_done_callback(lambda _: _inflight_requests.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant", language="en", dialog_summary=None):
+        """Одинаковые одновременные запросы делят один стрим; токены получает только первый подписчик"""
+        key = (self.model, chat_mode, language, get_message_key(message), hash_dialog_context(dialog_messages, dialog_summary))
+
+        shared_stream = _inflight_streams.get(key)
+        is_joined = shared_stream is not None
+        if not is_joined:
+            shared_stream = SharedStream(self._send_message_stream(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary))
+            _inflight_streams[key] = shared_stream
+            shared_stream.task.add_done_callback(lambda _: _inflight_streams.pop(key, None))
+
+        async for item in shared_stream.subscribe(zero_tokens=is_joined):
+            yield item
 
-                answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
+    async def _send_message(self, message, dialog_messages, chat_mode, language, dialog_summary=None):
+        if chat_mode not in config.chat_modes.keys():
+            raise ValueError(f"Chat mode {chat_mode} is not supported")
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        cache_key = None
+        if completion_cache is not None:
+            cache_key = completion_cache.make_key(self.model, chat_mode, language, message, dialog_messages, dialog_summary)
+            cached = completion_cache.get(cache_key)
+            if cached is not None:
+                answer, n_first_dialog_messages_removed = cached
+                return answer, (0, 0), n_first_dialog_messages_removed
 
-        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+        _use_http_session()
+
+        n_dialog_messages_before = len(dialog_messages)
+        dialog_messages = self._plan_dialog_messages(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+        n_reserved_tokens = await self._acquire_rate_limit(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+        n_input_tokens, n_output_tokens = 0, 0
+        try:
+            answer = None
+            while answer is None:
+                try:
+                    if self.model in CHAT_COMPLETION_MODELS:
+                        messages = self._generate_prompt_messages(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+
+                        started_at = time.monotonic()
+
+                        r = await call_openai(self.model, lambda: openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=messages,
+                            **OPENAI_COMPLETION_OPTIONS
+                        ))
+
+                        model_router.record_completion(self.model, time.monotonic() - started_at)
+                        answer = r.choices[0].message["content"]
+                    elif self.model in COMPLETION_MODELS:
+                        prompt = self._generate_prompt(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+                        started_at = time.monotonic()
+                        r = await call_openai(self.model, lambda: openai.Completion.acreate(
+                            engine=self.model,
+                            prompt=prompt,
+                            **OPENAI_COMPLETION_OPTIONS
+                        ))
+                        model_router.record_completion(self.model, time.monotonic() - started_at)
+                        answer = r.choices[0].text
+                    else:
+                        raise ValueError(f"Unknown model: {self.model}")
+
+                    answer = self._postprocess_answer(answer)
+                    n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
+                except openai.error.InvalidRequestError as e:  # too many tokens
+                    if len(dialog_messages) == 0:
+                        raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
+
+                    # forget first message in dialog_messages
+                    dialog_messages = dialog_messages[1:]
+
+            n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+        finally:
+            # при ошибке или отмене резерв возвращается в бакет, кроме уже потраченных токенов
+            self._reconcile_rate_limit(n_reserved_tokens, n_input_tokens + n_output_tokens)
+
+        if cache_key is not None:
+            completion_cache.put(cache_key, answer, n_first_dialog_messages_removed)
 
         return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
-    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
+    async def _send_message_stream(self, message, dialog_messages, chat_mode, language, dialog_summary=None):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
+        cache_key = None
+        if completion_cache is not None:
+            cache_key = completion_cache.make_key(self.model, chat_mode, language, message, dialog_messages, dialog_summary)
+            cached = completion_cache.get(cache_key)
+            if cached is not None:
+                # готовый ответ отдается тем же генератором, обработчик не отличает его от стрима
+                answer, n_first_dialog_messages_removed = cached
+                yield "finished", answer, (0, 0), n_first_dialog_messages_removed
+                return
+
+        _use_http_session()
+
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4","gpt-4o", "gpt-4-1106-preview"}:
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
+        dialog_messages = self._plan_dialog_messages(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+        n_reserved_tokens = await self._acquire_rate_limit(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+        n_input_tokens, n_output_tokens = 0, 0
+        try:
+            answer = None
+            while answer is None:
+                try:
+                    if self.model in CHAT_COMPLETION_MODELS:
+                        messages = self._generate_prompt_messages(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+
+                        started_at = time.monotonic()
+
+                        r_gen = await call_openai(self.model, lambda: openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=messages,
+                            stream=True,
+                            **OPENAI_COMPLETION_OPTIONS
+                        ))
+
+                        r_gen = model_router.track_stream(self.model, r_gen, started_at)
+
+                        # prompt считается один раз по сохраненным счетчикам, ответ - по приращениям
+                        n_input_tokens = self._count_prompt_tokens(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+                        n_output_tokens = 1
+                        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
-                    answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
+                        answer = ""
+                        async for r_item in r_gen:
+                            delta = r_item.choices[0].delta
 
-                        if "content" in delta:
-                            answer += delta.content
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
-                            n_first_dialog_messages_removed = 0
+                            if "content" in delta:
+                                answer += delta.content
+                                n_output_tokens += self._count_text_tokens(delta.content, model=self.model)
 
-                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                                yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
+                        n_output_tokens = self._count_output_tokens(answer, model=self.model)
 
-                elif self.model == "text-davinci-003":
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r_gen = await openai.Completion.acreate(
-                        engine=self.model,
-                        prompt=prompt,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
+                    elif self.model in COMPLETION_MODELS:
+                        prompt = self._generate_prompt(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary)
+                        started_at = time.monotonic()
+                        r_gen = await call_openai(self.model, lambda: openai.Completion.acreate(
+                            engine=self.model,
+                            prompt=prompt,
+                            stream=True,
+                            **OPENAI_COMPLETION_OPTIONS
+                        ))
+                        r_gen = model_router.track_stream(self.model, r_gen, started_at)
 
-                    answer = ""
-                    async for r_item in r_gen:
-                        answer += r_item.choices[0].text
-                        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
+                        n_input_tokens = self._count_text_tokens(prompt, model=self.model) + 1
+                        n_output_tokens = 0
                         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                        yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
-                answer = self._postprocess_answer(answer)
+                        answer = ""
+                        async for r_item in r_gen:
+                            answer += r_item.choices[0].text
+                            n_output_tokens += self._count_text_tokens(r_item.choices[0].text, model=self.model)
+                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                        n_output_tokens = self._count_text_tokens(answer, model=self.model)
+                    else:
+                        raise ValueError(f"Unknown model: {self.model}")
+
+                    answer = self._postprocess_answer(answer)
+
+                except openai.error.InvalidRequestError as e:  # too many tokens
+                    if len(dialog_messages) == 0:
+                        raise e
 
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise e
+                    # forget first message in dialog_messages
+                    dialog_messages = dialog_messages[1:]
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        finally:
+            # при ошибке или отмене резерв возвращается в бакет, кроме уже потраченных токенов
+            self._reconcile_rate_limit(n_reserved_tokens, n_input_tokens + n_output_tokens)
+
+        if cache_key is not None:
+            completion_cache.put(cache_key, answer, n_first_dialog_messages_removed)
 
         yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed  # sending final answer
 
@@ -132,42 +866,60 @@ class ChatGPT:
         message,
         dialog_messages=[],
         chat_mode="assistant",
+        language="en",
         image_buffer: BytesIO = None,
+        dialog_summary=None,
+        image_detail="high",
     ):
+        _use_http_session()
+
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model == "gpt-4-vision-preview" or self.model == "gpt-4o":
-                    messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
-                    )
-                    r = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].message.content
-                else:
-                    raise ValueError(f"Unsupported model: {self.model}")
-
-                answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = (
-                    r.usage.prompt_tokens,
-                    r.usage.completion_tokens,
-                )
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError(
-                        "Dialog messages is reduced to zero, but still has too many tokens to make completion"
-                    ) from e
-
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
-
-        n_first_dialog_messages_removed = n_dialog_messages_before - len(
-            dialog_messages
+        dialog_messages = self._plan_dialog_messages(
+            message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary, image_detail=image_detail if image_buffer is not None else None
         )
+        n_reserved_tokens = await self._acquire_rate_limit(
+            message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary, image_detail=image_detail if image_buffer is not None else None
+        )
+        n_input_tokens, n_output_tokens = 0, 0
+        try:
+            answer = None
+            while answer is None:
+                try:
+                    if self.model == "gpt-4-vision-preview" or self.model == "gpt-4o":
+                        messages = self._generate_prompt_messages(
+                            message, dialog_messages, chat_mode, language, image_buffer, dialog_summary=dialog_summary, image_detail=image_detail
+                        )
+                        started_at = time.monotonic()
+                        r = await call_openai(self.model, lambda: openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=messages,
+                            **OPENAI_COMPLETION_OPTIONS
+                        ))
+                        model_router.record_completion(self.model, time.monotonic() - started_at)
+                        answer = r.choices[0].message.content
+                    else:
+                        raise ValueError(f"Unsupported model: {self.model}")
+
+                    answer = self._postprocess_answer(answer)
+                    n_input_tokens, n_output_tokens = (
+                        r.usage.prompt_tokens,
+                        r.usage.completion_tokens,
+                    )
+                except openai.error.InvalidRequestError as e:  # too many tokens
+                    if len(dialog_messages) == 0:
+                        raise ValueError(
+                            "Dialog messages is reduced to zero, but still has too many tokens to make completion"
+                        ) from e
+
+                    # forget first message in dialog_messages
+                    dialog_messages = dialog_messages[1:]
+
+            n_first_dialog_messages_removed = n_dialog_messages_before - len(
+                dialog_messages
+            )
+        finally:
+            # при ошибке или отмене резерв возвращается в бакет, кроме уже потраченных токенов
+            self._reconcile_rate_limit(n_reserved_tokens, n_input_tokens + n_output_tokens)
 
         return (
             answer,
@@ -180,60 +932,91 @@ class ChatGPT:
         message,
         dialog_messages=[],
         chat_mode="assistant",
+        language="en",
         image_buffer: BytesIO = None,
+        dialog_summary=None,
+        image_detail="high",
     ):
-        n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model == "gpt-4-vision-preview" or self.model == "gpt-4o":
-                    messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
-                    )
-
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS,
-                    )
+        _use_http_session()
 
-                    answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
-                        if "content" in delta:
-                            answer += delta.content
-                            (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ) = self._count_tokens_from_messages(
-                                messages, answer, model=self.model
-                            )
-                            n_first_dialog_messages_removed = (
-                                n_dialog_messages_before - len(dialog_messages)
-                            )
-                            yield "not_finished", answer, (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ), n_first_dialog_messages_removed
-
-                answer = self._postprocess_answer(answer)
-
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise e
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        n_dialog_messages_before = len(dialog_messages)
+        dialog_messages = self._plan_dialog_messages(
+            message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary, image_detail=image_detail if image_buffer is not None else None
+        )
+        n_reserved_tokens = await self._acquire_rate_limit(
+            message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary, image_detail=image_detail if image_buffer is not None else None
+        )
+        n_input_tokens, n_output_tokens = 0, 0
+        try:
+            answer = None
+            while answer is None:
+                try:
+                    if self.model == "gpt-4-vision-preview" or self.model == "gpt-4o":
+                        messages = self._generate_prompt_messages(
+                            message, dialog_messages, chat_mode, language, image_buffer, dialog_summary=dialog_summary, image_detail=image_detail
+                        )
+
+                        started_at = time.monotonic()
+
+                        r_gen = await call_openai(self.model, lambda: openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=messages,
+                            stream=True,
+                            **OPENAI_COMPLETION_OPTIONS,
+                        ))
+
+                        r_gen = model_router.track_stream(self.model, r_gen, started_at)
+
+                        # prompt считается один раз по сохраненным счетчикам, ответ - по приращениям
+                        n_input_tokens = self._count_prompt_tokens(
+                            message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary, image_detail=image_detail if image_buffer is not None else None
+                        )
+                        n_output_tokens = 1
+                        n_first_dialog_messages_removed = (
+                            n_dialog_messages_before - len(dialog_messages)
+                        )
+
+                        answer = ""
+                        async for r_item in r_gen:
+                            delta = r_item.choices[0].delta
+                            if "content" in delta:
+                                answer += delta.content
+                                n_output_tokens += self._count_text_tokens(
+                                    delta.content, model=self.model
+                                )
+                                yield "not_finished", answer, (
+                                    n_input_tokens,
+                                    n_output_tokens,
+                                ), n_first_dialog_messages_removed
+
+                        n_output_tokens = self._count_output_tokens(
+                            answer, model=self.model
+                        )
+
+                    answer = self._postprocess_answer(answer)
+
+                except openai.error.InvalidRequestError as e:  # too many tokens
+                    if len(dialog_messages) == 0:
+                        raise e
+                    # forget first message in dialog_messages
+                    dialog_messages = dialog_messages[1:]
+
+        finally:
+            # при ошибке или отмене резерв возвращается в бакет, кроме уже потраченных токенов
+            self._reconcile_rate_limit(n_reserved_tokens, n_input_tokens + n_output_tokens)
 
         yield "finished", answer, (
             n_input_tokens,
             n_output_tokens,
         ), n_first_dialog_messages_removed
 
-    def _generate_prompt(self, message, dialog_messages, chat_mode):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
+    def _generate_prompt(self, message, dialog_messages, chat_mode, language="en", dialog_summary=None):
+        prompt = get_system_prompt(chat_mode, language)
         prompt += "\n\n"
 
+        if dialog_summary:
+            prompt += format_dialog_summary(dialog_summary) + "\n\n"
+
         # add chat context
         if len(dialog_messages) > 0:
             prompt += "Chat:\n"
@@ -250,13 +1033,13 @@ class ChatGPT:
     def _encode_image(self, image_buffer: BytesIO) -> bytes:
         return base64.b64encode(image_buffer.read()).decode("utf-8")
 
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
-
-        messages = [{"role": "system", "content": prompt}]
+    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, language="en", image_buffer: BytesIO = None, dialog_summary=None, image_detail="high"):
+        messages = [{"role": "system", "content": get_system_prompt(chat_mode, language)}]
+        if dialog_summary:
+            messages.append({"role": "system", "content": format_dialog_summary(dialog_summary)})
 
         for dialog_message in dialog_messages:
-            messages.append({"role": "user", "content": dialog_message["user"]})
+            messages.append({"role": "user", "content": self._prepare_dialog_content(dialog_message["user"])})
             messages.append({"role": "assistant", "content": dialog_message["bot"]})
 
         if image_buffer is not None:
@@ -273,7 +1056,7 @@ class ChatGPT:
                             "image_url" : {
 
                                 "url": f"data:image/jpeg;base64,{self._encode_image(image_buffer)}",
-                                "detail":"high"
+                                "detail": image_detail
                             }
                         }
                     ]
@@ -285,13 +1068,101 @@ class ChatGPT:
 
         return messages
 
+    def _prepare_dialog_content(self, content):
+        """Привести сохраненное сообщение к формату OpenAI: base64-изображения -> image_url (только для vision-моделей)"""
+        if not isinstance(content, list):
+            return content
+
+        prepared_content = []
+        for part in content:
+            if part.get("type") == "image":
+                if "image" not in part or self.model not in {"gpt-4-vision-preview", "gpt-4o"}:
+                    continue  # изображение не загружено или модель его не поддерживает
+                part = {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/jpeg;base64,{part['image']}", "detail": part.get("detail", "high")}
+                }
+            prepared_content.append(part)
+
+        return prepared_content
+
+    async def _acquire_rate_limit(self, message, dialog_messages, chat_mode, language="en", dialog_summary=None, image_detail=None):
+        """Дождаться места в лимитах модели; возвращает списанную оценку токенов"""
+        rate_limiter = get_rate_limiter(self.model)
+        if rate_limiter is None:
+            return 0
+
+        n_reserved_tokens = self._count_prompt_tokens(message, dialog_messages, chat_mode, language, dialog_summary=dialog_summary, image_detail=image_detail)
+        n_reserved_tokens += OPENAI_COMPLETION_OPTIONS["max_tokens"]
+        return await rate_limiter.acquire(n_reserved_tokens, config.openai_max_queue_wait)
+
+    def _reconcile_rate_limit(self, n_reserved_tokens, n_used_tokens):
+        rate_limiter = get_rate_limiter(self.model)
+        if rate_limiter is not None:
+            rate_limiter.reconcile(n_reserved_tokens, n_used_tokens)
+
+    def _plan_dialog_messages(self, message, dialog_messages, chat_mode, language="en", dialog_summary=None, image_detail=None):
+        """Самый длинный хвост dialog_messages, который вместе с ответом помещается в контекстное окно модели.
+
+        Перебор с InvalidRequestError остается страховкой на случай неточной оценки.
+        """
+        n_available_tokens = config.models["info"][self.model]["context_window"] - OPENAI_COMPLETION_OPTIONS["max_tokens"]
+        n_available_tokens -= self._count_prompt_tokens(message, [], chat_mode, language, dialog_summary=dialog_summary, image_detail=image_detail)
+
+        n_dialog_tokens = 0
+        n_fitting_dialog_messages = 0
+        for dialog_message in reversed(dialog_messages):
+            n_dialog_tokens += self._count_dialog_message_tokens(dialog_message)
+            if n_dialog_tokens > n_available_tokens:
+                break
+            n_fitting_dialog_messages += 1
+
+        return dialog_messages[len(dialog_messages) - n_fitting_dialog_messages:]
+
+    def _count_prompt_tokens(self, message, dialog_messages, chat_mode, language="en", dialog_summary=None, image_detail=None):
+        """Оценка входных токенов запроса: служебная часть + сохраненные счетчики сообщений диалога"""
+        if self.model == "text-davinci-003":
+            n_tokens = self._count_text_tokens(self._generate_prompt(message, [], chat_mode, language, dialog_summary=dialog_summary), model=self.model) + 1
+        else:
+            # system + текущее сообщение пользователя + 2 токена на ответ
+            tokens_per_message, _ = self._get_tokens_per_message(self.model)
+            n_tokens = 2 * tokens_per_message + get_system_prompt_n_tokens(chat_mode, language, self.model)
+            n_tokens += self._count_text_tokens(message, model=self.model) + 2
+            if dialog_summary:
+                n_tokens += tokens_per_message + self._count_text_tokens(format_dialog_summary(dialog_summary), model=self.model)
+            if image_detail is not None:
+                n_tokens += get_image_tokens_estimate(image_detail)
+
+        for dialog_message in dialog_messages:
+            n_tokens += self._count_dialog_message_tokens(dialog_message)
+
+        return n_tokens
+
+    def _count_dialog_message_tokens(self, dialog_message):
+        """Токены, которые пара user/bot добавляет в prompt"""
+        if self.model == "text-davinci-003":
+            return self._count_text_tokens(f"User: {dialog_message['user']}\nAssistant: {dialog_message['bot']}\n", model=self.model)
+
+        tokens_per_message, _ = self._get_tokens_per_message(self.model)
+
+        n_text_tokens = dialog_message.get("n_tokens", {}).get(get_encoding_name(self.model))
+        if n_text_tokens is None:
+            n_text_tokens = count_dialog_message_text_tokens(dialog_message, self.model)
+
+        n_image_tokens = 0
+        if isinstance(dialog_message["user"], list) and self.model in {"gpt-4-vision-preview", "gpt-4o"}:
+            n_image_tokens = sum(
+                get_image_tokens_estimate(part.get("detail", "high"))
+                for part in dialog_message["user"] if part.get("type") == "image" and "image" in part
+            )
+
+        return 2 * tokens_per_message + n_text_tokens + n_image_tokens
+
     def _postprocess_answer(self, answer):
         answer = answer.strip()
         return answer
 
-    def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
-        encoding = tiktoken.encoding_for_model(model)
-
+    def _get_tokens_per_message(self, model):
         if model == "gpt-3.5-turbo-16k":
             tokens_per_message = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
             tokens_per_name = -1  # if there's a name, the role is omitted
@@ -313,52 +1184,128 @@ class ChatGPT:
         else:
             raise ValueError(f"Unknown model: {model}")
 
-        # input
-        n_input_tokens = 0
-        for message in messages:
-            n_input_tokens += tokens_per_message
-            if isinstance(message["content"], list):
-                for sub_message in message["content"]:
-                    if "type" in sub_message:
-                        if sub_message["type"] == "text":
-                            n_input_tokens += len(encoding.encode(sub_message["text"]))
-                        elif sub_message["type"] == "image_url":
-                            pass
-            else:
-                if "type" in message:
-                    if message["type"] == "text":
-                        n_input_tokens += len(encoding.encode(message["text"]))
-                    elif message["type"] == "image_url":
-                        pass
+        return tokens_per_message, tokens_per_name
 
+    def _count_text_tokens(self, text, model="gpt-3.5-turbo"):
+        return _count_text_tokens_cached(model, text)
 
-        n_input_tokens += 2
+    def _count_output_tokens(self, answer, model="gpt-3.5-turbo"):
+        return 1 + self._count_text_tokens(answer, model=model)
 
-        # output
-        n_output_tokens = 1 + len(encoding.encode(answer))
 
-        return n_input_tokens, n_output_tokens
+async def summarize_dialog(dialog_messages, previous_summary=None, model=None):
+    """Сжать сообщения диалога вместе с предыдущим резюме в одно резюме (дешевой моделью, без стрима)"""
+    model = model or config.dialog_summary_model
+    _use_http_session()
 
-    def _count_tokens_from_prompt(self, prompt, answer, model="text-davinci-003"):
-        encoding = tiktoken.encoding_for_model(model)
+    transcript = ""
+    if previous_summary:
+        transcript += f"Previous summary:\n{previous_summary}\n\nNew turns:\n"
+    for dialog_message in dialog_messages:
+        if isinstance(dialog_message["user"], list):
+            user_text = " ".join(part["text"] for part in dialog_message["user"] if part.get("type") == "text")
+        else:
+            user_text = dialog_message["user"]
+        transcript += f"User: {user_text}\nAssistant: {dialog_message['bot']}\n"
+
+    messages = [
+        {"role": "system", "content": DIALOG_SUMMARY_PROMPT},
+        {"role": "user", "content": transcript}
+    ]
+
+    rate_limiter = get_rate_limiter(model)
+    if rate_limiter is not None:
+        n_reserved_tokens = len(get_encoding(model).encode(transcript)) + config.dialog_summary_max_tokens
+        n_reserved_tokens = await rate_limiter.acquire(n_reserved_tokens, config.openai_max_queue_wait)
+
+    n_input_tokens, n_output_tokens = 0, 0
+    try:
+        r = await call_openai(model, lambda: openai.ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            temperature=0,
+            max_tokens=config.dialog_summary_max_tokens,
+            request_timeout=config.openai_request_timeout
+        ))
+        n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
+    finally:
+        if rate_limiter is not None:
+            rate_limiter.reconcile(n_reserved_tokens, n_input_tokens + n_output_tokens)
+
+    return r.choices[0].message["content"].strip(), (n_input_tokens, n_output_tokens)
 
-        n_input_tokens = len(encoding.encode(prompt)) + 1
-        n_output_tokens = len(encoding.encode(answer))
 
-        return n_input_tokens, n_output_tokens
+async def transcribe_audio(audio_file) -> str:
+    _use_http_session()
 
+    def request():
+        audio_file.seek(0)  # файл перечитывается при каждой попытке
+        return openai.Audio.atranscribe("whisper-1", audio_file)
 
-async def transcribe_audio(audio_file) -> str:
-    r = await openai.Audio.atranscribe("whisper-1", audio_file)
+    r = await call_openai("whisper", request)
     return r["text"] or ""
 
 
+# общий на все голосовые сообщения лимит одновременных запросов к whisper (создается в event loop)
+_transcription_semaphore = None
+
+
+async def transcribe_audio_chunks(chunks, on_progress=None):
+    """Распознать куски одного голосового сообщения параллельно и склеить текст в исходном порядке.
+
+    Возвращает (текст, номера нераспознанных кусков с 1): ошибка одного куска не отменяет остальные,
+    исключение пробрасывается, только если не распознан ни один кусок.
+    on_progress(n_done, n_total) вызывается после каждого завершенного куска, в том числе неудачного.
+    """
+    global _transcription_semaphore
+    if _transcription_semaphore is None:
+        _transcription_semaphore = asyncio.Semaphore(config.voice_max_parallel_chunks)
+
+    n_done = 0
+
+    async def transcribe_chunk(i, chunk):
+        nonlocal n_done
+        audio_file = BytesIO(chunk)
+        audio_file.name = f"voice_{i}.oga"  # file extension is required
+        try:
+            async with _transcription_semaphore:
+                result = await transcribe_audio(audio_file)
+        except Exception as e:
+            logger.warning(f"Failed to transcribe voice chunk {i + 1}/{len(chunks)}: {e.__class__.__name__}: {e}")
+            result = e
+
+        n_done += 1
+        if on_progress is not None:
+            try:
+                await on_progress(n_done, len(chunks))
+            except Exception as e:  # прогресс - только индикация, из-за него распознанный текст не теряется
+                logger.warning(f"Failed to report voice transcription progress: {e.__class__.__name__}: {e}")
+        return result
+
+    tasks = [asyncio.ensure_future(transcribe_chunk(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:  # при отмене обработчика куски не нужны
+            task.cancel()
+
+    failed_chunks = [i + 1 for i, result in enumerate(results) if isinstance(result, Exception)]
+    if len(failed_chunks) == len(results):
+        raise results[0]
+
+    text = " ".join(result.strip() for result in results if isinstance(result, str) and result.strip())
+    return text, failed_chunks
+
+
 async def generate_images(prompt, n_images=4, size="512x512"):
-    r = await openai.Image.acreate(prompt=prompt, n=n_images, size=size)
+    _use_http_session()
+    # генерация оплачивается за каждое изображение, поэтому без повторов
+    r = await call_openai("dalle-2", lambda: openai.Image.acreate(prompt=prompt, n=n_images, size=size), retry=False)
     image_urls = [item.url for item in r.data]
     return image_urls
 
 
 async def is_content_acceptable(prompt):
-    r = await openai.Moderation.acreate(input=prompt)
+    _use_http_session()
+    r = await call_openai("moderation", lambda: openai.Moderation.acreate(input=prompt))
     return not all(r.results[0].categories.values())
@@ -0,0 +1,57 @@
+# request_context.py - Снапшот пользователя/группы/подписки на время обработки одного update
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional, Any
+
+_current_request = ContextVar("current_request", default=None)
+
+
+class RequestContext:
+    """Документы пользователя, группы и активная подписка, загруженные один раз на update.
+
+    Чтения отвечаются из памяти, записи копятся в user_updates/group_updates
+    и сбрасываются одним update_one на документ в Database.flush_request_context.
+    """
+
+    def __init__(self, user_id: int, chat_id: int, user_dict: Optional[dict], group_dict: Optional[dict], subscription: Optional[dict]):
+        self.user_id = user_id
+        self.chat_id = chat_id
+
+        self.user_dict = user_dict
+        self.group_dict = group_dict
+        self.subscription = subscription
+
+        self.user_updates = {}
+        self.group_updates = {}
+
+    def has_user(self, user_id: int) -> bool:
+        return self.user_dict is not None and user_id == self.user_id
+
+    def has_group(self, group_id: int) -> bool:
+        return self.group_dict is not None and group_id == self.chat_id
+
+    def set_user_attribute(self, key: str, value: Any, pending: bool = True):
+        self.user_dict[key] = value
+        if pending:
+            self.user_updates[key] = value
+
+    def set_group_attribute(self, key: str, value: Any, pending: bool = True):
+        self.group_dict[key] = value
+        if pending:
+            self.group_updates[key] = value
+
+    def is_premium(self) -> bool:
+        return self.subscription is not None and self.subscription["expires_at"] > datetime.now()
+
+
+def get_current() -> Optional[RequestContext]:
+    """Текущий снапшот (None вне обработчика update)"""
+    return _current_request.get()
+
+
+def activate(request: RequestContext):
+    return _current_request.set(request)
+
+
+def deactivate(token):
+    _current_request.reset(token)
@@ -1,5 +1,4 @@
 # subscription_handlers.py - Обработчики подписок и платежей
-import uuid
 from datetime import datetime, timedelta
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -26,16 +25,12 @@ async def show_premium_plans_handle(update: Update, context: CallbackContext, db
         send_method = update.callback_query.edit_message_text
         await update.callback_query.answer()
 
-    is_premium = db.get_user_subscription_status(user_id)
+    is_premium = await db.get_user_subscription_status(user_id)
 
     text = "💎 <b>Premium подписка</b>\n\n"
 
     if is_premium:
-        subscription = db.db["subscriptions"].find_one({
-            "user_id": user_id,
-            "status": "active",
-            "expires_at": {"$gt": datetime.now()}
-        })
+        subscription = await db.get_user_subscription_info(user_id)
         text += f"✅ У вас активна подписка до {subscription['expires_at'].strftime('%d.%m.%Y')}\n\n"
 
     text += "<b>Возможности Premium:</b>\n"
@@ -71,10 +66,10 @@ async def show_usage_stats_handle(update: Update, context: CallbackContext, db):
 
     user_id = query.from_user.id
     chat_id = query.message.chat.id
-    is_premium = db.get_user_subscription_status(user_id)
+    is_premium = await db.get_user_subscription_status(user_id)
 
-    daily_messages = db.get_daily_usage(user_id, "messages")
-    daily_images = db.get_daily_usage(user_id, "images")
+    daily_messages = await db.get_daily_usage(user_id, "messages")
+    daily_images = await db.get_daily_usage(user_id, "images")
 
     text = "📊 <b>Ваше использование сегодня:</b>\n\n"
 
@@ -87,11 +82,7 @@ async def show_usage_stats_handle(update: Update, context: CallbackContext, db):
     text += f"🎨 Изображения: {daily_images}/{max_images}\n\n"
 
     if is_premium:
-        subscription = db.db["subscriptions"].find_one({
-            "user_id": user_id,
-            "status": "active",
-            "expires_at": {"$gt": datetime.now()}
-        })
+        subscription = await db.get_user_subscription_info(user_id)
         text += f"💎 Premium до: {subscription['expires_at'].strftime('%d.%m.%Y')}"
     else:
         text += "🆓 Бесплатный план"
@@ -114,34 +105,12 @@ async def buy_premium_handle(update: Update, context: CallbackContext, db):
         duration_days = 365
         plan_name = "Premium Yearly"
 
-    # Создаем подписку без реального платежа
-    subscription_id = str(uuid.uuid4())
+    # Создаем подписку без реального платежа (тестовый платеж)
+    subscription_id = await db.create_subscription(user_id, f"premium_{plan_type}", duration_days)
     expires_at = datetime.now() + timedelta(days=duration_days)
 
-    subscription = {
-        "_id": subscription_id,
-        "user_id": user_id,
-        "plan": f"premium_{plan_type}",
-        "status": "active",
-        "created_at": datetime.now(),
-        "expires_at": expires_at,
-        "payment_id": "test_payment"  # Тестовый платеж
-    }
-
-    db.db["subscriptions"].insert_one(subscription)
-
     # Записываем тестовый платеж
-    payment_record = {
-        "_id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "amount": 25 if plan_type == "monthly" else 200,
-        "currency": "TJS",
-        "subscription_id": subscription_id,
-        "telegram_payment_id": "test_charge_id",
-        "created_at": datetime.now()
-    }
-
-    db.db["payments"].insert_one(payment_record)
+    await db.record_payment(user_id, 25 if plan_type == "monthly" else 200, "TJS", subscription_id)
 
     # Уведомляем пользователя
     text = f"🎉 <b>Premium активирован!</b>\n\n"
@@ -169,34 +138,23 @@ async def successful_payment_callback(update: Update, context: CallbackContext,
     # Определяем тип подписки
     duration_days = 30 if payment.invoice_payload == "premium_monthly" else 365
 
-    # Создаем подписку
-    subscription_id = str(uuid.uuid4())
+    # Создаем подписку (кеш статуса подписки обновляется внутри create_subscription)
+    subscription_id = await db.create_subscription(
+        user_id,
+        payment.invoice_payload,
+        duration_days,
+        payment_id=payment.telegram_payment_charge_id
+    )
     expires_at = datetime.now() + timedelta(days=duration_days)
 
-    subscription = {
-        "_id": subscription_id,
-        "user_id": user_id,
-        "plan": payment.invoice_payload,
-        "status": "active",
-        "created_at": datetime.now(),
-        "expires_at": expires_at,
-        "payment_id": payment.telegram_payment_charge_id
-    }
-
-    db.db["subscriptions"].insert_one(subscription)
-
     # Записываем платеж
-    payment_record = {
-        "_id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "amount": payment.total_amount / 100,
-        "currency": payment.currency,
-        "subscription_id": subscription_id,
-        "telegram_payment_id": payment.telegram_payment_charge_id,
-        "created_at": datetime.now()
-    }
-
-    db.db["payments"].insert_one(payment_record)
+    await db.record_payment(
+        user_id,
+        payment.total_amount / 100,
+        payment.currency,
+        subscription_id,
+        telegram_payment_id=payment.telegram_payment_charge_id
+    )
 
     # Уведомляем пользователя
     text = f"🎉 <b>Premium активирован!</b>\n\n"
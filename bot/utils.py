@@ -1,9 +1,36 @@
 # utils.py - Вспомогательные функции с поддержкой групп
 import asyncio
-from datetime import datetime
 from telegram import Update, User
 from telegram.ext import CallbackContext
-import config
+import request_context
+
+def with_request_context(handler, db, is_addressed_to_bot=None):
+    """Обернуть обработчик: снапшот пользователя/группы загружается один раз на update,
+    накопленные изменения записываются после завершения обработчика.
+
+    is_addressed_to_bot(update, context) - проверка без обращения к базе; если она вернула False
+    (сообщение в группе без упоминания бота), обработчик вызывается без снапшота и сам выходит.
+    """
+    async def wrapper(update: Update, context: CallbackContext):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context, db)
+
+        if is_addressed_to_bot is not None and not await is_addressed_to_bot(update, context):
+            return await handler(update, context, db)
+
+        chat_id = update.effective_chat.id if update.effective_chat else user.id
+        request = await db.load_request_context(user.id, chat_id)
+        token = request_context.activate(request)
+        try:
+            return await handler(update, context, db)
+        finally:
+            try:
+                await db.flush_request_context(request)
+            finally:
+                request_context.deactivate(token)
+
+    return wrapper
 
 async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User, db):
     """Регистрация пользователя если не существует"""
@@ -16,40 +43,16 @@ async def register_user_if_not_exists(update: Update, context: CallbackContext,
     else:
         chat_id = user.id  # fallback
 
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
-            user.id,
-            chat_id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
-        db.start_new_dialog(user.id, chat_id)
-
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id, chat_id)
-
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(user.id, "current_model", config.default_model)  # Используем из env
-
-    # back compatibility for n_used_tokens field
-    n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
-    if isinstance(n_used_tokens, int) or isinstance(n_used_tokens, float):  # old format
-        new_n_used_tokens = {
-            "gpt-3.5-turbo": {
-                "n_input_tokens": 0,
-                "n_output_tokens": n_used_tokens
-            }
-        }
-        db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
-
-    # voice message transcription
-    if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
-        db.set_user_attribute(user.id, "n_transcribed_seconds", 0.0)
-
-    # image generation
-    if db.get_user_attribute(user.id, "n_generated_images") is None:
-        db.set_user_attribute(user.id, "n_generated_images", 0)
+    user_dict = await db.register_user(
+        user.id,
+        chat_id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name
+    )
+
+    if user_dict.get("current_dialog_id") is None:
+        await db.start_new_dialog(user.id, chat_id)
 
 async def register_group_if_not_exists(update: Update, context: CallbackContext, db):
     """Регистрация группы если не существует (без изменения администратора)"""
@@ -69,13 +72,13 @@ async def register_group_if_not_exists(update: Update, context: CallbackContext,
     group_id = chat.id
     group_title = chat.title or "Unknown Group"
 
-    if not db.check_if_group_exists(group_id):
+    if not await db.check_if_group_exists(group_id):
         # Если группы нет в базе, создаем без администратора
         # Администратор должен быть установлен через my_chat_member_handler
-        db.add_new_group(group_id, group_title, admin_id=None)
+        await db.add_new_group(group_id, group_title, admin_id=None)
     else:
         # Обновляем время последнего взаимодействия
-        db.set_group_attribute(group_id, "last_interaction", datetime.now())
+        db.update_group_last_interaction(group_id)
 
 async def check_group_admin_rights(update: Update, context: CallbackContext, db) -> bool:
     """Проверить права администратора группы (только тот, кто добавил бота)"""
@@ -93,12 +96,12 @@ async def check_group_admin_rights(update: Update, context: CallbackContext, db)
         return True
 
     # Проверяем, является ли пользователь тем, кто добавил бота в группу
-    group_admin_id = db.get_group_attribute(chat_id, "admin_id")
+    group_admin_id = await db.get_group_attribute(chat_id, "admin_id")
 
     # Если администратор не установлен, временно разрешаем первому пользователю
     if group_admin_id is None:
         # Устанавливаем текущего пользователя как администратора
-        db.set_group_admin_id(chat_id, user_id)
+        await db.set_group_admin_id(chat_id, user_id)
         return True
 
     return group_admin_id == user_id
@@ -123,7 +126,7 @@ async def send_admin_rights_error(update: Update, context: CallbackContext, db):
         reply_method = lambda text, **kwargs: update.callback_query.answer(text, show_alert=True)
 
     # Получаем информацию о том, кто добавил бота
-    admin_id = db.get_group_admin_id(chat_id)
+    admin_id = await db.get_group_admin_id(chat_id)
 
     try:
         admin_info = await context.bot.get_chat_member(chat_id, admin_id)
@@ -133,5 +136,5 @@ async def send_admin_rights_error(update: Update, context: CallbackContext, db):
     except:
         admin_name = f"ID: {admin_id}"
 
-    error_text = t(user_id, "group_admin_only_with_name", chat_id=chat_id, admin_name=admin_name)
+    error_text = await t(user_id, "group_admin_only_with_name", chat_id=chat_id, admin_name=admin_name)
     await reply_method(error_text)
@@ -0,0 +1,30 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+CONFIG_DIR = ROOT_DIR / "config"
+
+# модули бота импортируются так же, как при запуске из bot/
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+
+# конфиг из примеров во временном каталоге: рабочее дерево и локальный config/config.yml не трогаются
+_test_config_dir = Path(tempfile.mkdtemp(prefix="bot-config-"))
+for name, source_name in (
+    ("config.yml", "config.example.yml"),
+    ("config.env", "config.example.env"),
+    ("chat_modes.yml", "chat_modes.yml"),
+    ("models.yml", "models.yml"),
+):
+    shutil.copy(CONFIG_DIR / source_name, _test_config_dir / name)
+os.environ["BOT_CONFIG_DIR"] = str(_test_config_dir)
+
+import config  # noqa: E402
+
+config.storage_backend = "memory"
+
+
+def pytest_unconfigure():
+    shutil.rmtree(_test_config_dir, ignore_errors=True)
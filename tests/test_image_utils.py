@@ -0,0 +1,21 @@
+"""Выбор detail по подписи: слова целиком, русские - в любой форме"""
+import pytest
+
+import config
+import image_utils
+
+
+@pytest.mark.parametrize("caption, detail", [
+    ("Please read the text", "high"),
+    ("show me the details", "high"),
+    ("retail store at night", "low"),
+    ("Прочитай, что написано в квитанции", "high"),
+    ("переведи текст с фото", "high"),
+    ("мелкий шрифт", "high"),
+    ("красивый закат", "low"),
+    ("", "low"),
+    (None, "low"),
+])
+def test_choose_image_detail_auto(monkeypatch, caption, detail):
+    monkeypatch.setattr(config, "vision_image_detail", "auto")
+    assert image_utils.choose_image_detail(caption) == detail
@@ -0,0 +1,164 @@
+"""Все запросы Database на встроенном хранилище: неподдержанный оператор здесь упадет раньше, чем в проде"""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import database
+import request_context
+from memory_storage import MemoryClient, UnsupportedQueryError
+
+USER_ID = 1
+GROUP_ID = -100
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def db():
+    db = database.Database()
+    assert db.is_embedded
+
+    run(db.register_user(USER_ID, USER_ID, username="user", first_name="First"))
+    run(db.start_new_dialog(USER_ID, USER_ID))
+    return db
+
+
+def new_dialog_message(text):
+    return {"user": [{"type": "text", "text": text}], "bot": f"answer to {text}", "date": datetime.now()}
+
+
+def test_users(db):
+    async def scenario():
+        assert await db.check_if_user_exists(USER_ID)
+        assert not await db.check_if_user_exists(2)
+        assert (await db.register_user(USER_ID, USER_ID))["username"] == "user"
+
+        await db.set_user_attribute(USER_ID, "language", "ru")
+        assert await db.get_user_attribute(USER_ID, "language") == "ru"
+        assert await db.get_chat_mode(USER_ID, USER_ID) == "assistant"
+        await db.set_chat_mode(USER_ID, "code_assistant", USER_ID)
+        assert await db.get_user_attribute(USER_ID, "current_chat_mode") == "code_assistant"
+
+        await db.update_n_used_tokens(USER_ID, "gpt-3.5-turbo", 10, 5)
+        await db.update_n_used_tokens(USER_ID, "gpt-3.5-turbo", 1, 1)
+        assert await db.get_user_attribute(USER_ID, "n_used_tokens") == {
+            "gpt-3_5-turbo": {"n_input_tokens": 11, "n_output_tokens": 6}
+        }
+
+        await db.migrate_legacy_data()
+
+    run(scenario())
+
+
+def test_groups(db):
+    async def scenario():
+        assert not await db.check_if_group_exists(GROUP_ID)
+        await db.add_new_group(GROUP_ID, "group", admin_id=None)
+        assert await db.check_if_group_exists(GROUP_ID)
+
+        await db.set_group_admin_id(GROUP_ID, USER_ID)
+        assert await db.is_group_admin(GROUP_ID, USER_ID)
+        await db.set_chat_mode(USER_ID, "artist", GROUP_ID)
+        assert await db.get_chat_mode(USER_ID, GROUP_ID) == "artist"
+        assert await db.get_group_attribute(GROUP_ID, "language") == "en"
+
+    run(scenario())
+
+
+def test_dialogs(db):
+    async def scenario():
+        for i in range(5):
+            await db.append_dialog_message(USER_ID, new_dialog_message(str(i)))
+        assert await db.get_dialog_message_count(USER_ID) == 5
+
+        dialog_messages, dialog_summary, n_not_loaded = await db.get_dialog_context(USER_ID, last_n=3)
+        assert [m["user"][0]["text"] for m in dialog_messages] == ["2", "3", "4"]
+        assert (dialog_summary, n_not_loaded) == (None, 2)
+
+        for dialog_message in dialog_messages:
+            dialog_message["n_tokens"] = {"cl100k_base": 7}
+        await db.save_dialog_token_counts(USER_ID, dialog_messages, [0, 2], "cl100k_base")
+        dialog_messages, _, _ = await db.get_dialog_context(USER_ID)
+        assert [m.get("n_tokens") for m in dialog_messages] == [None, None, {"cl100k_base": 7}, None, {"cl100k_base": 7}]
+
+        dialog_id = await db.get_user_attribute(USER_ID, "current_dialog_id")
+        dialog_messages, dialog_summary, n_summarized = await db.get_unsummarized_dialog(USER_ID, dialog_id)
+        assert (len(dialog_messages), dialog_summary, n_summarized) == (5, None, 0)
+
+        assert await db.set_dialog_summary(USER_ID, dialog_id, "summary", 2, 0)
+        dialog_messages, dialog_summary, n_summarized = await db.get_unsummarized_dialog(USER_ID, dialog_id)
+        assert [m["user"][0]["text"] for m in dialog_messages] == ["2", "3", "4"]
+        assert (dialog_summary, n_summarized) == ("summary", 2)
+        assert not await db.set_dialog_summary(USER_ID, dialog_id, "stale", 3, 0)
+        dialog_messages, dialog_summary, n_not_loaded = await db.get_dialog_context(USER_ID, last_n=10)
+        assert len(dialog_messages) == 3 and dialog_summary == "summary" and n_not_loaded == 0
+
+        assert (await db.pop_last_dialog_message(USER_ID))["user"][0]["text"] == "4"
+        assert await db.get_dialog_message_count(USER_ID) == 4
+
+        image_id = await db.put_image(b"jpeg")
+        assert await db.put_image(b"jpeg") == image_id
+        assert await db.get_image(image_id) == b"jpeg"
+        loaded = await db.load_dialog_images([{"user": [{"type": "image", "image_id": image_id}], "bot": ""}])
+        assert loaded[0]["user"][0]["image"] == "anBlZw=="
+
+    run(scenario())
+
+
+def test_subscriptions_and_usage(db):
+    async def scenario():
+        assert not await db.get_user_subscription_status(USER_ID)
+        db.invalidate_subscription_cache(USER_ID)
+
+        subscription_id = await db.create_subscription(USER_ID, "premium", 30)
+        await db.record_payment(USER_ID, 100.0, "RUB", subscription_id)
+        db.invalidate_subscription_cache(USER_ID)
+        assert await db.get_user_subscription_status(USER_ID)
+        assert (await db.get_user_subscription_info(USER_ID))["_id"] == subscription_id
+        assert await db.get_subscription_stats() == {"active_subscriptions": 1, "total_revenue": 100.0}
+
+        await db.cancel_subscription(USER_ID)
+        assert not await db.get_user_subscription_status(USER_ID)
+
+        await db.add_daily_usage(USER_ID, "messages")
+        await db.add_daily_usage(USER_ID, "messages", 2)
+        db.daily_usage_cache = {}
+        assert await db.get_daily_usage(USER_ID, "messages") == 3
+
+    run(scenario())
+
+
+def test_request_context_and_interactions(db):
+    async def scenario():
+        await db.add_new_group(GROUP_ID, "group")
+        request = await db.load_request_context(USER_ID, GROUP_ID)
+        token = request_context.activate(request)
+        try:
+            await db.set_user_attribute(USER_ID, "language", "ru")
+            db.update_last_interaction(USER_ID)
+            db.update_group_last_interaction(GROUP_ID)
+            await db.flush_request_context()
+        finally:
+            request_context.deactivate(token)
+
+        assert await db.get_user_attribute(USER_ID, "language") == "ru"
+        await db.flush_last_interactions()
+        assert db.pending_user_interactions == {}
+
+        await db.ensure_indexes()
+        assert await db.get_index_report() == {"missing": [], "mismatched": [], "unused": []}
+
+    run(scenario())
+
+
+def test_unsupported_operator_raises_value_error():
+    collection = MemoryClient()["test"]["collection"]
+    run(collection.insert_one({"_id": 1, "name": "a"}))
+
+    with pytest.raises(UnsupportedQueryError):
+        run(collection.find_one({"name": {"$regex": "^a"}}))
+    with pytest.raises(ValueError):
+        run(collection.update_one({"_id": 1}, {"$rename": {"name": "title"}}))
@@ -0,0 +1,111 @@
+"""Замена деградировавшей модели: сообщение уходит в совместимую модель, которую умеет отправлять ChatGPT"""
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import openai
+import pytest
+from openai.openai_object import OpenAIObject
+
+import config
+import database
+import message_handlers
+import openai_utils
+
+USER_ID = 11
+
+
+class FakeEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def openai_requests(monkeypatch):
+    monkeypatch.setattr(openai_utils, "get_encoding", lambda model: FakeEncoding())
+    monkeypatch.setattr(openai_utils, "get_encoding_name", lambda model: "fake")
+    monkeypatch.setattr(openai_utils, "model_router", openai_utils.ModelRouter())
+    monkeypatch.setattr(openai_utils, "_circuit_breakers", {})
+    monkeypatch.setattr(config, "enable_message_streaming", True)
+
+    requests = []
+
+    async def acreate(**kwargs):
+        requests.append(kwargs)
+
+        async def stream():
+            for content in ("fallback", " answer"):
+                yield OpenAIObject.construct_from({"choices": [{"delta": {"content": content}}]})
+        return stream()
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    return requests
+
+
+def make_update(text):
+    message = MagicMock()
+    message.chat.type = "private"
+    message.chat.id = USER_ID
+    message.chat_id = USER_ID
+    message.chat.send_action = AsyncMock()
+    message.from_user = SimpleNamespace(id=USER_ID, username="user", first_name="First", last_name="Last")
+    message.text = text
+    message.caption = None
+    message.photo = []
+    message.reply_text = AsyncMock(return_value=SimpleNamespace(chat_id=USER_ID, message_id=1))
+    return SimpleNamespace(message=message, edited_message=None, callback_query=None)
+
+
+def open_circuit_breaker(model):
+    circuit_breaker = openai_utils.get_circuit_breaker(model)
+    circuit_breaker.state = circuit_breaker.OPEN
+    circuit_breaker.opened_at = time.monotonic()
+
+
+def test_fallback_skips_models_the_send_path_cannot_handle(openai_requests, monkeypatch):
+    # модель без ветки отправки в ChatGPT не может стать заменой, даже если она первая в списке
+    monkeypatch.setitem(config.models["info"], "gpt-unknown", {"type": "chat_completion", "name": "Unknown"})
+    monkeypatch.setitem(config.models, "available_text_models", ["gpt-unknown", "gpt-4o", "gpt-4-vision-preview"])
+    open_circuit_breaker("gpt-4o")
+
+    assert openai_utils.model_router.choose_model("gpt-4o", is_premium=True) == "gpt-4-vision-preview"
+
+
+def test_message_is_answered_by_fallback_model(openai_requests, monkeypatch):
+    monkeypatch.setitem(config.models, "available_text_models", ["gpt-4o", "gpt-4-vision-preview"])
+    open_circuit_breaker("gpt-4o")
+
+    db = database.Database()
+    update = make_update("hello")
+
+    async def scenario():
+        await db.register_user(USER_ID, USER_ID)
+        await db.start_new_dialog(USER_ID, USER_ID)
+        await db.create_subscription(USER_ID, "premium", 30)
+        await db.set_user_attribute(USER_ID, "current_model", "gpt-4o")
+
+        context = SimpleNamespace(bot=SimpleNamespace(username="bot", id=1, edit_message_text=AsyncMock()))
+        await message_handlers.message_handle(update, context, db)
+        return await db.get_dialog_context(USER_ID), await db.get_user_attribute(USER_ID, "n_used_tokens")
+
+    (dialog_messages, _, _), n_used_tokens = asyncio.run(scenario())
+
+    assert [request["model"] for request in openai_requests] == ["gpt-4-vision-preview"]
+    assert dialog_messages[-1]["bot"] == "fallback answer"
+    assert "gpt-4-vision-preview" in n_used_tokens
+
+    replies = [call.args[0] for call in update.message.reply_text.call_args_list]
+    assert not any(reply.startswith("Something went wrong") for reply in replies)
+    assert any("model_fallback_used" in reply for reply in replies)
+
+
+def test_full_completion_time_is_not_counted_as_ttft(openai_requests):
+    router = openai_utils.model_router
+    for _ in range(config.router_min_samples):
+        router.record_completion("gpt-4", config.router_max_ttft + 5)
+    assert not router.is_degraded("gpt-4")
+
+    for _ in range(config.router_min_samples):
+        router.record_completion("gpt-4", config.router_max_latency + 5)
+    assert router.is_degraded("gpt-4")
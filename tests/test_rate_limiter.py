@@ -0,0 +1,77 @@
+"""Token bucket на модель: резерв сверяется с фактом и возвращается при отмене"""
+import asyncio
+
+import openai
+import pytest
+
+import openai_utils
+
+
+class FakeEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def openai_state(monkeypatch):
+    monkeypatch.setattr(openai_utils, "get_encoding", lambda model: FakeEncoding())
+    monkeypatch.setattr(openai_utils, "get_encoding_name", lambda model: "fake")
+    monkeypatch.setattr(openai_utils, "_rate_limiters", {})
+    monkeypatch.setattr(openai_utils, "_circuit_breakers", {})
+    monkeypatch.setattr(openai_utils, "completion_cache", None)
+
+
+def test_reconcile_uses_the_capped_reservation():
+    rate_limiter = openai_utils.ModelRateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+
+    async def scenario():
+        n_reserved_tokens = await rate_limiter.acquire(5000, max_wait=1)
+        assert n_reserved_tokens == 1000
+        rate_limiter.reconcile(n_reserved_tokens, 300)
+
+    asyncio.run(scenario())
+
+    # списано ровно 300 использованных токенов, а не 5000 - 300 возвращено сверх бюджета
+    assert rate_limiter.available_tokens == pytest.approx(700, abs=5)
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    rate_limiter = openai_utils.ModelRateLimiter(requests_per_minute=1, tokens_per_minute=1000)
+
+    async def scenario():
+        await rate_limiter.acquire(10, max_wait=1)
+        waiter = asyncio.create_task(rate_limiter.acquire(10, max_wait=120))
+        await asyncio.sleep(0.01)
+        assert rate_limiter.n_waiting == 1
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(scenario())
+
+    assert rate_limiter.n_waiting == 0
+    assert not rate_limiter.queue_lock.locked()
+
+
+def test_cancelled_completion_returns_its_reservation(openai_state, monkeypatch):
+    async def acreate(**kwargs):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+
+    async def scenario():
+        task = asyncio.create_task(openai_utils.ChatGPT("gpt-4").send_message("hello"))
+        await asyncio.sleep(0.01)
+        rate_limiter = openai_utils.get_rate_limiter("gpt-4")
+        assert rate_limiter.available_tokens < rate_limiter.tokens_per_minute
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return rate_limiter
+
+    rate_limiter = asyncio.run(scenario())
+
+    assert rate_limiter.available_tokens == pytest.approx(rate_limiter.tokens_per_minute)
+    assert rate_limiter.available_requests < rate_limiter.requests_per_minute
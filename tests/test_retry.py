@@ -0,0 +1,126 @@
+"""/retry через обработчик: сохраненное сообщение (список частей) повторяется как текст и фото из GridFS"""
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import openai
+import pytest
+from openai.openai_object import OpenAIObject
+
+import config
+import database
+import message_handlers
+import openai_utils
+
+USER_ID = 7
+
+
+class FakeEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def openai_requests(monkeypatch):
+    monkeypatch.setattr(openai_utils, "get_encoding", lambda model: FakeEncoding())
+    monkeypatch.setattr(openai_utils, "get_encoding_name", lambda model: "fake")
+    monkeypatch.setattr(config, "enable_message_streaming", False)
+
+    requests = []
+
+    async def acreate(**kwargs):
+        requests.append(kwargs)
+        return OpenAIObject.construct_from({
+            "choices": [{"message": {"role": "assistant", "content": "retried answer"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 3}
+        })
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    return requests
+
+
+def make_update(text):
+    message = MagicMock()
+    message.chat.type = "private"
+    message.chat.id = USER_ID
+    message.chat_id = USER_ID
+    message.chat.send_action = AsyncMock()
+    message.from_user = SimpleNamespace(id=USER_ID, username="user", first_name="First", last_name="Last")
+    message.text = text
+    message.caption = None
+    message.photo = []
+    message.reply_text = AsyncMock(return_value=SimpleNamespace(chat_id=USER_ID, message_id=1))
+    return SimpleNamespace(message=message, edited_message=None, callback_query=None)
+
+
+def make_context():
+    return SimpleNamespace(bot=SimpleNamespace(username="bot", id=1, edit_message_text=AsyncMock()))
+
+
+async def create_dialog(db, user_content, current_model=None):
+    await db.register_user(USER_ID, USER_ID)
+    await db.start_new_dialog(USER_ID, USER_ID)
+    if current_model is not None:
+        await db.create_subscription(USER_ID, "premium", 30)
+        await db.set_user_attribute(USER_ID, "current_model", current_model)
+
+    await db.append_dialog_message(USER_ID, {"user": user_content, "bot": "old answer", "date": datetime.now()})
+
+
+def test_retry_text_message(openai_requests):
+    db = database.Database()
+
+    async def scenario():
+        await create_dialog(db, [{"type": "text", "text": "hello there"}])
+        await message_handlers.retry_handle(make_update("/retry"), make_context(), db)
+        return await db.get_dialog_context(USER_ID)
+
+    dialog_messages, _, _ = asyncio.run(scenario())
+
+    assert openai_requests[-1]["messages"][-1] == {"role": "user", "content": "hello there"}
+    assert len(dialog_messages) == 1
+    assert dialog_messages[0]["user"] == [{"type": "text", "text": "hello there"}]
+    assert dialog_messages[0]["bot"] == "retried answer"
+
+
+def test_retry_photo_message(openai_requests):
+    db = database.Database()
+
+    async def scenario():
+        image_id = await db.put_image(b"jpeg")
+        await create_dialog(db, [
+            {"type": "text", "text": "what is this"},
+            {"type": "image", "image_id": image_id, "detail": "low"}
+        ], current_model="gpt-4o")
+        await message_handlers.retry_handle(make_update("/retry"), make_context(), db)
+        return image_id, await db.get_dialog_context(USER_ID)
+
+    image_id, (dialog_messages, _, _) = asyncio.run(scenario())
+
+    text_part, image_part = openai_requests[-1]["messages"][-1]["content"]
+    assert text_part == {"type": "text", "text": "what is this"}
+    assert image_part["image_url"] == {"url": "data:image/jpeg;base64,anBlZw==", "detail": "low"}
+    assert len(dialog_messages) == 1
+    assert dialog_messages[0]["user"][1] == {"type": "image", "image_id": image_id, "detail": "low"}
+
+
+def test_retry_keeps_message_when_completion_fails(openai_requests, monkeypatch):
+    async def acreate(**kwargs):
+        raise openai.error.AuthenticationError("Incorrect API key provided")
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    db = database.Database()
+    update = make_update("/retry")
+
+    async def scenario():
+        await create_dialog(db, [{"type": "text", "text": "hello there"}])
+        await message_handlers.retry_handle(update, make_context(), db)
+        return await db.get_dialog_context(USER_ID)
+
+    dialog_messages, _, _ = asyncio.run(scenario())
+
+    assert any(call.args[0].startswith("Something went wrong") for call in update.message.reply_text.call_args_list)
+    assert len(dialog_messages) == 1
+    assert dialog_messages[0]["user"] == [{"type": "text", "text": "hello there"}]
+    assert dialog_messages[0]["bot"] == "old answer"
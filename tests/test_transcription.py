@@ -0,0 +1,52 @@
+"""Параллельное распознавание кусков голосового: ошибка одного куска не теряет остальные"""
+import asyncio
+
+import pytest
+
+import openai_utils
+
+
+@pytest.fixture(autouse=True)
+def fresh_semaphore(monkeypatch):
+    # семафор привязывается к event loop, а каждый asyncio.run создает новый
+    monkeypatch.setattr(openai_utils, "_transcription_semaphore", None)
+
+
+def fake_transcribe(failed_names):
+    async def transcribe_audio(audio_file):
+        if audio_file.name in failed_names:
+            raise openai_utils.OpenAIUnavailableError("whisper is down")
+        return f" {audio_file.read().decode()} "
+    return transcribe_audio
+
+
+def test_failed_chunk_keeps_other_transcripts(monkeypatch):
+    monkeypatch.setattr(openai_utils, "transcribe_audio", fake_transcribe({"voice_1.oga"}))
+    progress = []
+
+    async def on_progress(n_done, n_total):
+        progress.append((n_done, n_total))
+
+    text, failed_chunks = asyncio.run(openai_utils.transcribe_audio_chunks([b"one", b"two", b"three"], on_progress))
+
+    assert text == "one three"
+    assert failed_chunks == [2]
+    assert sorted(progress) == [(1, 3), (2, 3), (3, 3)]
+
+
+def test_all_chunks_failed_raises(monkeypatch):
+    monkeypatch.setattr(openai_utils, "transcribe_audio", fake_transcribe({"voice_0.oga", "voice_1.oga"}))
+
+    with pytest.raises(openai_utils.OpenAIUnavailableError):
+        asyncio.run(openai_utils.transcribe_audio_chunks([b"one", b"two"]))
+
+
+def test_progress_errors_do_not_fail_transcription(monkeypatch):
+    monkeypatch.setattr(openai_utils, "transcribe_audio", fake_transcribe(set()))
+
+    async def on_progress(n_done, n_total):
+        raise TimeoutError("telegram timed out")
+
+    text, failed_chunks = asyncio.run(openai_utils.transcribe_audio_chunks([b"one", b"two"], on_progress))
+
+    assert (text, failed_chunks) == ("one two", [])